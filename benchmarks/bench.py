@@ -0,0 +1,543 @@
+"""
+Benchmarks for the scan, hash, database and upload pipeline.
+
+Generates a synthetic media tree, runs the daemon's own scanner, hasher,
+watcher, database and upload pool against an in-process fake Immich server
+and writes the results as JSON so runs can be compared across commits.
+
+    uv run benchmarks/bench.py --files 2000 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import uvloop
+
+from loguru import logger
+from watchdog.observers import Observer
+
+from fake_immich import FakeImmich
+
+from immich_upload_daemon import main as daemon
+from immich_upload_daemon import metrics
+from immich_upload_daemon.database import PENDING, Database
+from immich_upload_daemon.files import (
+    EventCoalescer,
+    MediaFileHandler,
+    scan_existing_files,
+)
+from immich_upload_daemon.hasher import Hasher
+from immich_upload_daemon.immich import Immich
+from immich_upload_daemon.network import NetworkMonitor, NetworkState
+from immich_upload_daemon.schedule import UploadOrder
+from immich_upload_daemon.uploader import Target, UploadPool, check_existing_assets
+
+
+class OnlineProvider:
+    """Network provider that always reports an unmetered connection."""
+
+    async def snapshot(self) -> NetworkState:
+        return NetworkState(connected=True, metered=False)
+
+    async def watch(self, on_change) -> None:
+        await asyncio.Event().wait()
+
+
+def write_file(path: str, size: int, rng: random.Random) -> None:
+    # A random block repeated keeps generation fast, the unique header keeps
+    # every file's hash different
+    block = rng.randbytes(min(size, 64 * 1024)) or b"\0"
+    with open(path, "wb") as f:
+        f.write(path.encode())
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def generate_tree(
+    root: str,
+    files: int,
+    dirs: int,
+    photo_size: int,
+    video_size: int,
+    video_ratio: float,
+    seed: int,
+    prefix: str = "IMG",
+) -> int:
+    """Create a media tree, file sizes vary by up to half around the mean."""
+    rng = random.Random(seed)
+    total = 0
+    for i in range(files):
+        directory = os.path.join(root, f"dir{i % max(1, dirs):04d}")
+        os.makedirs(directory, exist_ok=True)
+
+        if rng.random() < video_ratio:
+            size = int(video_size * rng.uniform(0.5, 1.5))
+            path = os.path.join(directory, f"{prefix}_{i:07d}.mp4")
+        else:
+            size = int(photo_size * rng.uniform(0.5, 1.5))
+            path = os.path.join(directory, f"{prefix}_{i:07d}.jpg")
+
+        write_file(path, size, rng)
+        total += size
+
+    return total
+
+
+async def count_media(db: Database) -> int:
+    await db.flush()
+    async with db.connection.execute("SELECT COUNT(*) FROM media") as cursor:
+        row = await cursor.fetchone()
+        return row[0]
+
+
+async def bench_scan(args, media_dir: str, db: Database) -> dict:
+    hasher = Hasher(db, args.hash_workers, args.hash_processes, lambda: None)
+    start = time.perf_counter()
+    roots = await scan_existing_files(
+        [media_dir], db, hasher, asyncio.Event(), args.scan_concurrency
+    )
+    await db.flush()
+    seconds = time.perf_counter() - start
+    await hasher.close()
+
+    files = await count_media(db)
+    return {
+        "seconds": seconds,
+        "files": files,
+        "files_per_second": files / seconds,
+        "roots": [
+            {
+                "path": root.path,
+                "files": root.files,
+                "directories": root.directories,
+                "seconds": root.seconds,
+                "files_per_second": root.files_per_second,
+            }
+            for root in roots
+        ],
+    }
+
+
+async def bench_watcher_burst(args, media_dir: str, db: Database) -> dict:
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[tuple[str, str | None]] = asyncio.Queue(args.queue_size)
+    hasher = Hasher(db, args.hash_workers, args.hash_processes, lambda: None)
+
+    coalescer = EventCoalescer(queue, args.quiet_period, db)
+    metrics.watcher_queue_high_water.set(0)
+    spilled = metrics.spilled_files.value
+    tasks = [
+        asyncio.create_task(coalescer.run()),
+        asyncio.create_task(coalescer.drain()),
+        asyncio.create_task(daemon.watcher(hasher, queue)),
+    ]
+
+    observer = Observer()
+    observer.schedule(MediaFileHandler(coalescer, loop), media_dir, recursive=True)
+    observer.start()
+
+    before = await count_media(db)
+    start = time.perf_counter()
+    burst_dir = os.path.join(media_dir, "burst")
+    await asyncio.to_thread(
+        generate_tree,
+        burst_dir,
+        args.burst,
+        1,
+        args.photo_size,
+        args.video_size,
+        args.video_ratio,
+        args.seed + 1,
+        "BURST",
+    )
+    written = time.perf_counter() - start
+
+    # Wait until every file of the burst made it into the database, sampling
+    # the paths held in memory by the coalescer and the queue
+    deadline = start + args.timeout
+    held = len(coalescer.pending) + queue.qsize()
+    while await count_media(db) < before + args.burst:
+        if time.perf_counter() > deadline:
+            break
+        await asyncio.sleep(0.05)
+        held = max(held, len(coalescer.pending) + queue.qsize())
+    seconds = time.perf_counter() - start
+
+    observer.stop()
+    observer.join()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await hasher.close()
+
+    ingested = await count_media(db) - before
+    return {
+        "seconds": seconds,
+        "write_seconds": written,
+        "files": ingested,
+        "files_per_second": ingested / seconds,
+        "peak_paths_held": held,
+        "queue_high_water": metrics.watcher_queue_high_water.value,
+        "spilled": metrics.spilled_files.value - spilled,
+    }
+
+
+async def start_targets(args, db: Database) -> tuple[list, list[Target], asyncio.Task]:
+    """Start a fake server and client for every target of the database."""
+    servers = []
+    targets = []
+    monitor = NetworkMonitor(OnlineProvider(), False, None, False)
+    monitor_task = asyncio.create_task(monitor.run())
+    await monitor.refresh()
+
+    for name in db.targets:
+        server = FakeImmich(
+            args.latency, args.bandwidth, args.duplicate_rate, args.seed
+        )
+        url = await server.start()
+        servers.append(server)
+
+        immich = Immich(
+            url,
+            "benchmark",
+            args.chunk_size,
+            stream_files=args.upload_body != "generator",
+            connection_limit=args.concurrency + 1,
+        )
+        await immich.connect()
+        targets.append(Target(name, immich, monitor))
+
+    return servers, targets, monitor_task
+
+
+async def stop_targets(servers: list, targets: list[Target], monitor_task) -> None:
+    monitor_task.cancel()
+    await asyncio.gather(monitor_task, return_exceptions=True)
+    for target in targets:
+        await target.immich.close()
+    for server in servers:
+        await server.stop()
+
+
+async def bench_upload(args, db: Database) -> dict:
+    # One fake server per target, all fed from a single read of each file
+    servers, targets, monitor_task = await start_targets(args, db)
+
+    pool = UploadPool(db, targets, args.concurrency, asyncio.Event())
+    pool.start()
+
+    start = time.perf_counter()
+    skipped = 0
+    if args.bulk_check_batch_size > 0:
+        skipped = await check_existing_assets(db, targets, args.bulk_check_batch_size)
+
+    async for file_name, priority in db.iter_unuploaded(args.page_size):
+        await pool.submit(file_name, priority)
+    await pool.join()
+    await pool.stop()
+    await db.flush()
+    seconds = time.perf_counter() - start
+
+    await stop_targets(servers, targets, monitor_task)
+
+    # Totals over all targets
+    uploads = sum(server.uploads for server in servers)
+    received = sum(server.bytes_received for server in servers)
+    return {
+        "seconds": seconds,
+        "targets": len(targets),
+        "files": uploads,
+        "skipped": skipped,
+        "duplicates": sum(server.duplicates for server in servers),
+        "bytes": received,
+        "files_per_second": uploads / seconds,
+        "bytes_per_second": received / seconds,
+        "connections_opened": sum(t.immich.connections_opened for t in targets),
+        "connections_reused": sum(t.immich.connections_reused for t in targets),
+        "pending_after": await db.count_unuploaded(),
+    }
+
+
+async def bench_priority(args, media_dir: str, db: Database) -> dict:
+    """
+    Time until a photo taken while the backlog is uploading reaches the
+    server, with every file in the database made pending again first. Most
+    telling with a --bandwidth limit, so the backlog takes a while.
+    """
+    await db.flush()
+    await db.connection.execute(
+        f"UPDATE uploads SET status = {PENDING}, attempts = 0, last_error = NULL, next_attempt_at = 0"
+    )
+    await db.connection.execute(f"UPDATE media SET status = {PENDING}")
+    await db.connection.commit()
+
+    servers, targets, monitor_task = await start_targets(args, db)
+    pool = UploadPool(db, targets, args.concurrency, asyncio.Event())
+    pool.start()
+
+    daemon.new_file_event.set()
+    uploader = asyncio.create_task(
+        daemon.uploader(db, targets, pool, 0, args.page_size)
+    )
+
+    # Let the backlog get going before the new photo shows up
+    backlog = await db.count_unuploaded()
+    while sum(server.uploads for server in servers) < min(args.concurrency, backlog):
+        await asyncio.sleep(0.01)
+
+    path = os.path.join(media_dir, "new", "IMG_new.jpg")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file(path, args.photo_size, random.Random(args.seed))
+
+    hasher = Hasher(db, 1, False, daemon.new_file_event.set)
+    uploaded_before = sum(server.uploads for server in servers)
+    start = time.perf_counter()
+    await hasher.submit(path)
+    async with asyncio.timeout(args.timeout):
+        while not await db.is_uploaded(path):
+            await asyncio.sleep(0.01)
+    seconds = time.perf_counter() - start
+    uploaded_meanwhile = sum(server.uploads for server in servers) - uploaded_before
+
+    uploader.cancel()
+    await asyncio.gather(uploader, return_exceptions=True)
+    await pool.stop()
+    await hasher.close()
+    await stop_targets(servers, targets, monitor_task)
+    os.remove(path)
+
+    return {
+        "order": db.order.name,
+        "backlog": backlog,
+        "seconds": seconds,
+        "uploaded_meanwhile": uploaded_meanwhile,
+    }
+
+
+async def bench_file_index(args, workdir: str) -> dict:
+    """Load and query the file index of a synthetic library with no files."""
+    db_path = os.path.join(workdir, "index.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+    db = Database(db_path, file_index=False)
+    await db.init_db()
+    await db.connection.executemany(
+        "INSERT INTO directories (id, path) VALUES (?, ?)",
+        ((i + 1, f"/media/DCIM/dir{i:04d}") for i in range(1000)),
+    )
+    rows = (
+        (i % 1000 + 1, f"IMG_{i:08d}.jpg", i.to_bytes(16, "big"), i % 2, i, i, i, 1)
+        for i in range(args.index_files)
+    )
+    await db.connection.executemany(
+        "INSERT INTO media (directory_id, name, file_hash, status, size, mtime_ns, inode, device) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    await db.connection.commit()
+    await db.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db_bytes = os.path.getsize(db_path)
+
+    start = time.perf_counter()
+    await db.load_index()
+    load_seconds = time.perf_counter() - start
+
+    # Loaded again for the memory, tracing slows the load down considerably
+    db.index = None
+    tracemalloc.start()
+    await db.load_index()
+    traced, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Lookups of known files through the index and through SQLite
+    sample = random.Random(args.seed).sample(range(args.index_files), 10000)
+    names = [f"/media/DCIM/dir{i % 1000:04d}/IMG_{i:08d}.jpg" for i in sample]
+    stats = [os.stat_result((0, i, 1, 0, 0, 0, i, 0, 0, 0)) for i in sample]
+
+    start = time.perf_counter()
+    for name, stat in zip(names, stats):
+        await db.needs_hash(name, stat)
+    index_seconds = time.perf_counter() - start
+
+    index, db.index = db.index, None
+    start = time.perf_counter()
+    for name, stat in zip(names, stats):
+        await db.needs_hash(name, stat)
+    query_seconds = time.perf_counter() - start
+
+    # First page of uploads out of the half of the library that is pending
+    pending = db.iter_unuploaded(args.page_size)
+    start = time.perf_counter()
+    for _ in range(args.page_size):
+        await anext(pending)
+    page_seconds = time.perf_counter() - start
+    await pending.aclose()
+
+    await db.close()
+    return {
+        "files": len(index),
+        "db_bytes": db_bytes,
+        "load_seconds": load_seconds,
+        "index_bytes": index.memory_usage(),
+        "traced_bytes": traced,
+        "peak_load_bytes": peak,
+        "index_lookups_per_second": len(names) / index_seconds,
+        "query_lookups_per_second": len(names) / query_seconds,
+        "first_page_seconds": page_seconds,
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="immich_bench_")
+    media_dir = os.path.join(workdir, "media")
+    db_path = os.path.join(workdir, "bench.db")
+
+    shutil.rmtree(media_dir, ignore_errors=True)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+    start = time.perf_counter()
+    total_bytes = await asyncio.to_thread(
+        generate_tree,
+        media_dir,
+        args.files,
+        args.dirs,
+        args.photo_size,
+        args.video_size,
+        args.video_ratio,
+        args.seed,
+    )
+    logger.warning(
+        f"Generated {args.files} files ({total_bytes} bytes) in "
+        f"{time.perf_counter() - start:.1f}s"
+    )
+
+    db = Database(
+        db_path,
+        targets=[f"target{i}" for i in range(args.targets)],
+        order=UploadOrder(args.order),
+    )
+    await db.init_db()
+
+    stages = args.stages.split(",")
+    results = {}
+    if "cold_scan" in stages:
+        results["cold_scan"] = await bench_scan(args, media_dir, db)
+    if "warm_scan" in stages:
+        results["warm_scan"] = await bench_scan(args, media_dir, db)
+    if "watcher_burst" in stages:
+        results["watcher_burst"] = await bench_watcher_burst(args, media_dir, db)
+    if "upload" in stages:
+        results["upload"] = await bench_upload(args, db)
+    if "priority" in stages:
+        results["priority"] = await bench_priority(args, media_dir, db)
+    if "file_index" in stages:
+        results["file_index"] = await bench_file_index(args, workdir)
+
+    await db.close()
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {**vars(args), "total_bytes": total_bytes},
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--dirs", type=int, default=20)
+    parser.add_argument("--photo-size", type=int, default=3 * 1024 * 1024)
+    parser.add_argument("--video-size", type=int, default=50 * 1024 * 1024)
+    parser.add_argument("--video-ratio", type=float, default=0.02)
+    parser.add_argument("--burst", type=int, default=500)
+    parser.add_argument("--quiet-period", type=float, default=0.5)
+    parser.add_argument("--queue-size", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--bandwidth", type=float, default=0, help="bytes/s")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument(
+        "--targets",
+        type=int,
+        default=1,
+        help="number of fake servers every file is uploaded to",
+    )
+    parser.add_argument("--scan-concurrency", type=int, default=2)
+    parser.add_argument("--hash-workers", type=int, default=4)
+    parser.add_argument("--hash-processes", action="store_true")
+    parser.add_argument("--chunk-size", type=int, default=65536)
+    parser.add_argument("--upload-body", choices=("file", "generator"), default="file")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument(
+        "--order", default="newest", help="upload order, as UPLOAD_ORDER"
+    )
+    parser.add_argument("--bulk-check-batch-size", type=int, default=500)
+    parser.add_argument("--index-files", type=int, default=1_000_000)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", default="cold_scan,warm_scan,watcher_burst,upload")
+    parser.add_argument("--workdir", help="keep the generated files here")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument(
+        "--loop",
+        choices=("uvloop", "asyncio"),
+        default="uvloop",
+        help="event loop to run on, the daemon runs on uvloop",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    # Only keep the benchmark's own progress and the daemon's warnings
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    if args.loop == "uvloop":
+        uvloop.install()
+    results = asyncio.run(run(args))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
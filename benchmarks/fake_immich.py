@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import random
+
+from aiohttp import web
+
+
+class FakeImmich:
+    """
+    In-process stand-in for the Immich endpoints the daemon uses. Every
+    request waits for latency seconds, asset bodies are read no faster than
+    bandwidth bytes per second and a duplicate_rate share of uploads is
+    answered as a duplicate. Like Immich, uploads with the checksum of a
+    known asset in the x-immich-checksum header are answered as duplicates
+    without reading the body.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        bandwidth: float = 0,
+        duplicate_rate: float = 0,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.duplicate_rate = duplicate_rate
+        self.random = random.Random(seed)
+
+        self.checksums: set[str] = set()
+        self.uploads: int = 0
+        self.duplicates: int = 0
+        self.early_duplicates: int = 0
+        self.bytes_received: int = 0
+
+        self.runner: web.AppRunner | None = None
+        self.url: str = ""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=0)
+        app.router.add_post("/api/assets", self.handle_upload)
+        app.router.add_post("/api/assets/bulk-upload-check", self.handle_bulk_check)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+
+        # Resolve the port picked by the OS when port is 0
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/api"
+        return self.url
+
+    async def stop(self) -> None:
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def handle_upload(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        known = request.headers.get("x-immich-checksum")
+        if known in self.checksums:
+            self.early_duplicates += 1
+            return web.json_response({"id": known, "status": "duplicate"})
+
+        checksum = hashlib.sha1()
+        reader = await request.multipart()
+        try:
+            async for part in reader:
+                if part.name != "assetData":
+                    await part.release()
+                    continue
+
+                while chunk := await part.read_chunk(1024 * 1024):
+                    checksum.update(chunk)
+                    self.bytes_received += len(chunk)
+                    if self.bandwidth:
+                        await asyncio.sleep(len(chunk) / self.bandwidth)
+
+        except ConnectionResetError:
+            # The client gave up on the upload, e.g. when it was paused
+            return web.Response(status=499)
+
+        self.uploads += 1
+        self.checksums.add(checksum.hexdigest())
+
+        if self.random.random() < self.duplicate_rate:
+            self.duplicates += 1
+            return web.json_response({"id": "duplicate", "status": "duplicate"})
+
+        return web.json_response({"id": str(self.uploads), "status": "created"})
+
+    async def handle_bulk_check(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        body = await request.json()
+        results = []
+        for asset in body.get("assets", []):
+            if asset["checksum"] in self.checksums:
+                results.append(
+                    {
+                        "id": asset["id"],
+                        "action": "reject",
+                        "reason": "duplicate",
+                        "assetId": asset["checksum"],
+                    }
+                )
+            else:
+                results.append({"id": asset["id"], "action": "accept"})
+
+        return web.json_response({"results": results})
@@ -96,7 +96,10 @@
               );
         in
         {
-          default = pythonSet.mkVirtualEnv "immich-upload-daemon-env" workspace.deps.default;
+          # With the D-Bus bindings the WIFI_ONLY and NOT_METERED conditions need
+          default = pythonSet.mkVirtualEnv "immich-upload-daemon-env" (
+            workspace.deps.default // { immich-upload-daemon = [ "networkmanager" ]; }
+          );
         }
       ) nixpkgs.legacyPackages;
 
@@ -0,0 +1,278 @@
+import os
+
+from datetime import datetime
+
+import aiohttp
+
+from loguru import logger
+from xdg.BaseDirectory import xdg_cache_home
+
+from .database import Database
+from .hasher import Hasher
+from .reconcile import Reconciler
+from .schedule import VIDEO
+from .throttle import Bandwidth
+from .uploader import UploadPool
+
+
+def get_socket_path() -> str:
+    """
+    Default path of the control socket, in the user's runtime directory when
+    there is one.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "immich_upload_daemon.sock")
+
+    return os.path.join(xdg_cache_home, "immich_upload_daemon", "control.sock")
+
+
+class ControlServer:
+    """
+    JSON API on a Unix socket to inspect and steer the running daemon: its
+    status, pausing and resuming uploads, uploading a file right away,
+    reconciling the media paths and changing the upload concurrency or
+    bandwidth without a restart. Only the owner of the socket can connect to
+    it.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        db: Database,
+        hasher: Hasher,
+        pool: UploadPool,
+        bandwidth: Bandwidth,
+        reconciler: Reconciler,
+    ) -> None:
+        self.socket_path = socket_path
+        self.db = db
+        self.hasher = hasher
+        self.pool = pool
+        self.bandwidth = bandwidth
+        self.reconciler = reconciler
+
+        self.runner = None
+
+    async def start(self) -> None:
+        # Only imported when the control socket is enabled
+        from aiohttp import web
+
+        def route(handler):
+            async def handle(request: web.Request) -> web.Response:
+                try:
+                    # Invalid JSON raises a ValueError too
+                    body = await request.json() if request.can_read_body else {}
+                    return web.json_response(await handler(body))
+                except ValueError as e:
+                    return web.json_response({"error": str(e)}, status=400)
+
+            return handle
+
+        app = web.Application()
+        app.router.add_get("/status", route(self.status))
+        app.router.add_post("/pause", route(self.pause))
+        app.router.add_post("/resume", route(self.resume))
+        app.router.add_post("/upload", route(self.upload))
+        app.router.add_post("/reconcile", route(self.reconcile))
+        app.router.add_post("/settings", route(self.settings))
+
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.UnixSite(self.runner, self.socket_path).start()
+        os.chmod(self.socket_path, 0o600)
+
+        logger.info(f"Listening for control commands on {self.socket_path}")
+
+    async def stop(self) -> None:
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def status(self, body: dict) -> dict:
+        failed, next_retry_at = await self.db.failed_summary()
+        last_pass = self.reconciler.last
+
+        return {
+            "paused": self.pool.paused,
+            "concurrency": self.pool.concurrency,
+            "max_concurrency": self.pool.max_concurrency,
+            "bandwidth": self.bandwidth.rate,
+            "order": self.db.order.name,
+            "targets": [
+                {
+                    "name": target.name,
+                    "url": target.immich.base_url,
+                    "server_failing": target.breaker.is_open,
+                    "network": {
+                        "favorable": target.monitor.verdict,
+                        "videos_favorable": target.monitor_for(VIDEO).verdict,
+                        "connected": target.monitor.state.connected,
+                        "metered": target.monitor.state.metered,
+                        "interface": target.monitor.state.interface,
+                        "ssid": target.monitor.state.ssid,
+                    },
+                }
+                for target in self.pool.targets
+            ],
+            "uploads": [
+                {
+                    "file": transfer.file_path,
+                    "target": target.name,
+                    "size": transfer.size,
+                    "sent": transfer.sent,
+                    "rate": transfer.rate,
+                }
+                for target in self.pool.targets
+                for transfer in target.immich.transfers.values()
+            ],
+            "pending": await self.db.count_unuploaded(),
+            "failed": failed,
+            "next_retry_at": next_retry_at,
+            "reconcile": {
+                "running": self.reconciler.current is not None,
+                "last": last_pass.as_dict() if last_pass else None,
+            },
+        }
+
+    async def pause(self, body: dict) -> dict:
+        self.pool.pause()
+        return {"paused": True}
+
+    async def resume(self, body: dict) -> dict:
+        self.pool.resume()
+        return {"paused": False}
+
+    async def upload(self, body: dict) -> dict:
+        file_name = body.get("path")
+        if not file_name or not os.path.isabs(file_name):
+            raise ValueError("The path must be absolute")
+
+        if not os.path.isfile(file_name):
+            raise ValueError(f"{file_name} is not a file")
+
+        # Added to the database first like any other file, known unchanged
+        # files are not hashed again
+        await (await self.hasher.submit(file_name))
+
+        uploaded = await self.db.is_uploaded(file_name)
+        if uploaded is None:
+            raise ValueError(f"Failed to add {file_name}, see the daemon log")
+
+        if uploaded:
+            return {"path": file_name, "status": "uploaded"}
+
+        # Failed uploads are tried again right away
+        logger.info(f"Uploading {file_name} on request")
+        await self.db.retry_now(file_name)
+        queued = self.pool.submit_now(file_name)
+        return {"path": file_name, "status": "queued" if queued else "uploading"}
+
+    async def reconcile(self, body: dict) -> dict:
+        self.reconciler.trigger("requested over the control socket")
+        return {"reconciling": True}
+
+    async def settings(self, body: dict) -> dict:
+        concurrency = body.get("concurrency")
+        if concurrency is not None:
+            self.pool.set_concurrency(int(concurrency))
+
+        bandwidth = body.get("bandwidth")
+        if bandwidth is not None:
+            self.bandwidth.set_rate(int(bandwidth))
+            logger.info(f"Upload bandwidth set to {format_rate(int(bandwidth))}")
+
+        return {
+            "concurrency": self.pool.concurrency,
+            "bandwidth": self.bandwidth.rate,
+        }
+
+
+async def request(
+    socket_path: str, method: str, route: str, payload: dict | None = None
+) -> dict:
+    """Send a command to the daemon listening on socket_path."""
+    connector = aiohttp.UnixConnector(path=socket_path)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async with session.request(
+            method, f"http://localhost{route}", json=payload
+        ) as response:
+            return await response.json()
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+
+    return f"{size:.1f} {unit}" if unit != "B" else f"{size:.0f} B"
+
+
+def format_rate(rate: float) -> str:
+    return f"{format_size(rate)}/s" if rate else "unlimited"
+
+
+def format_status(status: dict) -> str:
+    """Human readable form of the status returned by the daemon."""
+    lines = [
+        f"Uploads:     {'paused' if status['paused'] else 'running'}, "
+        f"{status['concurrency']} workers (max {status['max_concurrency']}), "
+        f"bandwidth {format_rate(status['bandwidth'])}, order {status['order']}",
+        f"Pending:     {status['pending']}",
+        f"Failed:      {status['failed']}",
+    ]
+
+    if status["next_retry_at"]:
+        next_retry = datetime.fromtimestamp(status["next_retry_at"])
+        lines.append(f"Next retry:  {next_retry.isoformat(' ', 'seconds')}")
+
+    reconcile = status["reconcile"]
+    last = reconcile["last"]
+    if reconcile["running"]:
+        lines.append("Reconciled:  running now")
+    elif last:
+        started = datetime.fromtimestamp(last["started_at"])
+        lines.append(
+            f"Reconciled:  {started.isoformat(' ', 'seconds')}, "
+            f"{last['files']} files, {last['added']} added, "
+            f"{last['changed']} changed, {last['removed']} removed"
+        )
+
+    lines.append("")
+    lines.append("Targets:")
+    for target in status["targets"]:
+        network = target["network"]
+        if not network["connected"]:
+            details = ["not connected"]
+        else:
+            details = [network["interface"] or "unknown interface"]
+            if network["ssid"]:
+                details.append(network["ssid"])
+            if network["metered"] is not None:
+                details.append("metered" if network["metered"] else "not metered")
+        if network["favorable"] and not network["videos_favorable"]:
+            details.append("videos deferred")
+        if target["server_failing"]:
+            details.append("server failing")
+
+        verdict = "favorable" if network["favorable"] else "unfavorable"
+        lines.append(
+            f"  {target['name']} ({target['url']}): {verdict}, {', '.join(details)}"
+        )
+
+    if status["uploads"]:
+        lines.append("")
+        lines.append("In flight:")
+        for upload in status["uploads"]:
+            percent = upload["sent"] / upload["size"] * 100 if upload["size"] else 100
+            lines.append(
+                f"  {upload['file']} to {upload['target']}: "
+                f"{format_size(upload['sent'])} of "
+                f"{format_size(upload['size'])} ({percent:.0f}%) at "
+                f"{format_size(upload['rate'])}/s"
+            )
+
+    return "\n".join(lines)
@@ -1,10 +1,17 @@
 import aiosqlite
+import asyncio
+import itertools
 import os
+import time
 
+from typing import AsyncIterator
 from loguru import logger
-from imohash import hashfile
 from xdg.BaseDirectory import save_data_path
 
+from . import metrics
+from .index import FileIndex, path_fingerprint
+from .schedule import VIDEO, UploadOrder, media_kind
+
 
 def get_db_path(db_name: str) -> str:
     """
@@ -15,32 +22,506 @@ def get_db_path(db_name: str) -> str:
     return os.path.join(app_data_dir, db_name)
 
 
+def _stat_columns(stats: os.stat_result) -> tuple[int, int, int, int]:
+    """Stat values stored to detect unchanged files without hashing them."""
+    return (stats.st_size, stats.st_mtime_ns, stats.st_ino, stats.st_dev)
+
+
+def _from_hex(value: str | None) -> bytes | None:
+    """Binary form of a hex digest stored by older versions, None if invalid."""
+    try:
+        return bytes.fromhex(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+# Upload target used when only one server is configured
+DEFAULT_TARGET = "default"
+
+# Shortest time between restarts of a pass over pending media for new files
+RESTART_INTERVAL = 1.0
+
+# Status of media and of its uploads to each target. Media is uploaded once
+# every upload is, a failed upload stays pending until it succeeds.
+PENDING = 0
+UPLOADED = 1
+FAILED = 2
+
+# Media is stored by directory and name, writes and lookups by path resolve
+# the directory in the same statement so they can be queued like any other
+AT_PATH = "directory_id = (SELECT id FROM directories WHERE path = ?) AND name = ?"
+MEDIA_AT_PATH = f"(SELECT id FROM media WHERE {AT_PATH})"
+DIRECTORY_ID = "(SELECT id FROM directories WHERE path = ?)"
+DIRECTORY_PATH = "(SELECT path FROM directories WHERE id = media.directory_id)"
+
+
 class Database:
-    def __init__(self, db_file: str) -> None:
+    """
+    Writes are queued and committed together in a single transaction once
+    batch_size writes are pending or flush_interval seconds have passed.
+    Reads that drive uploads flush first so they always see queued writes.
+    """
+
+    def __init__(
+        self,
+        db_file: str,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        synchronous: str = "NORMAL",
+        cache_size: int = -16000,
+        mmap_size: int = 0,
+        file_index: bool = True,
+        targets: list[str] | None = None,
+        order: UploadOrder | None = None,
+    ) -> None:
         self.db_file: str = db_file
         self.conn: aiosqlite.Connection | None = None
 
+        self.batch_size: int = max(1, batch_size)
+        self.flush_interval: float = flush_interval
+        self.synchronous: str = synchronous.upper()
+        self.cache_size: int = cache_size
+        self.mmap_size: int = mmap_size
+
+        # In-memory index answering lookups on the ingestion path, loaded by
+        # init_db when enabled and kept in sync with every write
+        self.use_file_index: bool = file_index
+        self.index: FileIndex | None = None
+
+        # Upload state is kept per target in the uploads table, media.status
+        # is only set to uploaded once the file is on every target
+        self.targets: list[str] = targets or [DEFAULT_TARGET]
+        self.target_ids: dict[str, int] = {}
+
+        # Directories known to be in the database, others are added ahead of
+        # the first media written to them
+        self.directories: set[str] = set()
+
+        # Order pending media is uploaded in, and the number of files added
+        # for upload so passes over pending media can start over for them
+        self.order: UploadOrder = order or UploadOrder()
+        self.added: int = 0
+
+        # Set while the first scan of an empty database, a new or reset one,
+        # adds media the servers may already have. Only that media is
+        # checksummed ahead of its upload to ask them, other media gets its
+        # checksum from the read that uploads it.
+        self.precheck: bool = False
+
+        # Writes waiting for the next flush, each with the future of the
+        # caller waiting on it if any
+        self.pending_writes: list[tuple[str, tuple, asyncio.Future | None]] = []
+
+        # Media whose upload state is changed by queued writes and by the
+        # writes being committed, so reading it only waits for a flush then
+        self.pending_paths: set[str] = set()
+        self.flushing_paths: set[str] = set()
+        self.flush_lock = asyncio.Lock()
+        self.flush_timer: asyncio.TimerHandle | None = None
+        self.flush_tasks: set[asyncio.Task] = set()
+
     async def init_db(self) -> None:
         try:
+            if self.synchronous not in SYNCHRONOUS_MODES:
+                raise ValueError(f"Invalid synchronous mode {self.synchronous}")
+
             self.conn = await aiosqlite.connect(self.db_file)
             await self.conn.execute("PRAGMA journal_mode=WAL")
+            await self.conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            await self.conn.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+            await self.conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
 
-            # Create the media table if it doesn't exist.
-            await self.conn.execute(
-                "CREATE TABLE IF NOT EXISTS media (file_name TEXT PRIMARY KEY, file_hash TEXT, uploaded INTEGER)"
-            )
+            # Replacing a media row has to fire its delete trigger so the
+            # upload state of the replaced row goes with it
+            await self.conn.execute("PRAGMA recursive_triggers=ON")
 
-            # Create an index on uploaded column for faster retrieval.
-            await self.conn.execute(
-                "CREATE INDEX IF NOT EXISTS idx_uploaded ON media (uploaded)"
-            )
+            await self._migrate()
+
+            async with self.conn.execute("SELECT 1 FROM media LIMIT 1") as cursor:
+                self.precheck = await cursor.fetchone() is None
 
+            await self._sync_targets()
+            await self._create_order_index()
             await self.conn.commit()
 
+            async with self.conn.execute("SELECT path FROM directories") as cursor:
+                self.directories = {row[0] for row in await cursor.fetchall()}
+
+            if self.use_file_index:
+                await self.load_index()
+
         except Exception as e:
             logger.error(f"Failed to initialize database: {e}")
             raise e
 
+    async def load_index(self) -> None:
+        """Load every known file into the in-memory index in one query."""
+        start = time.perf_counter()
+        await self.connection.create_function(
+            "path_fingerprint", 1, path_fingerprint, deterministic=True
+        )
+
+        # Sorted by SQLite and read in chunks so the index is filled without
+        # holding every row in memory. Paths are joined in SQL, which is
+        # cheaper than a second Python function per row.
+        index = FileIndex()
+        async with self.connection.execute(
+            f"SELECT path_fingerprint(rtrim(directories.path, '/') || '/' || media.name), file_hash, status = {UPLOADED}, size, mtime_ns, inode, device FROM media JOIN directories ON directories.id = media.directory_id ORDER BY 1"
+        ) as cursor:
+            while rows := await cursor.fetchmany(10000):
+                index.load(rows)
+
+        self.index = index
+        metrics.file_index_bytes.set(index.memory_usage())
+        logger.info(
+            f"Loaded {len(index)} known files into the index in "
+            f"{time.perf_counter() - start:.1f}s "
+            f"({index.memory_usage() / 1024 / 1024:.1f} MiB)"
+        )
+
+    async def _migrate(self) -> None:
+        """
+        Bring the schema to the latest version, recorded in the user_version
+        of the database. Each migration is committed on its own, so one that
+        fails is tried again on the next start.
+        """
+        migrations = [
+            self._migrate_legacy,
+            self._migrate_normalized,
+            self._migrate_spilled_files,
+            self._migrate_precheck,
+        ]
+
+        async with self.connection.execute("PRAGMA user_version") as cursor:
+            version = (await cursor.fetchone())[0]
+
+        if version > len(migrations):
+            raise RuntimeError(
+                f"Database version {version} is newer than the supported "
+                f"version {len(migrations)}"
+            )
+
+        for number, migration in enumerate(migrations[version:], version + 1):
+            logger.info(f"Migrating database to version {number}")
+            start = time.perf_counter()
+
+            # DDL is not part of the implicit transactions of sqlite3
+            await self.connection.execute("BEGIN")
+            try:
+                await migration()
+                await self.connection.execute(f"PRAGMA user_version = {number}")
+                await self.connection.commit()
+            except Exception:
+                await self.connection.rollback()
+                raise
+
+            logger.info(
+                f"Migrated database to version {number} in "
+                f"{time.perf_counter() - start:.1f}s"
+            )
+
+        # Give the pages of the replaced tables back to the file system
+        if version < len(migrations):
+            await self.connection.execute("VACUUM")
+
+    async def _migrate_legacy(self) -> None:
+        """
+        Version 1, the layout released before the schema was versioned: media
+        keyed by full path with an uploaded flag.
+        """
+        await self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS media (file_name TEXT PRIMARY KEY, file_hash TEXT, uploaded INTEGER)"
+        )
+        await self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_uploaded ON media (uploaded)"
+        )
+
+    async def _migrate_normalized(self) -> None:
+        """
+        Version 2: paths are split into a table of directories and a name, so
+        the long common prefixes are stored once, and rows get integer ids the
+        upload state refers to instead of the path. Hashes are stored as
+        binary and upload state as status codes per target, and only pending
+        rows are indexed. Rows keep their rowid as id so the discovery order
+        holds. Media uploaded before keeps its state for the first target.
+        """
+        conn = self.connection
+        await conn.create_function(
+            "path_dirname", 1, os.path.dirname, deterministic=True
+        )
+        await conn.create_function(
+            "path_basename", 1, os.path.basename, deterministic=True
+        )
+        await conn.create_function("from_hex", 1, _from_hex, deterministic=True)
+        await conn.create_function("media_kind", 1, media_kind, deterministic=True)
+
+        await conn.execute(
+            "CREATE TABLE directories (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE)"
+        )
+        await conn.execute(
+            "INSERT INTO directories (path) SELECT DISTINCT path_dirname(file_name) FROM media ORDER BY 1"
+        )
+
+        await conn.execute(
+            f"CREATE TABLE media_v2 (id INTEGER PRIMARY KEY, directory_id INTEGER NOT NULL REFERENCES directories (id), name TEXT NOT NULL, file_hash BLOB, checksum BLOB, status INTEGER NOT NULL DEFAULT {PENDING}, kind INTEGER NOT NULL DEFAULT 0, size INTEGER, mtime_ns INTEGER, inode INTEGER, device INTEGER, UNIQUE (directory_id, name))"
+        )
+        await conn.execute(
+            f"INSERT INTO media_v2 (id, directory_id, name, file_hash, status, kind) SELECT rowid, (SELECT id FROM directories WHERE path = path_dirname(file_name)), path_basename(file_name), from_hex(file_hash), CASE WHEN uploaded THEN {UPLOADED} ELSE {PENDING} END, media_kind(file_name) FROM media"
+        )
+        await conn.execute("DROP TABLE media")
+        await conn.execute("ALTER TABLE media_v2 RENAME TO media")
+
+        await conn.execute(
+            "CREATE TABLE targets (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)"
+        )
+        await conn.execute(
+            f"CREATE TABLE uploads (media_id INTEGER NOT NULL, target_id INTEGER NOT NULL, status INTEGER NOT NULL DEFAULT {PENDING}, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, next_attempt_at REAL NOT NULL DEFAULT 0, PRIMARY KEY (media_id, target_id)) WITHOUT ROWID"
+        )
+        async with conn.execute(
+            "INSERT INTO targets (name) VALUES (?)", (self.targets[0],)
+        ) as cursor:
+            first = cursor.lastrowid
+        await conn.execute(
+            "INSERT INTO uploads (media_id, target_id, status) SELECT id, ?, status FROM media",
+            (first,),
+        )
+
+        await conn.execute("CREATE INDEX idx_file_hash ON media (file_hash)")
+
+        # Pending media and uploads are a small part of a large library, so
+        # only they are indexed. Queries have to repeat the literal condition
+        # of a partial index, a bound parameter does not match it.
+        await conn.execute(
+            f"CREATE INDEX idx_media_pending ON media (status) WHERE status = {PENDING}"
+        )
+        await conn.execute(
+            f"CREATE INDEX idx_uploads_pending ON uploads (next_attempt_at) WHERE status != {UPLOADED}"
+        )
+
+        # Upload state is kept in step with media by triggers so the batched
+        # media writes stay a single statement each. New or changed media
+        # starts over on every target, a REPLACE of the media row also
+        # replaces its upload state.
+        await conn.execute(
+            """CREATE TRIGGER media_insert AFTER INSERT ON media BEGIN
+                INSERT OR REPLACE INTO uploads (media_id, target_id, status)
+                SELECT NEW.id, id, NEW.status FROM targets;
+            END"""
+        )
+        await conn.execute(
+            """CREATE TRIGGER media_delete AFTER DELETE ON media BEGIN
+                DELETE FROM uploads WHERE media_id = OLD.id;
+            END"""
+        )
+        # Media is uploaded once it is uploaded to every target
+        await conn.execute(
+            f"""CREATE TRIGGER uploads_done AFTER UPDATE OF status ON uploads WHEN NEW.status = {UPLOADED} BEGIN
+                UPDATE media SET status = {UPLOADED} WHERE id = NEW.media_id AND NOT EXISTS (SELECT 1 FROM uploads WHERE media_id = NEW.media_id AND status != {UPLOADED});
+            END"""
+        )
+
+    async def _migrate_spilled_files(self) -> None:
+        """
+        Version 3: files the watcher had no room for while events arrived
+        faster than they were hashed, checked once the backlog goes down.
+        """
+        await self.connection.execute(
+            "CREATE TABLE spilled_files (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, moved_from TEXT)"
+        )
+
+    async def _migrate_precheck(self) -> None:
+        """
+        Version 4: media to check against the servers before uploading it.
+        Media pending without a checksum was due for the check before.
+        """
+        await self.connection.execute(
+            "ALTER TABLE media ADD COLUMN precheck INTEGER NOT NULL DEFAULT 0"
+        )
+        await self.connection.execute(
+            f"UPDATE media SET precheck = 1 WHERE status = {PENDING} AND checksum IS NULL"
+        )
+
+    async def _sync_targets(self) -> None:
+        """
+        Add upload state for newly configured targets and drop it for removed
+        ones.
+        """
+        async with self.connection.execute("SELECT name, id FROM targets") as cursor:
+            known = dict(await cursor.fetchall())
+
+        changed = False
+        for target in self.targets:
+            if target not in known:
+                logger.info(f"Adding upload target {target}, every file is pending")
+                async with self.connection.execute(
+                    "INSERT INTO targets (name) VALUES (?)", (target,)
+                ) as cursor:
+                    known[target] = cursor.lastrowid
+                await self.connection.execute(
+                    "INSERT INTO uploads (media_id, target_id) SELECT id, ? FROM media",
+                    (known[target],),
+                )
+                changed = True
+
+        for target, target_id in list(known.items()):
+            if target not in self.targets:
+                logger.info(f"Removing upload target {target}")
+                await self.connection.execute(
+                    "DELETE FROM uploads WHERE target_id = ?", (target_id,)
+                )
+                await self.connection.execute(
+                    "DELETE FROM targets WHERE id = ?", (target_id,)
+                )
+                del known[target]
+                changed = True
+
+        if changed:
+            await self.connection.execute(
+                f"UPDATE media SET status = CASE WHEN EXISTS (SELECT 1 FROM uploads WHERE uploads.media_id = media.id AND uploads.status != {UPLOADED}) THEN {PENDING} ELSE {UPLOADED} END"
+            )
+
+        self.target_ids = known
+
+    async def _create_order_index(self) -> None:
+        """
+        Create the partial index over pending media the upload order needs and
+        drop those of orders no longer used.
+        """
+        index_name = self.order.index_name
+        async with self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name GLOB 'idx_order_*'"
+        ) as cursor:
+            stale = [row[0] for row in await cursor.fetchall() if row[0] != index_name]
+
+        for name in stale:
+            logger.info(f"Dropping index {name} of a previous upload order")
+            await self.connection.execute(f"DROP INDEX {name}")
+
+        if index_name:
+            await self.connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {index_name} ON media ({self.order.key}) WHERE status = {PENDING}"
+            )
+
+    def _write(
+        self,
+        sql: str,
+        params: tuple,
+        wait: bool = False,
+        paths: tuple[str, ...] = (),
+    ) -> asyncio.Future | None:
+        """
+        Queue a write for the next batch. When wait is set, the returned future
+        resolves once the batch containing the write has been committed.
+        Paths are the media whose upload state the write changes.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future() if wait else None
+        self.pending_writes.append((sql, params, future))
+        self.pending_paths.update(paths)
+
+        if len(self.pending_writes) >= self.batch_size:
+            self._start_flush()
+        elif self.flush_timer is None:
+            self.flush_timer = loop.call_later(self.flush_interval, self._start_flush)
+
+        return future
+
+    def _add_directory(self, directory: str) -> None:
+        """Queue adding a directory ahead of the first media written to it."""
+        if directory not in self.directories:
+            self._write(
+                "INSERT OR IGNORE INTO directories (path) VALUES (?)", (directory,)
+            )
+            self.directories.add(directory)
+
+    def _start_flush(self) -> None:
+        task = asyncio.create_task(self.flush())
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush(self) -> None:
+        """
+        Commit all queued writes in a single transaction. When it fails they
+        are committed one at a time, so only the writes that fail themselves
+        are lost, and their errors are raised to the callers waiting on them.
+        """
+        # Shielded so a caller cancelled on shutdown does not drop the writes
+        # already taken from the queue, and the callers waiting on them
+        await asyncio.shield(self._flush())
+
+    async def _flush(self) -> None:
+        async with self.flush_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            writes, self.pending_writes = self.pending_writes, []
+            self.flushing_paths, self.pending_paths = self.pending_paths, set()
+            if not writes:
+                return
+
+            errors = {}
+            try:
+                # Consecutive writes of the same statement go through executemany
+                with metrics.db_commit_seconds.time():
+                    for sql, group in itertools.groupby(writes, key=lambda w: w[0]):
+                        await self.connection.executemany(
+                            sql, [params for _, params, _ in group]
+                        )
+                    await self.connection.commit()
+                logger.debug(f"Committed {len(writes)} database writes")
+
+            except Exception as e:
+                logger.error(f"Error writing {len(writes)} changes to database: {e}")
+                logger.warning(
+                    "Rolling back database, writing the changes one at a time"
+                )
+                await self.connection.rollback()
+                errors = await self._write_each(writes)
+
+            if errors:
+                metrics.db_write_errors.inc(len(errors))
+
+                # The index already holds the lost changes
+                if self.index is not None:
+                    logger.warning("Dropping the file index, using database lookups")
+                    self.index = None
+
+                # Directories may be among them, they are added again with
+                # the next media written to them
+                self.directories.clear()
+
+            for position, (_, _, future) in enumerate(writes):
+                if future is None or future.done():
+                    continue
+                if position in errors:
+                    future.set_exception(errors[position])
+                else:
+                    future.set_result(None)
+
+            self.flushing_paths = set()
+
+    async def _write_each(
+        self, writes: list[tuple[str, tuple, asyncio.Future | None]]
+    ) -> dict[int, Exception]:
+        """
+        Commit writes one at a time after their batch failed, returning the
+        errors of those that failed by their position in writes.
+        """
+        errors = {}
+        for position, (sql, params, _) in enumerate(writes):
+            try:
+                await self.connection.execute(sql, params)
+                await self.connection.commit()
+            except Exception as e:
+                logger.error(f"Dropping database write {sql} {params}: {e}")
+                await self.connection.rollback()
+                errors[position] = e
+
+        return errors
+
     @property
     def connection(self) -> aiosqlite.Connection:
         if self.conn is None:
@@ -50,82 +531,584 @@ class Database:
 
         return self.conn
 
-    async def add_media(self, file_name: str) -> bool:
-        """Insert or update the media in the database and reset the uploaded flag."""
+    async def _stat_of(self, file_name: str) -> tuple | None:
+        """Stored size, mtime, inode and device of media, None if unknown."""
+        async with self.connection.execute(
+            f"SELECT size, mtime_ns, inode, device FROM media WHERE {AT_PATH}",
+            os.path.split(file_name),
+        ) as cursor:
+            return await cursor.fetchone()
+
+    async def needs_hash(self, file_name: str, stats: os.stat_result) -> bool:
+        """Check if the media is new or its stat changed since it was last seen."""
         try:
+            if self.index is not None:
+                unchanged = self.index.is_unchanged(file_name, _stat_columns(stats))
+            else:
+                unchanged = await self._stat_of(file_name) == _stat_columns(stats)
+
+            # Unchanged since it was last seen, no need to hash it again
+            if unchanged:
+                logger.debug(f"Media {file_name} unchanged since last scan")
+                return False
+
+            return True
+
+        except Exception as e:
+            logger.error(f"Error checking media {file_name}: {e}")
+            return True
+
+    async def add_media(
+        self,
+        file_name: str,
+        file_hash: bytes,
+        stats: os.stat_result,
+        checksum: bytes | None = None,
+    ) -> bool:
+        """
+        Insert or update the media in the database and reset its status. A
+        copy of uploaded media is recorded as uploaded only when checksum, its
+        full SHA-1, matches the uploaded one, the sampled file_hash alone can
+        be the same for different content.
+        """
+        try:
+            file_stat = _stat_columns(stats)
+            directory, name = os.path.split(file_name)
+
             # Check if file_name and file_hash already exist in the database.
-            file_hash = hashfile(file_name, hexdigest=True)
-            async with self.connection.execute(
-                "SELECT * FROM media WHERE file_name = ? AND file_hash = ?",
-                (file_name, file_hash),
-            ) as cursor:
-                row = await cursor.fetchone()
+            if self.index is not None:
+                exists = self.index.has_hash(file_name, file_hash)
+            else:
+                async with self.connection.execute(
+                    f"SELECT 1 FROM media WHERE {AT_PATH} AND file_hash = ?",
+                    (directory, name, file_hash),
+                ) as cursor:
+                    exists = await cursor.fetchone() is not None
 
-            if row:
-                # If the file_name and file_hash already exists, do nothing
+            if exists:
+                # Same content, only refresh the stored stat information
                 logger.info(f"Media {file_name} already exists in the database")
+                self._write(
+                    f"UPDATE media SET size = ?, mtime_ns = ?, inode = ?, device = ? WHERE {AT_PATH}",
+                    (*file_stat, directory, name),
+                )
+                if self.index is not None:
+                    self.index.set_stat(file_name, file_stat)
+                return False
+
+            # A copy of content that is already on the server needs no upload
+            self._add_directory(directory)
+            uploaded = await self.find_uploaded(file_hash)
+            if uploaded is not None and (checksum is None or uploaded[1] != checksum):
+                logger.info(
+                    f"Media {file_name} has the same sampled hash as "
+                    f"{uploaded[0]} but its checksum "
+                    f"{'differs' if checksum else 'is not known'}, uploading it"
+                )
+            elif uploaded is not None:
+                original = uploaded[0]
+                logger.info(
+                    f"Media {file_name} has the same content as {original}, "
+                    "already uploaded"
+                )
+                self._write(
+                    f"INSERT OR REPLACE INTO media (directory_id, name, file_hash, status, size, mtime_ns, inode, device, kind, checksum) VALUES ({DIRECTORY_ID}, ?, ?, {UPLOADED}, ?, ?, ?, ?, ?, ?)",
+                    (
+                        directory,
+                        name,
+                        file_hash,
+                        *file_stat,
+                        media_kind(file_name),
+                        checksum,
+                    ),
+                    paths=(file_name,),
+                )
+                if self.index is not None:
+                    self.index.add(file_name, file_hash, file_stat, uploaded=True)
+                metrics.deduplicated_files.inc()
                 return False
 
             logger.info(f"Adding media {file_name}")
-            await self.connection.execute(
-                "INSERT OR REPLACE INTO media (file_name, file_hash, uploaded) VALUES (?, ?, 0)",
-                (file_name, file_hash),
+            self._write(
+                f"INSERT OR REPLACE INTO media (directory_id, name, file_hash, status, size, mtime_ns, inode, device, kind, checksum, precheck) VALUES ({DIRECTORY_ID}, ?, ?, {PENDING}, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    directory,
+                    name,
+                    file_hash,
+                    *file_stat,
+                    media_kind(file_name),
+                    checksum,
+                    int(self.precheck and checksum is None),
+                ),
+                paths=(file_name,),
             )
-            await self.connection.commit()
+            if self.index is not None:
+                self.index.add(file_name, file_hash, file_stat)
+            self.added += 1
             return True
 
         except Exception as e:
             logger.error(f"Error adding media {file_name}: {e}")
             return False
 
-    async def remove_media(self, file_name: str) -> bool:
-        """Remove media in the database"""
+    async def find_uploaded(self, file_hash: bytes) -> tuple[str, bytes | None] | None:
+        """Return the file name and checksum of uploaded media with this hash."""
+        # Most content is new, which the index can tell without a query
+        if self.index is not None and not self.index.may_contain(file_hash):
+            return None
+
         try:
-            logger.info(f"Removing {file_name} from database")
-            if not file_name:
-                logger.warning(f"File name {file_name} not valid, skipping")
-                return False
+            async with self.connection.execute(
+                f"SELECT {DIRECTORY_PATH}, name, checksum FROM media WHERE file_hash = ? AND status = {UPLOADED} LIMIT 1",
+                (file_hash,),
+            ) as cursor:
+                row = await cursor.fetchone()
+                return (os.path.join(row[0], row[1]), row[2]) if row else None
 
-            cursor = await self.connection.cursor()
-            await cursor.execute("DELETE FROM media WHERE file_name = ?", (file_name,))
+        except Exception as e:
+            logger.error(f"Error finding media with hash {file_hash.hex()}: {e}")
+            return None
 
-            await self.connection.commit()
+    async def rename_media(
+        self, old_name: str, new_name: str, stats: os.stat_result
+    ) -> bool:
+        """
+        Move the row of renamed media to its new path, keeping its hash and
+        upload state. Returns False when the old path is not known with the
+        same size, mtime, inode and device, in which case it has to be hashed.
+        """
+        try:
+            file_stat = _stat_columns(stats)
+            if self.index is not None:
+                known = self.index.is_unchanged(old_name, file_stat)
+            else:
+                known = await self._stat_of(old_name) == file_stat
+
+            if not known:
+                return False
+
+            logger.info(f"Renaming media {old_name} to {new_name}")
+            directory, name = os.path.split(new_name)
+            self._add_directory(directory)
+            self._write(
+                f"UPDATE OR REPLACE media SET directory_id = {DIRECTORY_ID}, name = ?, kind = ? WHERE {AT_PATH}",
+                (directory, name, media_kind(new_name), *os.path.split(old_name)),
+                paths=(old_name, new_name),
+            )
+            if self.index is not None:
+                self.index.rename(old_name, new_name, file_stat)
+            return True
 
         except Exception as e:
-            logger.error(f"Error removing media {file_name}: {e}")
-            logger.error("Rolling back database")
+            logger.error(f"Error renaming media {old_name}: {e}")
+            return False
 
-            await self.connection.rollback()
+    async def remove_media(self, file_name: str) -> bool:
+        """Remove media in the database"""
+        logger.info(f"Removing {file_name} from database")
+        if not file_name:
+            logger.warning(f"File name {file_name} not valid, skipping")
             return False
 
-    async def mark_uploaded(self, file_name: str) -> None:
+        self._write(
+            f"DELETE FROM media WHERE {AT_PATH}",
+            os.path.split(file_name),
+            paths=(file_name,),
+        )
+        if self.index is not None:
+            self.index.remove(file_name)
+        return True
+
+    async def diff_directory(
+        self, directory: str, files: list[tuple[str, os.stat_result]]
+    ) -> tuple[
+        list[tuple[str, os.stat_result]], list[tuple[str, os.stat_result]], list[str]
+    ]:
+        """
+        Compare the media files found in a directory with its rows by size,
+        mtime, inode and device. Returns the files that are new, the files
+        that changed and the paths of rows whose file is gone.
+        """
+        await self.flush()
+        async with self.connection.execute(
+            f"SELECT name, size, mtime_ns, inode, device FROM media WHERE directory_id = {DIRECTORY_ID}",
+            (directory,),
+        ) as cursor:
+            known = {row[0]: row[1:] for row in await cursor.fetchall()}
+
+        added, changed = [], []
+        for file_name, stats in files:
+            file_stat = known.pop(os.path.basename(file_name), None)
+            if file_stat is None:
+                added.append((file_name, stats))
+            elif file_stat != _stat_columns(stats):
+                changed.append((file_name, stats))
+
+        return added, changed, [os.path.join(directory, name) for name in known]
+
+    async def devices_of(self, directory: str) -> set[int]:
+        """Return the devices the media in a directory was last seen on."""
+        async with self.connection.execute(
+            f"SELECT DISTINCT device FROM media WHERE directory_id = {DIRECTORY_ID} AND device IS NOT NULL",
+            (directory,),
+        ) as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+
+    async def directories_under(self, root: str) -> list[str]:
+        """Return the directories with media at or below root."""
+        prefix = os.path.join(root, "")
+        async with self.connection.execute(
+            "SELECT path FROM directories WHERE path = ? OR substr(path, 1, ?) = ?",
+            (root, len(prefix), prefix),
+        ) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def remove_empty_directories(self, root: str) -> int:
+        """Remove the directories at or below root that no media is in anymore."""
+        await self.flush()
+        prefix = os.path.join(root, "")
+        async with self.connection.execute(
+            "SELECT path FROM directories WHERE (path = ? OR substr(path, 1, ?) = ?) AND NOT EXISTS (SELECT 1 FROM media WHERE directory_id = directories.id)",
+            (root, len(prefix), prefix),
+        ) as cursor:
+            empty = [row[0] for row in await cursor.fetchall()]
+
+        # Media added to them since is kept, along with its directory
+        for directory in empty:
+            self._write(
+                "DELETE FROM directories WHERE path = ? AND NOT EXISTS (SELECT 1 FROM media WHERE directory_id = directories.id)",
+                (directory,),
+            )
+            self.directories.discard(directory)
+        return len(empty)
+
+    def spill_file(self, file_name: str, moved_from: str | None = None) -> None:
+        """
+        Record a file to check later, along with its previous path if it was
+        renamed. Does not wait for the write.
+        """
+        self._write(
+            "INSERT OR REPLACE INTO spilled_files (path, moved_from) VALUES (?, ?)",
+            (file_name, moved_from),
+        )
+
+    async def get_spilled(self, limit: int) -> list[tuple[int, str, str | None]]:
+        """Return up to limit of the oldest spilled files as (id, path, moved_from)."""
+        await self.flush()
+        async with self.connection.execute(
+            "SELECT id, path, moved_from FROM spilled_files ORDER BY id LIMIT ?",
+            (limit,),
+        ) as cursor:
+            return await cursor.fetchall()
+
+    def remove_spilled(self, spill_ids: list[int]) -> None:
+        # By id, a file spilled again in the meantime has a new one and stays
+        for spill_id in spill_ids:
+            self._write("DELETE FROM spilled_files WHERE id = ?", (spill_id,))
+
+    async def mark_uploaded(self, file_name: str, target: str) -> bool:
+        """
+        Mark media as uploaded to a target, returning once the change is
+        committed.
+        """
         try:
-            logger.info(f"Marking {file_name} as uploaded")
+            logger.info(f"Marking {file_name} as uploaded to {target}")
 
-            await self.connection.execute(
-                "UPDATE media SET uploaded = 1 WHERE file_name = ?", (file_name,)
+            future = self._write(
+                f"UPDATE uploads SET status = {UPLOADED} WHERE media_id = {MEDIA_AT_PATH} AND target_id = ?",
+                (*os.path.split(file_name), self.target_ids[target]),
+                wait=True,
+                paths=(file_name,),
             )
-            await self.connection.commit()
+            await future
+
+            # Only uploaded as a whole once every target has it
+            if self.index is not None and (
+                len(self.targets) == 1 or await self.is_uploaded(file_name)
+            ):
+                self.index.set_uploaded(file_name)
+            return True
 
         except Exception as e:
             logger.error(f"Error marking {file_name} as uploaded: {e}")
-            return
+            return False
+
+    def _pending_filter(
+        self, targets: list[str] | None, video_targets: list[str] | None
+    ) -> tuple[str, tuple]:
+        """
+        Condition on the uploads rows of media pending on one of targets, by
+        default any, and for videos on one of video_targets, by default the
+        same.
+        """
+        targets = self.targets if targets is None else targets
+        video_targets = targets if video_targets is None else video_targets
+
+        target_ids = tuple(self.target_ids[t] for t in targets)
+        sql = (
+            f"uploads.status != {UPLOADED} "
+            f"AND uploads.target_id IN ({', '.join('?' * len(target_ids))})"
+        )
+        params = target_ids
+        if video_targets != targets:
+            video_ids = tuple(self.target_ids[t] for t in video_targets)
+            sql += (
+                f" AND (media.kind != {VIDEO} OR uploads.target_id IN "
+                f"({', '.join('?' * len(video_ids))}))"
+            )
+            params += video_ids
+
+        return sql, params
+
+    async def iter_unuploaded(
+        self,
+        page_size: int = 500,
+        targets: list[str] | None = None,
+        video_targets: list[str] | None = None,
+    ) -> AsyncIterator[tuple[str, tuple[int, int]]]:
+        """
+        Yield pending media and its priority in upload order, lowest first,
+        one page at a time. Each page continues after the sort key of the last
+        one through the order's index, so rows handled earlier in the pass are
+        not read again and finding the next page does not slow down with the
+        size of the backlog.
+
+        When media is added during the pass it starts over from the top, at
+        most every RESTART_INTERVAL seconds, so a new file that sorts first is
+        yielded next instead of after the rest of the backlog.
+
+        Only media with an upload due to one of targets, by default any, is
+        returned, videos only when due to one of video_targets. Failed uploads
+        are skipped until their next attempt is due.
+        """
+        key = self.order.key
+        pending, pending_params = self._pending_filter(targets, video_targets)
+
+        # Without statistics SQLite may sort every pending row, the order's
+        # index must be used to stay fast
+        media = "media INDEXED BY idx_media_pending"
+        if self.order.index_name:
+            media = f"media INDEXED BY {self.order.index_name}"
+
+        last = None
+        while True:
+            added = self.added
+            queried_at = time.monotonic()
+            after, after_params = "", ()
+            if last is not None:
+                after = f"AND {key} >= ? AND ({key} > ? OR rowid > ?)"
+                after_params = (last[0], last[0], last[1])
 
-    async def get_unuploaded(self) -> list[str]:
+            try:
+                await self.flush()
+                async with self.connection.execute(
+                    f"SELECT {key}, rowid, {DIRECTORY_PATH}, name FROM {media} WHERE status = {PENDING} {after} AND EXISTS (SELECT 1 FROM uploads WHERE uploads.media_id = media.id AND uploads.next_attempt_at <= ? AND {pending}) ORDER BY {key}, rowid LIMIT ?",
+                    (*after_params, time.time(), *pending_params, page_size),
+                ) as cursor:
+                    rows = await cursor.fetchall()
+
+            except Exception as e:
+                logger.error(f"Error retrieving unuploaded media: {e}")
+                return
+
+            if not rows:
+                return
+
+            last = rows[-1][:2]
+            for sort_key, rowid, directory, name in rows:
+                yield os.path.join(directory, name), (sort_key, rowid)
+
+                if (
+                    self.added != added
+                    and time.monotonic() - queried_at >= RESTART_INTERVAL
+                ):
+                    logger.debug("New media added, restarting from the top")
+                    last = None
+                    break
+
+    async def has_unuploaded(self) -> bool:
         try:
+            await self.flush()
             async with self.connection.execute(
-                "SELECT file_name FROM media WHERE uploaded = 0"
+                f"SELECT 1 FROM media WHERE status = {PENDING} LIMIT 1"
+            ) as cursor:
+                return await cursor.fetchone() is not None
+
+        except Exception as e:
+            logger.error(f"Error retrieving unuploaded media: {e}")
+            return False
+
+    async def count_unuploaded(self) -> int:
+        try:
+            await self.flush()
+            async with self.connection.execute(
+                f"SELECT COUNT(*) FROM media WHERE status = {PENDING}"
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else 0
+
+        except Exception as e:
+            logger.error(f"Error counting unuploaded media: {e}")
+            return 0
+
+    async def next_attempt_time(
+        self,
+        targets: list[str] | None = None,
+        video_targets: list[str] | None = None,
+    ) -> float | None:
+        """
+        Return when the next pending upload to one of targets, by default any,
+        is due, for videos to one of video_targets. None if nothing is pending.
+        """
+        pending, pending_params = self._pending_filter(targets, video_targets)
+        try:
+            await self.flush()
+            async with self.connection.execute(
+                f"SELECT MIN(uploads.next_attempt_at) FROM uploads JOIN media ON media.id = uploads.media_id WHERE {pending}",
+                pending_params,
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else None
+
+        except Exception as e:
+            logger.error(f"Error retrieving next attempt time: {e}")
+            return None
+
+    async def failed_summary(self) -> tuple[int, float | None]:
+        """Return the number of failed pending uploads and when the next is retried."""
+        try:
+            await self.flush()
+            # The first condition lets SQLite use the index of pending uploads
+            async with self.connection.execute(
+                f"SELECT COUNT(*), MIN(next_attempt_at) FROM uploads WHERE status != {UPLOADED} AND status = {FAILED}"
+            ) as cursor:
+                row = await cursor.fetchone()
+                return (row[0], row[1]) if row else (0, None)
+
+        except Exception as e:
+            logger.error(f"Error counting failed media: {e}")
+            return 0, None
+
+    async def is_uploaded(self, file_name: str) -> bool | None:
+        """Whether media has been uploaded, None if it is not in the database."""
+        try:
+            await self.flush()
+            async with self.connection.execute(
+                f"SELECT status FROM media WHERE {AT_PATH}", os.path.split(file_name)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row[0] == UPLOADED if row else None
+
+        except Exception as e:
+            logger.error(f"Error retrieving {file_name}: {e}")
+            return None
+
+    async def pending_targets(self, file_name: str) -> list[str]:
+        """Return the targets media is due to be uploaded to."""
+        try:
+            # Other queued writes are left to their batch
+            if file_name in self.pending_paths or file_name in self.flushing_paths:
+                await self.flush()
+            async with self.connection.execute(
+                f"SELECT targets.name FROM uploads JOIN targets ON targets.id = uploads.target_id WHERE uploads.media_id = {MEDIA_AT_PATH} AND uploads.status != {UPLOADED} AND uploads.next_attempt_at <= ?",
+                (*os.path.split(file_name), time.time()),
+            ) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+        except Exception as e:
+            logger.error(f"Error retrieving upload targets of {file_name}: {e}")
+            return []
+
+    async def retry_now(self, file_name: str) -> None:
+        """Make the pending uploads of media due now, even after failures."""
+        self._write(
+            f"UPDATE uploads SET next_attempt_at = 0 WHERE media_id = {MEDIA_AT_PATH} AND status != {UPLOADED}",
+            os.path.split(file_name),
+            paths=(file_name,),
+        )
+
+    async def get_attempts(self, file_name: str, target: str) -> int:
+        try:
+            async with self.connection.execute(
+                f"SELECT attempts FROM uploads WHERE media_id = {MEDIA_AT_PATH} AND target_id = ?",
+                (*os.path.split(file_name), self.target_ids[target]),
+            ) as cursor:
+                row = await cursor.fetchone()
+                return (row[0] or 0) if row else 0
+
+        except Exception as e:
+            logger.error(f"Error retrieving attempts for {file_name}: {e}")
+            return 0
+
+    async def mark_failed(
+        self,
+        file_name: str,
+        target: str,
+        error: str,
+        attempts: int,
+        next_attempt_at: float,
+    ) -> None:
+        """Record a failed upload and when it may be attempted again."""
+        self._write(
+            f"UPDATE uploads SET status = {FAILED}, attempts = ?, last_error = ?, next_attempt_at = ? WHERE media_id = {MEDIA_AT_PATH} AND target_id = ?",
+            (
+                attempts,
+                error,
+                next_attempt_at,
+                *os.path.split(file_name),
+                self.target_ids[target],
+            ),
+            paths=(file_name,),
+        )
+
+    async def get_unchecked(self, limit: int) -> list[str]:
+        """
+        Return pending media added by the first scan of an empty database
+        that has not been checked against the server yet.
+        """
+        try:
+            await self.flush()
+            async with self.connection.execute(
+                f"SELECT {DIRECTORY_PATH}, name FROM media WHERE status = {PENDING} AND checksum IS NULL AND precheck = 1 LIMIT ?",
+                (limit,),
             ) as cursor:
                 rows = await cursor.fetchall()
 
-                if rows:
-                    return [row[0] for row in rows]
-                return []
+                return [os.path.join(directory, name) for directory, name in rows]
 
         except Exception as e:
-            logger.error(f"Error retrieving unuploaded media: {e}")
+            logger.error(f"Error retrieving unchecked media: {e}")
             return []
 
+    def skip_precheck(self, file_name: str) -> None:
+        """Leave media to its upload instead of checking it with the servers."""
+        self._write(
+            f"UPDATE media SET precheck = 0 WHERE {AT_PATH}", os.path.split(file_name)
+        )
+
+    async def get_checksum(self, file_name: str) -> bytes | None:
+        """Return the SHA-1 checksum of media, None if it is not known yet."""
+        async with self.connection.execute(
+            f"SELECT checksum FROM media WHERE {AT_PATH}", os.path.split(file_name)
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        return row[0] if row else None
+
+    async def set_checksum(
+        self, file_name: str, checksum: bytes, stats: os.stat_result
+    ) -> None:
+        """
+        Store the SHA-1 checksum of media computed from the file as it was
+        when stats were taken, unless the row is of a later version of it.
+        """
+        self._write(
+            f"UPDATE media SET checksum = ? WHERE {AT_PATH} AND size = ? AND mtime_ns = ?",
+            (checksum, *os.path.split(file_name), stats.st_size, stats.st_mtime_ns),
+        )
+
     async def close(self) -> None:
         if self.conn:
+            # Make sure everything queued is on disk before closing
+            await self.flush()
             await self.conn.close()
@@ -1,11 +1,16 @@
 import asyncio
 import os
+import time
+from typing import Callable
 
 import aiofiles
 from loguru import logger
 from watchdog.events import FileSystemEventHandler
 
+from . import metrics
 from .database import Database
+from .hasher import Hasher
+from .schedule import VIDEO_EXTENSIONS
 
 # Source: https://github.com/immich-app/immich/blob/main/docs/docs/features/supported-formats.md?plain=1
 SUPPORTED_MEDIA_EXTENSIONS = (
@@ -27,82 +32,407 @@ SUPPORTED_MEDIA_EXTENSIONS = (
     ".svg",
     ".tif",
     ".tiff",
-    # Video extensions
-    ".3gp",
-    ".3gpp",
-    ".avi",
-    ".flv",
-    ".m4v",
-    ".mkv",
-    ".mts",
-    ".m2ts",
-    ".m2t",
-    ".mp4",
-    ".insv",
-    ".mpg",
-    ".mpe",
-    ".mpeg",
-    ".mov",
-    ".webm",
-    ".wmv",
+    *VIDEO_EXTENSIONS,
 )
 
 
-class MediaFileHandler(FileSystemEventHandler):
+# Spilled files fed back in at a time when the queue is unbounded, and the
+# wait for room before trying again
+DRAIN_BATCH_SIZE = 500
+DRAIN_INTERVAL = 0.1
+
+
+def is_media_file(path: str) -> bool:
+    return path.lower().endswith(SUPPORTED_MEDIA_EXTENSIONS)
+
+
+class EventCoalescer:
     """
-    Watchdog event handler that looks for newly created media files.
-    Only files with common media extensions are enqueued.
+    Collects watcher events per path and only emits a file once it is done
+    being written, either because a close-write or move event arrived for it
+    or because its size and mtime stayed the same for the quiet period.
+    Each burst of events for a path results in a single emitted file.
+    Files are emitted as (path, moved_from) with the previous path of renamed
+    files so they can be renamed in the database instead of added again.
+
+    Paths waiting to settle and files in the queue are each limited to the
+    size of the queue. Files beyond that are spilled to the database and fed
+    back in by drain() once half of the room is free, so a large import
+    copied into a watched directory does not grow memory without bound.
+    on_caught_up is called once the last spilled file was fed back in.
     """
 
-    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop) -> None:
+    def __init__(
+        self,
+        queue: asyncio.Queue,
+        quiet_period: float,
+        db: Database,
+        on_caught_up: Callable[[], None] | None = None,
+    ) -> None:
         self.queue = queue
+        self.quiet_period = quiet_period
+        self.db = db
+        self.limit: int = queue.maxsize
+        self.on_caught_up = on_caught_up
+
+        # Path to the (size, mtime_ns) seen on the last check, None until checked
+        self.pending: dict[str, tuple[int, int] | None] = {}
+        self.wake = asyncio.Event()
+
+        # Set while spilled files may be waiting, including from the last run
+        self.spilled = asyncio.Event()
+        self.spilled.set()
+        self.spilling = False
+
+    def notify(
+        self, path: str, complete: bool = False, moved_from: str | None = None
+    ) -> None:
+        """Record an event for a path, must be called from the event loop."""
+        if moved_from is not None:
+            # Events still pending for the old name are replaced by the rename
+            self.pending.pop(moved_from, None)
+
+        if complete:
+            # The writer is done with the file, no need to wait any longer
+            self.pending.pop(path, None)
+            self._emit(path, moved_from)
+            return
+
+        if path not in self.pending and self.limit and len(self.pending) >= self.limit:
+            self._spill(path, None)
+            return
+
+        self.pending.setdefault(path, None)
+        self.wake.set()
+
+    def _emit(self, path: str, moved_from: str | None) -> None:
+        try:
+            self.queue.put_nowait((path, moved_from))
+        except asyncio.QueueFull:
+            self._spill(path, moved_from)
+            return
+
+        depth = self.queue.qsize()
+        metrics.watcher_queue_depth.set(depth)
+        if depth > metrics.watcher_queue_high_water.value:
+            metrics.watcher_queue_high_water.set(depth)
+
+    def _spill(self, path: str, moved_from: str | None) -> None:
+        if not self.spilling:
+            logger.warning(
+                "Watcher queue is full, recording new files in the database "
+                "until it has room again"
+            )
+            self.spilling = True
+
+        self.db.spill_file(path, moved_from)
+        metrics.spilled_files.inc()
+        self.spilled.set()
+
+    async def drain(self) -> None:
+        """Feed spilled files back in as the backlog goes down."""
+        while True:
+            await self.spilled.wait()
+
+            # Only half of the room is used, so drained files do not fill it
+            # right back up and spill the next events again
+            capacity = self.limit // 2 if self.limit else DRAIN_BATCH_SIZE
+            room = capacity - max(len(self.pending), self.queue.qsize())
+            if room <= 0:
+                await asyncio.sleep(DRAIN_INTERVAL)
+                continue
+
+            self.spilled.clear()
+            rows = await self.db.get_spilled(room)
+            if not rows:
+                if self.spilling:
+                    logger.info("Watcher caught up with the spilled files")
+                    self.spilling = False
+                    if self.on_caught_up is not None:
+                        self.on_caught_up()
+                continue
+
+            logger.debug(f"Checking {len(rows)} spilled files")
+            paths = [path for _, path, moved_from in rows if moved_from is None]
+            stats = await asyncio.to_thread(_stat_signatures, paths)
+            settled = time.time_ns() - int(self.quiet_period * 1e9)
+
+            for _, path, moved_from in rows:
+                signature = stats.get(path)
+                # Renames are complete, as are files not modified for the quiet
+                # period, others may still be written
+                if moved_from is not None or (
+                    signature is not None and signature[1] < settled
+                ):
+                    self._emit(path, moved_from)
+                elif signature is not None:
+                    self.pending.setdefault(path, signature)
+
+            self.wake.set()
+            self.db.remove_spilled([spill_id for spill_id, _, _ in rows])
+            self.spilled.set()
+
+    async def run(self) -> None:
+        while True:
+            if not self.pending:
+                await self.wake.wait()
+                self.wake.clear()
+
+            await asyncio.sleep(self.quiet_period)
+
+            paths = list(self.pending)
+            stats = await asyncio.to_thread(_stat_signatures, paths)
+
+            for path in paths:
+                # Emitted by a complete event while we were checking
+                if path not in self.pending:
+                    continue
+
+                signature = stats.get(path)
+                if signature is None:
+                    # Gone before it settled, e.g. a temporary file
+                    del self.pending[path]
+                elif signature == self.pending[path]:
+                    del self.pending[path]
+                    self._emit(path, None)
+                else:
+                    self.pending[path] = signature
+
+
+def _stat_signatures(paths: list[str]) -> dict[str, tuple[int, int]]:
+    signatures = {}
+    for path in paths:
+        try:
+            stats = os.stat(path)
+        except OSError:
+            continue
+
+        signatures[path] = (stats.st_size, stats.st_mtime_ns)
+
+    return signatures
+
+
+class MediaFileHandler(FileSystemEventHandler):
+    """
+    Watchdog event handler that looks for new or changed media files.
+    Only files with common media extensions are passed on to the coalescer.
+    """
+
+    def __init__(
+        self, coalescer: EventCoalescer, loop: asyncio.AbstractEventLoop
+    ) -> None:
+        self.coalescer = coalescer
         self.loop = loop
         super().__init__()
 
+    def _notify(
+        self, path: str, complete: bool = False, moved_from: str | None = None
+    ) -> None:
+        self.loop.call_soon_threadsafe(
+            self.coalescer.notify, path, complete, moved_from
+        )
+
     def on_created(self, event):
         # Only process files (not directories) with typical media extensions.
-        if not event.is_directory and event.src_path.lower().endswith(
-            SUPPORTED_MEDIA_EXTENSIONS
-        ):
+        if not event.is_directory and is_media_file(event.src_path):
             logger.info(f"Detected new media file: {event.src_path}")
-            self.loop.call_soon_threadsafe(self.queue.put_nowait, event.src_path)
+            self._notify(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory and is_media_file(event.src_path):
+            self._notify(event.src_path)
+
+    def on_moved(self, event):
+        # Renamed into place, the file is already complete
+        if not event.is_directory and is_media_file(event.dest_path):
+            logger.info(f"Detected media file moved into place: {event.dest_path}")
+
+            # A media file that was renamed can keep its database row
+            moved_from = event.src_path if is_media_file(event.src_path) else None
+            self._notify(event.dest_path, complete=True, moved_from=moved_from)
+
+    def on_closed(self, event):
+        # Closed after writing
+        if not event.is_directory and is_media_file(event.src_path):
+            self._notify(event.src_path, complete=True)
+
+
+def list_directory(
+    directory: str,
+) -> tuple[list[tuple[str, os.stat_result]], list[tuple[str, int]]]:
+    """
+    List the media files of a directory with their stats and its subdirectories
+    with the device they are on. Raises OSError when the directory can not be
+    listed, entries that can not be read are skipped.
+    """
+    files = []
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                # Like os.walk, symlinked directories are not followed
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(
+                        (entry.path, entry.stat(follow_symlinks=False).st_dev)
+                    )
+                elif entry.is_file() and is_media_file(entry.name):
+                    files.append((entry.path, entry.stat()))
+            except OSError:
+                continue
+
+    return files, subdirs
+
+
+def _scan_directory(
+    directory: str,
+) -> tuple[list[tuple[str, os.stat_result]], list[tuple[str, int]]]:
+    try:
+        return list_directory(directory)
+    except OSError as e:
+        logger.warning(f"Failed to scan {directory}: {e}")
+        return [], []
+
+
+class RootScan:
+    """Progress of the scan of one media path."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.files: int = 0
+        self.directories: int = 0
+        self.seconds: float = 0
+
+        # Directories queued or being listed
+        self.pending: int = 0
+        self.start: float = time.perf_counter()
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.seconds if self.seconds else 0
+
+
+class MediaScanner:
+    """
+    Walks the media paths with os.scandir and hands every media file, with the
+    stat from its directory entry, to the hasher. Directories are listed in
+    threads by per_device workers for each underlying device, so paths on
+    different devices are scanned in parallel while a single disk or SD card
+    is not thrashed by too many concurrent listings.
+    """
+
+    def __init__(self, hasher: Hasher, per_device: int = 2) -> None:
+        self.hasher = hasher
+        self.per_device = max(1, per_device)
+
+        self.queues: dict[int, asyncio.Queue[tuple[RootScan, str]]] = {}
+        self.workers: list[asyncio.Task] = []
+        self.pending: int = 0
+        self.idle = asyncio.Event()
+
+    async def scan(self, paths: list[str]) -> list[RootScan]:
+        """Scan every path, returns once all media files were submitted."""
+        roots = []
+        for path in paths:
+            try:
+                device = (await asyncio.to_thread(os.stat, path)).st_dev
+            except OSError as e:
+                logger.warning(f"Failed to scan {path}: {e}")
+                continue
+
+            root = RootScan(path)
+            roots.append(root)
+            self._enqueue(root, path, device)
+
+        try:
+            if self.pending:
+                await self.idle.wait()
+
+        finally:
+            for task in self.workers:
+                task.cancel()
+
+            await asyncio.gather(*self.workers, return_exceptions=True)
+            self.workers.clear()
+            self.queues.clear()
+
+        return roots
+
+    def _enqueue(self, root: RootScan, directory: str, device: int) -> None:
+        queue = self.queues.get(device)
+        if queue is None:
+            queue = self.queues[device] = asyncio.Queue()
+            for _ in range(self.per_device):
+                self.workers.append(asyncio.create_task(self._work(queue)))
+
+        root.pending += 1
+        self.pending += 1
+        self.idle.clear()
+        queue.put_nowait((root, directory))
+
+    async def _work(self, queue: asyncio.Queue[tuple[RootScan, str]]) -> None:
+        while True:
+            root, directory = await queue.get()
+            try:
+                files, subdirs = await asyncio.to_thread(_scan_directory, directory)
+                root.directories += 1
+
+                for subdir, device in subdirs:
+                    self._enqueue(root, subdir, device)
+
+                # The stat is reused by the hasher to skip unchanged files
+                for file_path, stats in files:
+                    await self.hasher.submit(file_path, stats)
+                root.files += len(files)
+
+            finally:
+                root.pending -= 1
+                if not root.pending:
+                    root.seconds = time.perf_counter() - root.start
+                    logger.info(
+                        f"Scanned {root.path}: {root.files} files in "
+                        f"{root.directories} directories in {root.seconds:.1f}s "
+                        f"({root.files_per_second:.0f} files/s)"
+                    )
+
+                self.pending -= 1
+                if not self.pending:
+                    self.idle.set()
 
 
 async def scan_existing_files(
-    paths: list[str], db: Database, new_file_event: asyncio.Event
-) -> None:
+    paths: list[str],
+    db: Database,
+    hasher: Hasher,
+    new_file_event: asyncio.Event,
+    per_device: int = 2,
+) -> list[RootScan]:
     """
     Scan the provided directories for existing media files and add them to the database.
-    The scanning is performed in a thread to avoid blocking the event loop.
+    Files are handed to the hasher as soon as they are found, the same stage the
+    watcher feeds, so uploads can start while the scan is still running.
     """
     logger.info("Scanning existing files in provided directories...")
-    for path in paths:
-        # Use asyncio.to_thread to run os.walk in a thread
-        files = await asyncio.to_thread(
-            lambda: [
-                os.path.join(root, f)
-                for root, dirs, files in os.walk(path)
-                for f in files
-                if f.lower().endswith(SUPPORTED_MEDIA_EXTENSIONS)
-            ]
-        )
-        for file_path in files:
-            if os.path.exists(file_path):
-                try:
-                    if await db.add_media(file_path):
-                        new_file_event.set()
+    start = time.perf_counter()
+    roots = await MediaScanner(hasher, per_device).scan(paths)
+
+    # Wait for the hasher to write everything found to the database
+    await hasher.join()
 
-                except Exception as e:
-                    logger.error(f"Error processing {file_path}: {e}")
+    # Media added from now on is new to the servers too
+    db.precheck = False
 
     # Check if unuploaded and if there is any then start the uploader incase there were lingering files
-    if await db.get_unuploaded():
+    if await db.has_unuploaded():
         new_file_event.set()
 
-    logger.info("Finished scanning existing files.")
+    metrics.scan_seconds.set(time.perf_counter() - start)
+    logger.info(
+        f"Finished scanning existing files in {metrics.scan_seconds.value:.1f}s."
+    )
+    return roots
 
 
-async def file_chunk_generator(file_path, chunk_size=8192):
+async def file_chunk_generator(file_path, chunk_size=65536):
     async with aiofiles.open(file_path, "rb") as f:
         while True:
             chunk = await f.read(chunk_size)
@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import os
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable
+
+from imohash import hashfile
+from loguru import logger
+
+from . import metrics
+from .database import Database
+
+
+def hash_file(file_name: str) -> bytes:
+    # Module level so it can be pickled when running in a process pool
+    return hashfile(file_name)
+
+
+def checksum_file(file_name: str) -> bytes:
+    """SHA-1 of the whole file, the checksum Immich identifies assets by."""
+    with open(file_name, "rb") as f:
+        return hashlib.file_digest(f, "sha1").digest()
+
+
+class Hasher:
+    """
+    Pipeline stage that hashes files in a thread or process pool and hands the
+    results to the database. Both the scanner and the watcher feed it through
+    submit(), which waits while the pool is saturated.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        workers: int,
+        use_processes: bool,
+        on_added: Callable[[], None],
+    ) -> None:
+        self.db = db
+        self.workers = max(1, workers)
+        self.on_added = on_added
+
+        self.executor: Executor
+        if use_processes:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="hasher"
+            )
+
+        # Allow one batch waiting on top of the batch being hashed
+        self.slots = asyncio.Semaphore(self.workers * 2)
+        self.pending: dict[str, asyncio.Task] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    async def submit(
+        self, file_name: str, stats: os.stat_result | None = None
+    ) -> asyncio.Task:
+        """
+        Queue a file for hashing, waiting while the pool is saturated. Returns
+        the task that adds it to the database.
+        """
+        # Already being processed, e.g. reported by both the scanner and watcher
+        task = self.pending.get(file_name)
+        if task is not None:
+            return task
+
+        await self.slots.acquire()
+
+        task = asyncio.create_task(self._process(file_name, stats))
+        self.pending[file_name] = task
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def rename(self, old_name: str, new_name: str) -> None:
+        """
+        Move the database row of a renamed file to its new path, or queue the
+        file for hashing when it is not known under its old path.
+        """
+        try:
+            stats = await asyncio.to_thread(os.stat, new_name)
+        except FileNotFoundError:
+            logger.warning(f"Media {new_name} no longer exists")
+            return
+
+        if not await self.db.rename_media(old_name, new_name, stats):
+            await self.submit(new_name, stats)
+
+    async def join(self) -> None:
+        """Wait until every submitted file has been written to the database."""
+        # asyncio.wait always yields to the loop, unlike gather of finished
+        # tasks, so the done callbacks removing them from tasks get to run
+        while self.tasks:
+            await asyncio.wait(self.tasks)
+
+    async def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _process(self, file_name: str, stats: os.stat_result | None) -> None:
+        try:
+            if stats is None:
+                stats = await asyncio.to_thread(os.stat, file_name)
+
+            if not await self.db.needs_hash(file_name, stats):
+                return
+
+            loop = asyncio.get_running_loop()
+            with metrics.hash_seconds.time():
+                file_hash = await loop.run_in_executor(
+                    self.executor, hash_file, file_name
+                )
+
+            # The sampled hash can match different content, a copy of uploaded
+            # media is only trusted when its full checksum matches
+            checksum = None
+            uploaded = await self.db.find_uploaded(file_hash)
+            if uploaded is not None and uploaded[0] != file_name and uploaded[1]:
+                checksum = await loop.run_in_executor(
+                    self.executor, checksum_file, file_name
+                )
+
+            if await self.db.add_media(file_name, file_hash, stats, checksum):
+                self.on_added()
+
+        except FileNotFoundError:
+            logger.warning(f"Media {file_name} no longer exists")
+
+        except Exception as e:
+            logger.error(f"Error processing {file_name}: {e}")
+
+        finally:
+            self.pending.pop(file_name, None)
+            self.slots.release()
@@ -1,46 +1,249 @@
 import aiohttp
+import asyncio
 import os
+import time
 
 from datetime import datetime
 from loguru import logger
 
+from . import metrics
 from .files import file_chunk_generator
+from .payload import (
+    BodyChecksum,
+    FilePayload,
+    SharedFilePayload,
+    SharedReader,
+    Transfer,
+)
+from .throttle import Bandwidth
 
 
-async def upload(base_url: str, api_key: str, file: str, chunk_size: int) -> bool:
-    try:
-        logger.info(f"Uploading {file}...")
-        stats = os.stat(file)
-        file_size = os.stat(file).st_size
-
-        headers = {
-            "Accept": "application/json",
-            "x-api-key": api_key,
-        }
-
-        # Convert timestamps to ISO format for JSON compatibility.
-        data = {
-            "deviceAssetId": f"{file}-{stats.st_mtime}",
-            "deviceId": "python",
-            "fileCreatedAt": datetime.fromtimestamp(stats.st_mtime).isoformat(),
-            "fileModifiedAt": datetime.fromtimestamp(stats.st_mtime).isoformat(),
-            "fileSize": str(file_size),
-            "isFavorite": "false",
-        }
-
-        timeout = aiohttp.ClientTimeout(total=60 * 60)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
+def _record_upload(file_size: int, duration: float) -> None:
+    metrics.files_uploaded.inc()
+    metrics.bytes_uploaded.inc(file_size)
+    metrics.upload_seconds.observe(duration)
+    if duration > 0:
+        metrics.upload_throughput.set(file_size / duration)
+
+
+async def _tracked_chunks(
+    chunks, transfer: Transfer, bandwidth: Bandwidth, checksum: BodyChecksum | None
+):
+    async for chunk in chunks:
+        if checksum is not None:
+            checksum.update(chunk)
+        await bandwidth.acquire(len(chunk))
+        yield chunk
+        transfer.sent += len(chunk)
+
+
+class UploadError(Exception):
+    """
+    Raised when an upload fails. server_error marks failures that are not
+    specific to the file, like the server being unreachable or erroring.
+    """
+
+    def __init__(self, message: str, server_error: bool = False) -> None:
+        super().__init__(message)
+        self.server_error = server_error
+
+
+class Immich:
+    """
+    Client for the Immich API. A single session and connection pool is kept
+    for the lifetime of the daemon so connections, TLS sessions and DNS
+    lookups are reused across uploads.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        chunk_size: int,
+        stream_files: bool = True,
+        connection_limit: int = 4,
+        keepalive_timeout: float = 60,
+        dns_cache_ttl: int = 300,
+        bandwidth: Bandwidth | None = None,
+    ) -> None:
+        self.base_url: str = base_url
+        self.api_key: str = api_key
+        self.chunk_size: int = chunk_size
+        self.stream_files: bool = stream_files
+        self.connection_limit: int = connection_limit
+        self.keepalive_timeout: float = keepalive_timeout
+        self.dns_cache_ttl: int = dns_cache_ttl
+
+        self._session: aiohttp.ClientSession | None = None
+
+        # Upload rate limit, can be shared with the clients of other targets,
+        # and the progress of the uploads running now
+        self.bandwidth = bandwidth or Bandwidth()
+        self.transfers: dict[str, Transfer] = {}
+
+        # Disabled once the server reports it does not know the endpoint
+        self.bulk_check_supported: bool = True
+
+        # Connection pool counters
+        self.connections_opened: int = 0
+        self.connections_reused: int = 0
+
+    async def connect(self) -> None:
+        connector = aiohttp.TCPConnector(
+            limit_per_host=self.connection_limit,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_create)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            headers={
+                "Accept": "application/json",
+                "x-api-key": self.api_key,
+            },
+            timeout=aiohttp.ClientTimeout(total=60 * 60),
+            trace_configs=[trace_config],
+        )
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise RuntimeError(
+                "Immich session is not initialized. Call connect() first."
+            )
+
+        return self._session
+
+    async def close(self) -> None:
+        if self._session:
+            logger.debug(
+                f"Immich connections opened: {self.connections_opened}, "
+                f"reused: {self.connections_reused}"
+            )
+            await self._session.close()
+            self._session = None
+
+    async def _on_connection_create(self, session, context, params) -> None:
+        self.connections_opened += 1
+
+    async def _on_connection_reuse(self, session, context, params) -> None:
+        self.connections_reused += 1
+
+    async def bulk_upload_check(
+        self, checksums: dict[str, bytes]
+    ) -> dict[str, str | None] | None:
+        """
+        Ask the server which of the given checksums it already has, without
+        sending any file data. Returns the files the server rejected as
+        duplicates mapped to the existing asset id, or None if the check failed.
+        """
+        if not self.bulk_check_supported:
+            return None
+
+        try:
+            payload = {
+                "assets": [
+                    {"id": file_name, "checksum": checksum.hex()}
+                    for file_name, checksum in checksums.items()
+                ]
+            }
+
+            async with self.session.post(
+                f"{self.base_url}/assets/bulk-upload-check", json=payload
+            ) as response:
+                if response.status == 404:
+                    logger.warning(
+                        "Server does not support bulk upload checks, disabling"
+                    )
+                    self.bulk_check_supported = False
+                    return None
+
+                if response.status not in [200, 201]:
+                    logger.error(f"Failed bulk upload check: {await response.text()}")
+                    return None
+
+                response_json = await response.json()
+
+            return {
+                result["id"]: result.get("assetId")
+                for result in response_json.get("results", [])
+                if result.get("action") == "reject"
+                and result.get("reason") == "duplicate"
+            }
+
+        except Exception as e:
+            logger.error(f"Failed bulk upload check: {e}")
+            return None
+
+    async def upload(
+        self,
+        file: str,
+        source: SharedReader | None = None,
+        checksum: bytes | None = None,
+        body_checksum: BodyChecksum | None = None,
+    ) -> bool:
+        """
+        Upload a file, raising UploadError if it fails. With a source the file
+        data comes from a read shared with uploads to other targets.
+
+        A known checksum is sent in the x-immich-checksum header, which lets
+        servers that support it answer duplicates without taking the body,
+        otherwise body_checksum is computed from the file as it is sent.
+        """
+        try:
+            logger.info(f"Uploading {file}...")
+            start = time.perf_counter()
+            stats = await asyncio.to_thread(os.stat, file)
+            file_size = stats.st_size
+
+            # Convert timestamps to ISO format for JSON compatibility.
+            data = {
+                "deviceAssetId": f"{file}-{stats.st_mtime}",
+                "deviceId": "python",
+                "fileCreatedAt": datetime.fromtimestamp(stats.st_mtime).isoformat(),
+                "fileModifiedAt": datetime.fromtimestamp(stats.st_mtime).isoformat(),
+                "fileSize": str(file_size),
+                "isFavorite": "false",
+            }
+
+            transfer = Transfer(file, file_size)
+            self.transfers[file] = transfer
+
             # Build the form-data for upload.
             form = aiohttp.FormData()
             for key, value in data.items():
                 form.add_field(key, value)
 
-            file_iter = file_chunk_generator(file, chunk_size=chunk_size)
-            file_payload = aiohttp.AsyncIterablePayload(
-                file_iter,
-                size=file_size,
-                content_type="application/octet-stream",
-            )
+            file_payload: aiohttp.Payload
+            if source is not None:
+                file_payload = SharedFilePayload(
+                    source,
+                    size=file_size,
+                    transfer=transfer,
+                    bandwidth=self.bandwidth,
+                    content_type="application/octet-stream",
+                )
+            elif self.stream_files:
+                file_payload = FilePayload(
+                    file,
+                    size=file_size,
+                    min_chunk_size=self.chunk_size,
+                    transfer=transfer,
+                    bandwidth=self.bandwidth,
+                    checksum=body_checksum,
+                    content_type="application/octet-stream",
+                )
+            else:
+                file_iter = file_chunk_generator(file, chunk_size=self.chunk_size)
+                file_payload = aiohttp.AsyncIterablePayload(
+                    _tracked_chunks(file_iter, transfer, self.bandwidth, body_checksum),
+                    size=file_size,
+                    content_type="application/octet-stream",
+                )
             form.add_field(
                 "assetData",
                 file_payload,
@@ -48,29 +251,41 @@ async def upload(base_url: str, api_key: str, file: str, chunk_size: int) -> boo
                 content_type="application/octet-stream",
             )
 
-            async with session.post(
-                f"{base_url}/assets", headers=headers, data=form
+            headers = {"x-immich-checksum": checksum.hex()} if checksum else None
+            async with self.session.post(
+                f"{self.base_url}/assets", data=form, headers=headers
             ) as response:
                 status = response.status
                 if status not in [200, 201]:
-                    logger.error(f"Failed to upload {file}: {await response.text()}")
-                    return False
+                    # Authentication and server errors affect every file
+                    raise UploadError(
+                        f"{status} {await response.text()}",
+                        server_error=status >= 500 or status in [401, 403],
+                    )
 
                 response_json = await response.json()
                 status = response_json.get("status")
                 if status == "created":
                     logger.success(f"{file} uploaded successfully")
+                    _record_upload(file_size, time.perf_counter() - start)
                     return True
                 elif status == "duplicate":
                     logger.warning(f"{file} is duplicate of {response_json.get('id')}")
                     return True
-                logger.error(f"Failed to upload {file}: {response_json}")
-                return False
+                raise UploadError(f"Unexpected response {response_json}")
+
+        except FileNotFoundError:
+            logger.warning(f"File {file} no longer exists")
+            raise FileNotFoundError
+
+        except UploadError:
+            raise
+
+        except (aiohttp.ClientConnectionError, TimeoutError) as e:
+            raise UploadError(str(e) or type(e).__name__, server_error=True)
 
-    except FileNotFoundError:
-        logger.warning(f"File {file} no longer exists")
-        raise FileNotFoundError
+        except Exception as e:
+            raise UploadError(str(e) or type(e).__name__)
 
-    except Exception as e:
-        logger.error(f"Failed to upload {file}: {e}")
-        return False
+        finally:
+            self.transfers.pop(file, None)
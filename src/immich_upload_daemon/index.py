@@ -0,0 +1,252 @@
+import itertools
+import sys
+
+from array import array
+from bisect import bisect_left
+from typing import Iterable
+
+# Stat fingerprint of a removed file, real fingerprints are moved off it
+REMOVED = -(2**63)
+
+# Size of the content filter, two probes give about 1% false positives
+FILTER_BITS_PER_FILE = 16
+MIN_FILTER_BYTES = 8192
+
+
+def path_fingerprint(file_name: str) -> int:
+    # The index only lives as long as the process, so the randomized built-in
+    # string hash is stable enough and much cheaper than a digest
+    return hash(file_name)
+
+
+def stat_fingerprint(file_stat: tuple) -> int:
+    fingerprint = hash(file_stat)
+    return fingerprint if fingerprint != REMOVED else REMOVED + 1
+
+
+def content_fingerprint(file_hash: bytes | None, uploaded: bool) -> int:
+    # The lowest bit holds the uploaded flag
+    return (hash(file_hash) & ~1) | int(uploaded)
+
+
+class FileIndex:
+    """
+    Compact in-memory index of the media in the database so checking whether a
+    file is known and unchanged does not need a query. Paths, stats and content
+    hashes are kept as 64-bit fingerprints in sorted arrays, 24 bytes per file.
+    Files added since the last compaction live in a small overlay dict that is
+    merged into the arrays once it grows past compact_threshold entries, or a
+    32nd of the arrays for large libraries.
+
+    A Bloom filter over the content hashes tells when a file's content is
+    certainly not known under any path, so looking for copies of it only needs
+    a query on the rare possible match.
+    """
+
+    def __init__(self, compact_threshold: int = 4096) -> None:
+        self.keys = array("q")
+        self.stats = array("q")
+        self.contents = array("q")
+        self.added: dict[int, tuple[int, int]] = {}
+        self.compact_threshold = compact_threshold
+        self.count: int = 0
+
+        # Built on first use after loading
+        self.content_filter = bytearray(MIN_FILTER_BYTES)
+        self.filtered: int = 0
+        self.filter_stale: bool = False
+
+    def load(self, rows: Iterable[tuple]) -> None:
+        """
+        Fill the index from (path fingerprint, file_hash, uploaded, size,
+        mtime_ns, inode, device) rows sorted by path fingerprint. Can be called
+        with consecutive chunks of the rows.
+        """
+        last = self.keys[-1] if self.keys else None
+        for row in rows:
+            key = row[0]
+            if key == last:
+                continue
+
+            self.keys.append(key)
+            self.stats.append(stat_fingerprint(row[3:]))
+            self.contents.append(content_fingerprint(row[1], bool(row[2])))
+            last = key
+
+        self.count = len(self.keys)
+        self.filter_stale = True
+
+    def __len__(self) -> int:
+        return self.count
+
+    def memory_usage(self) -> int:
+        """Approximate number of bytes used by the index."""
+        arrays = sum(
+            a.buffer_info()[1] * a.itemsize
+            for a in (self.keys, self.stats, self.contents)
+        )
+        # Every overlay entry holds a key, a tuple and two fingerprints
+        overlay = sys.getsizeof(self.added) + len(self.added) * 160
+        return arrays + overlay + len(self.content_filter)
+
+    def _find(self, key: int) -> int | None:
+        """Position of key in the arrays, None if it is not in them."""
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+
+        return None
+
+    def _get(self, file_name: str) -> tuple[int, int] | None:
+        key = path_fingerprint(file_name)
+        entry = self.added.get(key)
+        if entry is not None:
+            return entry
+
+        i = self._find(key)
+        if i is None or self.stats[i] == REMOVED:
+            return None
+
+        return self.stats[i], self.contents[i]
+
+    def _set(self, file_name: str, stat: int, content: int) -> None:
+        key = path_fingerprint(file_name)
+        if key in self.added:
+            self.added[key] = (stat, content)
+            return
+
+        i = self._find(key)
+        if i is None:
+            self.added[key] = (stat, content)
+            self.count += 1
+            # Grows with the index so large libraries are not copied too often
+            if len(self.added) >= max(self.compact_threshold, len(self.keys) // 32):
+                self.compact()
+            return
+
+        if self.stats[i] == REMOVED:
+            self.count += 1
+
+        self.stats[i] = stat
+        self.contents[i] = content
+
+    def is_unchanged(self, file_name: str, file_stat: tuple) -> bool:
+        """Whether the file is known with the same size, mtime, inode and device."""
+        entry = self._get(file_name)
+        return entry is not None and entry[0] == stat_fingerprint(file_stat)
+
+    def has_hash(self, file_name: str, file_hash: bytes) -> bool:
+        """Whether the file is known with the same content hash."""
+        entry = self._get(file_name)
+        return entry is not None and (entry[1] | 1) == (
+            content_fingerprint(file_hash, True)
+        )
+
+    def may_contain(self, file_hash: bytes) -> bool:
+        """Whether media with this content hash may be known, False is certain."""
+        if self.filter_stale:
+            self._rebuild_filter(self.count)
+
+        return all(
+            self.content_filter[bit >> 3] & (1 << (bit & 7))
+            for bit in self._filter_bits(content_fingerprint(file_hash, False))
+        )
+
+    def add(
+        self, file_name: str, file_hash: bytes, file_stat: tuple, uploaded: bool = False
+    ) -> None:
+        """Record new or changed media."""
+        content = content_fingerprint(file_hash, uploaded)
+        self._set(file_name, stat_fingerprint(file_stat), content)
+        self._filter_add(content)
+
+    def rename(self, old_name: str, new_name: str, file_stat: tuple) -> None:
+        entry = self._get(old_name)
+        if entry is not None:
+            self.remove(old_name)
+            self._set(new_name, stat_fingerprint(file_stat), entry[1])
+
+    def set_stat(self, file_name: str, file_stat: tuple) -> None:
+        entry = self._get(file_name)
+        if entry is not None:
+            self._set(file_name, stat_fingerprint(file_stat), entry[1])
+
+    def set_uploaded(self, file_name: str) -> None:
+        entry = self._get(file_name)
+        if entry is not None:
+            self._set(file_name, entry[0], entry[1] | 1)
+
+    def remove(self, file_name: str) -> None:
+        key = path_fingerprint(file_name)
+        if self.added.pop(key, None) is not None:
+            self.count -= 1
+            return
+
+        # Left in place as a tombstone, dropped on the next restart
+        i = self._find(key)
+        if i is not None and self.stats[i] != REMOVED:
+            self.stats[i] = REMOVED
+            self.count -= 1
+
+    def compact(self) -> None:
+        """Merge the overlay into the sorted arrays."""
+        keys = array("q")
+        stats = array("q")
+        contents = array("q")
+
+        # Copy the runs between the new keys with slices so only the overlay
+        # is walked in Python
+        start = 0
+        for key in sorted(self.added):
+            i = bisect_left(self.keys, key, start)
+            keys.extend(self.keys[start:i])
+            stats.extend(self.stats[start:i])
+            contents.extend(self.contents[start:i])
+
+            stat, content = self.added[key]
+            keys.append(key)
+            stats.append(stat)
+            contents.append(content)
+            start = i
+
+        keys.extend(self.keys[start:])
+        stats.extend(self.stats[start:])
+        contents.extend(self.contents[start:])
+
+        self.keys, self.stats, self.contents = keys, stats, contents
+        self.added.clear()
+
+    def _filter_bits(self, content: int) -> tuple[int, int]:
+        # Two probes from different parts of the fingerprint, skipping the
+        # uploaded flag in the lowest bit
+        mask = len(self.content_filter) * 8 - 1
+        return (content >> 1) & mask, (content >> 33) & mask
+
+    def _filter_add(self, content: int) -> None:
+        if self.filter_stale or (
+            (self.filtered + 1) * FILTER_BITS_PER_FILE > len(self.content_filter) * 8
+        ):
+            self._rebuild_filter(self.count + 1)
+
+        for bit in self._filter_bits(content):
+            self.content_filter[bit >> 3] |= 1 << (bit & 7)
+        self.filtered += 1
+
+    def _rebuild_filter(self, files: int) -> None:
+        """Size the filter for files entries and fill it from the index."""
+        size = MIN_FILTER_BYTES
+        while size * 8 < files * FILTER_BITS_PER_FILE:
+            size *= 2
+
+        self.content_filter = bytearray(size)
+        self.filtered = 0
+        self.filter_stale = False
+
+        contents = itertools.chain(
+            (c for c, s in zip(self.contents, self.stats) if s != REMOVED),
+            (content for _, content in self.added.values()),
+        )
+        for content in contents:
+            for bit in self._filter_bits(content):
+                self.content_filter[bit >> 3] |= 1 << (bit & 7)
+            self.filtered += 1
@@ -1,8 +1,11 @@
+import argparse
 import asyncio
+import json
 import uvloop
 import os
 import signal
 import sys
+import time
 
 from aiofiles import open
 from dotenv import dotenv_values
@@ -10,76 +13,161 @@ from loguru import logger
 from watchdog.observers import Observer
 from xdg.BaseDirectory import xdg_config_home
 
-from .immich import upload
-from .database import Database, get_db_path
-from .files import MediaFileHandler, scan_existing_files
-from .network import check_network_conditions
-from .utils import str_to_bool
+from . import control, metrics
+from .database import DEFAULT_TARGET, Database, get_db_path
+from .files import EventCoalescer, MediaFileHandler, scan_existing_files
+from .hasher import Hasher
+from .startup import profile_startup
+from .immich import Immich
+from .network import (
+    NetworkManagerProvider,
+    NetworkMonitor,
+    NetworkProvider,
+    NullNetworkProvider,
+    has_networkmanager,
+)
+from .reconcile import Reconciler
+from .schedule import VIDEO, UploadOrder
+from .throttle import Bandwidth
+from .uploader import Target, UploadPool, check_existing_assets
+from .utils import str_to_bool, str_to_int
 
 # A global event to signal shutdown
 shutdown_event = asyncio.Event()
 new_file_event = asyncio.Event()
 
+# Wait before another upload pass after one failed
+UPLOAD_PASS_RETRY_DELAY = 30
+
 
 def shutdown():
     logger.info("Received shutdown signal, initiating graceful shutdown...")
     shutdown_event.set()
 
 
-async def watcher(db: Database, queue: asyncio.Queue):
+async def watcher(hasher: Hasher, queue: asyncio.Queue):
     """
-    Asynchronous watcher that processes file paths from the queue.
+    Asynchronous watcher that hands file paths from the queue to the hasher.
     """
     while not shutdown_event.is_set():
         logger.info("Waiting for a new files...")
 
         # Wait for a new file path from the watchdog handler.
-        file_path = await queue.get()
+        file_path, moved_from = await queue.get()
+        metrics.watcher_queue_depth.set(queue.qsize())
 
-        if os.path.exists(file_path):
-            if await db.add_media(file_path):
-                new_file_event.set()
+        if moved_from is not None:
+            await hasher.rename(moved_from, file_path)
+        elif await asyncio.to_thread(os.path.exists, file_path):
+            await hasher.submit(file_path)
 
         queue.task_done()
 
 
+async def wait_favorable(targets: list[Target], timeout: float | None = None):
+    """Wait until the network conditions of one of targets are met."""
+    waits = [asyncio.create_task(target.monitor.favorable.wait()) for target in targets]
+    try:
+        await asyncio.wait(waits, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for wait in waits:
+            wait.cancel()
+
+
 async def uploader(
     db: Database,
-    base_url: str,
-    api_key: str,
-    chunk_size: int,
-    # Conditions
-    wifi_only: bool,
-    ssid: str | None,
-    not_metered: bool,
+    targets: list[Target],
+    pool: UploadPool,
+    bulk_check_batch_size: int,
+    page_size: int,
 ):
     while not shutdown_event.is_set():
-        # Wait for a new file event to upload
-        await new_file_event.wait()
+        try:
+            await upload_pass(db, targets, pool, bulk_check_batch_size, page_size)
+        except Exception as e:
+            # A failing pass, e.g. on a database error, must not stop uploads
+            logger.error(f"Upload pass failed, trying again: {e}")
+            await asyncio.sleep(UPLOAD_PASS_RETRY_DELAY)
 
-        while True:
-            condition = await check_network_conditions(wifi_only, ssid, not_metered)
-            if condition:
-                break
 
-            logger.warning("Rechecking network condition in 10 mins")
-            await asyncio.sleep(60 * 10)
+async def upload_pass(
+    db: Database,
+    targets: list[Target],
+    pool: UploadPool,
+    bulk_check_batch_size: int,
+    page_size: int,
+):
+    """Hand the pending media to the upload workers once there is new media."""
+    # Wait for a new file event to upload
+    await new_file_event.wait()
+
+    # Woken by the network monitors as soon as conditions are favorable
+    if not any(target.monitor.verdict for target in targets):
+        logger.warning("Waiting for network conditions to be met")
+        with pool.blocked():
+            await wait_favorable(targets)
+
+    # Skip files the servers already have before sending any bytes
+    if bulk_check_batch_size > 0:
+        skipped = await check_existing_assets(db, targets, bulk_check_batch_size)
+        if skipped:
+            logger.info(f"Skipped {skipped} uploads of files already on a server")
+
+    metrics.pending_files.set(await db.count_unuploaded())
+
+    # Stream files pending on a target that can be uploaded to now to the
+    # workers page by page in upload order, videos only where the video
+    # conditions are met too
+    favorable = [target.name for target in targets if target.monitor.verdict]
+    video_favorable = [
+        target.name for target in targets if target.monitor_for(VIDEO).verdict
+    ]
+    found = False
+    async for file_name, priority in db.iter_unuploaded(
+        page_size, favorable, video_favorable
+    ):
+        found = True
+        await pool.submit(file_name, priority)
+
+    # Only clear when unuploaded comes back empty to prevent issues with
+    # new files being discovered during the uploading process
+    if not found:
+        new_file_event.clear()
+
+        # Sleep until the next failed upload is due unless a new file shows
+        # up or the conditions of another target are met
+        next_attempt_at = await db.next_attempt_time(favorable, video_favorable)
+        unfavorable = [
+            monitor
+            for target in targets
+            for monitor in target.monitors
+            if not monitor.verdict
+        ]
+        if next_attempt_at is None and not unfavorable:
+            logger.info("Waiting for a new files...")
+            return
 
-        unuploaded = await db.get_unuploaded()
+        delay = None
+        if next_attempt_at is not None:
+            delay = max(0, next_attempt_at - time.time())
+            logger.info(f"Waiting {delay:.0f}s for the next retry...")
 
-        # Only clear when unuploaded comes back empty to prevent issues with
-        # new files being discovered during the uploading process
-        if not unuploaded:
-            new_file_event.clear()
-            logger.info("Waiting for a new files...")
+        waits = [asyncio.create_task(new_file_event.wait())]
+        waits.extend(
+            asyncio.create_task(monitor.favorable.wait()) for monitor in unfavorable
+        )
+        try:
+            await asyncio.wait(
+                waits, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            for wait in waits:
+                wait.cancel()
+        new_file_event.set()
+        return
 
-        for file_name in unuploaded:
-            try:
-                if await upload(base_url, api_key, file_name, chunk_size):
-                    await db.mark_uploaded(file_name)
-            
-            except FileNotFoundError:
-                await db.remove_media(file_name)
+    # Let the workers drain this pass before querying the database again
+    await pool.join()
 
 
 async def create_default_config(env_file: str):
@@ -90,6 +178,10 @@ async def create_default_config(env_file: str):
 API_KEY
 MEDIA_PATHS
 CHUNK_SIZE=65536
+UPLOAD_CONCURRENCY=2
+BULK_CHECK_BATCH_SIZE=500
+HASH_WORKERS=4
+HASH_PROCESSES=False
 DEBUG=True
 
 # Conditions
@@ -122,11 +214,15 @@ async def read_key(path: str | None) -> str | None:
         return None
 
 
-async def run():
-    # Load environment variables
-    env_file = os.path.join(
+def get_env_file() -> str:
+    return os.path.join(
         xdg_config_home, "immich_upload_daemon", "immich_upload_daemon.env"
     )
+
+
+async def run():
+    # Load environment variables
+    env_file = get_env_file()
     if not os.path.exists(env_file):
         # Create the directory if it doesn't exist
         os.makedirs(os.path.dirname(env_file), exist_ok=True)
@@ -141,33 +237,128 @@ async def run():
         or await read_key(env.get("API_KEY_FILE"))
     )
     media_paths: str | None = env.get("MEDIA_PATHS")
-    chunk_size: int | str | None = env.get("CHUNK_SIZE", 65536)
-    wifi_only: bool = str_to_bool(env.get("WIFI_ONLY"))
-    ssid: str | None = env.get("SSID")
-    not_metered: bool = str_to_bool(env.get("NOT_METERED"))
+    chunk_size: int = str_to_int(env.get("CHUNK_SIZE"), 65536)
+    upload_concurrency: int = str_to_int(env.get("UPLOAD_CONCURRENCY"), 2)
+    upload_max_concurrency: int = max(
+        upload_concurrency, str_to_int(env.get("UPLOAD_MAX_CONCURRENCY"), 8)
+    )
+    upload_bandwidth: int = str_to_int(env.get("UPLOAD_BANDWIDTH"), 0)
+    upload_body: str = (env.get("UPLOAD_BODY") or "file").lower()
+    upload_page_size: int = str_to_int(env.get("UPLOAD_PAGE_SIZE"), 500)
+    upload_order: str = env.get("UPLOAD_ORDER") or "newest"
+    retry_base_delay: int = str_to_int(env.get("RETRY_BASE_DELAY"), 60)
+    retry_max_delay: int = str_to_int(env.get("RETRY_MAX_DELAY"), 60 * 60 * 6)
+    bulk_check_batch_size: int = str_to_int(env.get("BULK_CHECK_BATCH_SIZE"), 500)
+    hash_workers: int = str_to_int(env.get("HASH_WORKERS"), 4)
+    hash_processes: bool = str_to_bool(env.get("HASH_PROCESSES"))
+    scan_concurrency: int = str_to_int(env.get("SCAN_CONCURRENCY"), 2)
+    watch_quiet_period: int = str_to_int(env.get("WATCH_QUIET_PERIOD_MS"), 2000)
+    watch_queue_size: int = str_to_int(env.get("WATCH_QUEUE_SIZE"), 10000)
+    reconcile_interval: int = str_to_int(env.get("RECONCILE_INTERVAL"), 60 * 60 * 6)
+    reconcile_rate: int = str_to_int(env.get("RECONCILE_RATE"), 1000)
+    metrics_port: int = str_to_int(env.get("METRICS_PORT"), 0)
+    metrics_host: str = env.get("METRICS_HOST") or "127.0.0.1"
+    metrics_socket: str | None = env.get("METRICS_SOCKET")
+    control_socket: str = env.get("CONTROL_SOCKET") or control.get_socket_path()
+    db_batch_size: int = str_to_int(env.get("DB_BATCH_SIZE"), 500)
+    db_flush_interval: int = str_to_int(env.get("DB_FLUSH_INTERVAL_MS"), 1000)
+    db_synchronous: str = env.get("DB_SYNCHRONOUS") or "NORMAL"
+    db_cache_size: int = str_to_int(env.get("DB_CACHE_SIZE"), -16000)
+    db_mmap_size: int = str_to_int(env.get("DB_MMAP_SIZE"), 0)
+    db_file_index: bool = str_to_bool(env.get("DB_FILE_INDEX") or "true")
+    target_names: list[str] = [
+        name.strip() for name in (env.get("TARGETS") or "").split(",") if name.strip()
+    ]
     debug: bool = str_to_bool(env.get("DEBUG"))
 
     configure_logger(debug)
 
-    if not BASE_URL or not API_KEY:
-        logger.error(f"Please set BASE_URL and API_KEY in {env_file}")
+    try:
+        order = UploadOrder(upload_order)
+    except ValueError as e:
+        logger.error(f"Please fix UPLOAD_ORDER in {env_file}: {e}")
         return
 
-    # Default chunk_size
-    # Fallback for if chunk_size key exists but not set
-    if not chunk_size:
-        chunk_size = 65536
-    if isinstance(chunk_size, str):
-        chunk_size = int(chunk_size)
+    # Settings of each upload target are prefixed with its name in upper case
+    # and fall back to the unprefixed ones. Without TARGETS there is a single
+    # target using the unprefixed settings.
+    target_configs = []
+    for name in target_names or [DEFAULT_TARGET]:
+        prefix = f"{name.upper()}_" if target_names else ""
+        base_url = env.get(f"{prefix}BASE_URL") or BASE_URL
+        api_key = API_KEY
+        if prefix:
+            api_key = (
+                env.get(f"{prefix}API_KEY")
+                or await read_key(env.get(f"{prefix}API_KEY_FILE"))
+                or API_KEY
+            )
+
+        if not base_url or not api_key:
+            logger.error(
+                f"Please set {prefix}BASE_URL and {prefix}API_KEY in {env_file}"
+            )
+            return
+
+        target_configs.append(
+            (
+                name,
+                # Strip trailing slashes
+                base_url.rstrip("/"),
+                api_key,
+                str_to_bool(env.get(f"{prefix}WIFI_ONLY") or env.get("WIFI_ONLY")),
+                env.get(f"{prefix}SSID") or env.get("SSID"),
+                str_to_bool(env.get(f"{prefix}NOT_METERED") or env.get("NOT_METERED")),
+                str_to_bool(
+                    env.get(f"{prefix}VIDEO_WIFI_ONLY") or env.get("VIDEO_WIFI_ONLY")
+                ),
+                str_to_bool(
+                    env.get(f"{prefix}VIDEO_NOT_METERED")
+                    or env.get("VIDEO_NOT_METERED")
+                ),
+            )
+        )
 
-    # Strip trailing slashes
-    BASE_URL = BASE_URL.rstrip("/")
+    # Track network conditions from NetworkManager signals, D-Bus is only used
+    # when a condition needs it.
+    provider: NetworkProvider = NullNetworkProvider()
+    if any(
+        config[3] or config[5] or config[6] or config[7] for config in target_configs
+    ):
+        if not has_networkmanager():
+            logger.error(
+                "WIFI_ONLY and NOT_METERED need NetworkManager support, install "
+                "it with the networkmanager extra: "
+                "immich-upload-daemon[networkmanager]"
+            )
+            return
+        provider = NetworkManagerProvider()
+
+    # Optional local metrics endpoint
+    metrics_runner = None
+    if metrics_port or metrics_socket:
+        metrics_runner = await metrics.start_server(
+            metrics_host, metrics_port, metrics_socket
+        )
 
-    db = Database(get_db_path("files.db"))
+    db = Database(
+        get_db_path("files.db"),
+        batch_size=db_batch_size,
+        flush_interval=db_flush_interval / 1000,
+        synchronous=db_synchronous,
+        cache_size=db_cache_size,
+        mmap_size=db_mmap_size,
+        file_index=db_file_index,
+        targets=[config[0] for config in target_configs],
+        order=order,
+    )
     await db.init_db()
 
-    # Create an asyncio queue for file events.
-    file_queue: asyncio.Queue[str] = asyncio.Queue()
+    # Create an asyncio queue for file events, files beyond its size are
+    # spilled to the database by the coalescer.
+    file_queue: asyncio.Queue[tuple[str, str | None]] = asyncio.Queue(
+        max(0, watch_queue_size)
+    )
 
     if media_paths:
         # Parse MEDIA_PATHS (assumed comma-separated).
@@ -185,19 +376,50 @@ async def run():
             os.path.expanduser("~/Videos"),
         ]
 
-    # First, scan the provided directories for existing media files.
-    await scan_existing_files(paths, db, new_file_event)
+    # Hashing stage shared by the scanner and the watcher.
+    hasher = Hasher(db, hash_workers, hash_processes, new_file_event.set)
+
+    # Periodic walks of the media paths for changes the watcher missed.
+    reconciler = Reconciler(
+        paths,
+        db,
+        hasher,
+        reconcile_interval,
+        rate=reconcile_rate,
+        settle=watch_quiet_period / 1000,
+    )
 
     loop = asyncio.get_running_loop()
 
-    # Create and start watchdog observers for each media path.
+    # Watchdog events are coalesced until files are completely written. A
+    # burst that spilled the queue may also have overflowed inotify's, which
+    # is not reported, so the media paths are reconciled once it is through.
+    coalescer = EventCoalescer(
+        file_queue,
+        watch_quiet_period / 1000,
+        db,
+        lambda: reconciler.trigger("watcher queue overflowed"),
+    )
+    coalescer_task = asyncio.create_task(coalescer.run())
+    drain_task = asyncio.create_task(coalescer.drain())
+
+    # Create and start watchdog observers for each media path before scanning
+    # so files created during the scan are not missed.
     observers = []
     for path in paths:
         if os.path.isdir(path):
-            event_handler = MediaFileHandler(file_queue, loop)
+            event_handler = MediaFileHandler(coalescer, loop)
             observer = Observer()
             observer.schedule(event_handler, path=path, recursive=True)
-            observer.start()
+            try:
+                observer.start()
+            except OSError as e:
+                # Usually fs.inotify.max_user_watches being reached
+                logger.error(
+                    f"Failed to watch {path}: {e}, changes there are only "
+                    "found by the scan every RECONCILE_INTERVAL"
+                )
+                continue
             observers.append(observer)
             logger.info(f"Started watching directory: {path}")
         else:
@@ -207,22 +429,122 @@ async def run():
     loop.add_signal_handler(signal.SIGINT, shutdown)
     loop.add_signal_handler(signal.SIGTERM, shutdown)
 
+    # Upload bandwidth limit shared by every target
+    bandwidth = Bandwidth(upload_bandwidth * 1024)
+
+    targets: list[Target] = []
+    monitor_tasks: list[asyncio.Task] = []
+    for (
+        name,
+        base_url,
+        api_key,
+        wifi_only,
+        ssid,
+        not_metered,
+        video_wifi_only,
+        video_not_metered,
+    ) in target_configs:
+        # Shared Immich client, one connection per upload worker plus one spare
+        # for API calls made outside the workers. Connections are only opened
+        # when needed, so allowing for the most workers costs nothing up front.
+        immich = Immich(
+            base_url,
+            api_key,
+            chunk_size,
+            stream_files=upload_body != "generator",
+            connection_limit=upload_max_concurrency + 1,
+            bandwidth=bandwidth,
+        )
+        await immich.connect()
+
+        monitor = NetworkMonitor(provider, wifi_only, ssid, not_metered)
+        monitor_tasks.append(asyncio.create_task(monitor.run()))
+
+        # Videos only get their own monitor when their conditions are stricter
+        video_monitor = None
+        if (video_wifi_only and not wifi_only) or (
+            video_not_metered and not not_metered
+        ):
+            video_monitor = NetworkMonitor(
+                provider,
+                wifi_only or video_wifi_only,
+                ssid,
+                not_metered or video_not_metered,
+            )
+            monitor_tasks.append(asyncio.create_task(video_monitor.run()))
+
+        targets.append(Target(name, immich, monitor, video_monitor))
+
+    # Start the upload workers that the uploader feeds.
+    pool = UploadPool(
+        db,
+        targets,
+        upload_concurrency,
+        shutdown_event,
+        retry_base_delay=retry_base_delay,
+        retry_max_delay=retry_max_delay,
+        max_concurrency=upload_max_concurrency,
+    )
+    pool.start()
+
+    # Local control socket for the ctl command
+    control_server = control.ControlServer(
+        control_socket, db, hasher, pool, bandwidth, reconciler
+    )
+    try:
+        await control_server.start()
+    except OSError as e:
+        logger.error(f"Failed to listen on control socket {control_socket}: {e}")
+
     # Create asynchronous tasks for both the watcher and uploader.
-    watcher_task = asyncio.create_task(watcher(db, file_queue))
+    watcher_task = asyncio.create_task(watcher(hasher, file_queue))
     uploader_task = asyncio.create_task(
-        uploader(db, BASE_URL, API_KEY, chunk_size, wifi_only, ssid, not_metered)
+        uploader(
+            db,
+            targets,
+            pool,
+            bulk_check_batch_size,
+            upload_page_size,
+        )
+    )
+
+    # Scan the provided directories for existing media files while watching
+    # and uploading, new files are picked up by the uploader as they are added.
+    scan_task = asyncio.create_task(
+        scan_existing_files(paths, db, hasher, new_file_event, scan_concurrency)
     )
+    reconcile_task = asyncio.create_task(reconciler.run())
 
     # Wait until shutdown_event is set (via signal)
     await shutdown_event.wait()
     logger.info("Shutdown event received, cancelling tasks...")
+    await control_server.stop()
 
     # Cancel running tasks
+    scan_task.cancel()
+    reconcile_task.cancel()
+    coalescer_task.cancel()
+    drain_task.cancel()
+    for monitor_task in monitor_tasks:
+        monitor_task.cancel()
     watcher_task.cancel()
     uploader_task.cancel()
 
     # Wait for tasks to cancel gracefully
-    await asyncio.gather(watcher_task, uploader_task, return_exceptions=True)
+    await asyncio.gather(
+        scan_task,
+        reconcile_task,
+        coalescer_task,
+        drain_task,
+        *monitor_tasks,
+        watcher_task,
+        uploader_task,
+        return_exceptions=True,
+    )
+    await pool.stop()
+    for target in targets:
+        await target.immich.close()
+    await hasher.close()
 
     # Stop and join all observers.
     for observer in observers:
@@ -231,10 +553,114 @@ async def run():
         observer.join()
 
     await db.close()
+
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
     logger.info("Shutdown complete.")
 
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Upload new media files to an Immich server."
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="print the slowest imports of a cold start and exit",
+    )
+    parser.add_argument(
+        "--startup-budget",
+        type=float,
+        default=0,
+        metavar="MS",
+        help="with --profile-startup, exit with an error above this import time",
+    )
+
+    subparsers = parser.add_subparsers(dest="command")
+    ctl = subparsers.add_parser("ctl", help="control the running daemon")
+    ctl.add_argument(
+        "--socket",
+        help="control socket of the daemon, by default CONTROL_SOCKET from the "
+        "env file or the daemon's default",
+    )
+    ctl.add_argument("--json", action="store_true", help="print the raw response")
+
+    actions = ctl.add_subparsers(dest="action", required=True)
+    actions.add_parser("status", help="show uploads, pending files and network")
+    actions.add_parser("pause", help="stop uploading until resumed")
+    actions.add_parser("resume", help="resume uploading")
+    actions.add_parser(
+        "reconcile", help="compare the media paths with the database now"
+    )
+    upload = actions.add_parser("upload", help="upload a file right away")
+    upload.add_argument("path")
+    settings = actions.add_parser("set", help="change upload settings")
+    settings.add_argument("--concurrency", type=int, help="number of upload workers")
+    settings.add_argument(
+        "--bandwidth",
+        type=int,
+        metavar="KIB",
+        help="upload limit in KiB/s, 0 for unlimited",
+    )
+
+    return parser.parse_args()
+
+
+async def ctl(args: argparse.Namespace) -> int:
+    """Send a control command to the running daemon, returns the exit code."""
+    socket_path = args.socket
+    if not socket_path:
+        env_file = get_env_file()
+        env = dotenv_values(env_file) if os.path.exists(env_file) else {}
+        socket_path = env.get("CONTROL_SOCKET") or control.get_socket_path()
+
+    method, route, payload = "POST", f"/{args.action}", None
+    if args.action == "status":
+        method = "GET"
+    elif args.action == "upload":
+        payload = {"path": os.path.abspath(args.path)}
+    elif args.action == "set":
+        route = "/settings"
+        payload = {"concurrency": args.concurrency}
+        if args.bandwidth is not None:
+            payload["bandwidth"] = args.bandwidth * 1024
+
+    try:
+        response = await control.request(socket_path, method, route, payload)
+    except OSError as e:
+        print(f"Failed to connect to the daemon on {socket_path}: {e}")
+        return 1
+
+    if args.json or "error" in response:
+        print(json.dumps(response, indent=2))
+    elif args.action == "status":
+        print(control.format_status(response))
+    elif args.action == "upload":
+        print(f"{response['path']}: {response['status']}")
+    elif args.action == "set":
+        print(
+            f"{response['concurrency']} upload workers, "
+            f"bandwidth {control.format_rate(response['bandwidth'])}"
+        )
+    elif args.action == "reconcile":
+        print("Reconciling")
+    else:
+        print("Paused" if response["paused"] else "Resumed")
+
+    return 1 if "error" in response else 0
+
+
 def main():
+    args = parse_args()
+    if args.command == "ctl":
+        sys.exit(asyncio.run(ctl(args)))
+
+    if args.profile_startup:
+        if not profile_startup(__spec__.name, budget_ms=args.startup_budget):
+            sys.exit(1)
+        return
+
     uvloop.install()
     asyncio.run(run())
 
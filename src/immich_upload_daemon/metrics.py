@@ -0,0 +1,220 @@
+import bisect
+import time
+
+from loguru import logger
+
+PREFIX = "immich_upload_daemon"
+
+# Latency buckets in seconds, from a fast database commit to a large video
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    5,
+    10,
+    30,
+    60,
+    300,
+    1800,
+)
+
+
+class Counter:
+    def __init__(self, name: str, description: str) -> None:
+        self.name = f"{PREFIX}_{name}"
+        self.description = description
+        self.value: float = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+
+class Gauge:
+    def __init__(self, name: str, description: str) -> None:
+        self.name = f"{PREFIX}_{name}"
+        self.description = description
+        self.value: float = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.value}",
+        ]
+
+
+class Histogram:
+    def __init__(
+        self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS
+    ) -> None:
+        self.name = f"{PREFIX}_{name}"
+        self.description = description
+        self.buckets = buckets
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "Timer":
+        return Timer(self)
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Timer:
+    """Context manager observing the time spent in its block."""
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+        self.start: float = 0
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+bytes_uploaded = Counter("uploaded_bytes_total", "Bytes of media uploaded")
+files_uploaded = Counter("uploaded_files_total", "Media files uploaded")
+upload_throughput = Gauge(
+    "upload_throughput_bytes_per_second", "Throughput of the last upload"
+)
+upload_seconds = Histogram("upload_duration_seconds", "Time taken per file upload")
+hash_seconds = Histogram("hash_duration_seconds", "Time taken to hash a file")
+db_commit_seconds = Histogram(
+    "db_commit_duration_seconds", "Time taken to commit a batch of writes"
+)
+db_write_errors = Counter(
+    "db_write_errors_total", "Database writes lost because they failed"
+)
+watcher_queue_depth = Gauge("watcher_queue_depth", "Files waiting in the watcher queue")
+watcher_queue_high_water = Gauge(
+    "watcher_queue_high_water_mark", "Most files ever waiting in the watcher queue"
+)
+spilled_files = Counter(
+    "watcher_spilled_files_total",
+    "Files recorded in the database because the watcher queue was full",
+)
+pending_files = Gauge("pending_files", "Files waiting to be uploaded")
+file_index_bytes = Gauge(
+    "file_index_bytes", "Approximate memory used by the in-memory file index"
+)
+scan_seconds = Gauge("scan_duration_seconds", "Duration of the last scan")
+deduplicated_files = Counter(
+    "deduplicated_files_total",
+    "Files skipped because the same content was already uploaded",
+)
+retries = Counter("upload_retries_total", "Failed uploads scheduled for a retry")
+network_blocked_seconds = Counter(
+    "network_blocked_seconds_total",
+    "Time uploads spent waiting for network conditions",
+)
+reconcile_seconds = Gauge(
+    "reconcile_duration_seconds", "Duration of the last reconciliation pass"
+)
+reconcile_added = Counter(
+    "reconcile_added_files_total",
+    "New files found by reconciliation, missed by the watcher",
+)
+reconcile_changed = Counter(
+    "reconcile_changed_files_total",
+    "Changed files found by reconciliation, missed by the watcher",
+)
+reconcile_removed = Counter(
+    "reconcile_removed_files_total",
+    "Deleted files removed from the database by reconciliation",
+)
+
+METRICS = [
+    bytes_uploaded,
+    files_uploaded,
+    upload_throughput,
+    upload_seconds,
+    hash_seconds,
+    db_commit_seconds,
+    db_write_errors,
+    watcher_queue_depth,
+    watcher_queue_high_water,
+    spilled_files,
+    pending_files,
+    file_index_bytes,
+    scan_seconds,
+    deduplicated_files,
+    retries,
+    network_blocked_seconds,
+    reconcile_seconds,
+    reconcile_added,
+    reconcile_changed,
+    reconcile_removed,
+]
+
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+async def start_server(host: str, port: int, socket_path: str | None):
+    """
+    Serve the metrics in the Prometheus text format on a TCP port or Unix
+    socket. Returns the runner to clean up on shutdown.
+    """
+    # Only imported when the endpoint is enabled
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+
+    site: web.BaseSite
+    if socket_path:
+        site = web.UnixSite(runner, socket_path)
+        logger.info(f"Serving metrics on {socket_path}")
+    else:
+        site = web.TCPSite(runner, host, port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    await site.start()
+    return runner
@@ -1,19 +1,19 @@
-from sdbus import sd_bus_open_system, set_default_bus
-from sdbus_async.networkmanager import (
-    NetworkManager,
-    NetworkConnectionSettings,
-    ActiveConnection,
-    NetworkDeviceGeneric,
-)
-from sdbus_async.networkmanager.enums import DeviceType, DeviceMetered
+import asyncio
+import importlib.util
+
+from typing import Callable, Protocol
 
 from loguru import logger
 
-set_default_bus(sd_bus_open_system())
-nm = NetworkManager()
+# NetworkManager's NM_DEVICE_TYPE_WIFI and NM_METERED_YES, kept here so
+# evaluating conditions does not need the D-Bus bindings
+DEVICE_TYPE_WIFI = 2
+METERED_YES = 1
+
 
+async def get_device_types(nm) -> dict[str, int]:
+    from sdbus_async.networkmanager import NetworkDeviceGeneric
 
-async def get_device_types():
     device_types = {}
     devices_paths = await nm.get_devices()
     for device_path in devices_paths:
@@ -27,7 +27,11 @@ async def get_device_types():
     return device_types
 
 
-async def get_current_network_connection() -> dict[str, dict[str, tuple[str, any]]]:
+async def get_current_network_connection(
+    nm,
+) -> dict[str, dict[str, tuple[str, any]]]:
+    from sdbus_async.networkmanager import ActiveConnection, NetworkConnectionSettings
+
     connections_paths: list[str] = await nm.active_connections
 
     active_connections: list[ActiveConnection] = [
@@ -49,58 +53,242 @@ async def get_current_network_connection() -> dict[str, dict[str, tuple[str, any
         return network_settings
 
 
-async def check_network_conditions(
-    wifi_only: bool, ssid: str | None, not_metered: bool
+class NetworkState:
+    """Snapshot of the default network connection."""
+
+    def __init__(
+        self,
+        connected: bool = False,
+        metered: bool | None = None,
+        interface: str | None = None,
+        device_type: int | None = None,
+        ssid: str | None = None,
+    ) -> None:
+        self.connected = connected
+        self.metered = metered
+        self.interface = interface
+        self.device_type = device_type
+        self.ssid = ssid
+
+    def __repr__(self) -> str:
+        return (
+            f"NetworkState(connected={self.connected}, metered={self.metered}, "
+            f"interface={self.interface}, device_type={self.device_type}, "
+            f"ssid={self.ssid})"
+        )
+
+
+class NetworkProvider(Protocol):
+    """Source of network state, implemented by NetworkManager or a fake in tests."""
+
+    async def snapshot(self) -> NetworkState: ...
+
+    async def watch(self, on_change: Callable[[], None]) -> None:
+        """Call on_change whenever the network may have changed, runs forever."""
+        ...
+
+
+class NullNetworkProvider:
+    """Provider used when no condition needs the network state, always online."""
+
+    async def snapshot(self) -> NetworkState:
+        return NetworkState(connected=True)
+
+    async def watch(self, on_change: Callable[[], None]) -> None:
+        await asyncio.Event().wait()
+
+
+def has_networkmanager() -> bool:
+    """
+    Whether the D-Bus bindings NetworkManagerProvider uses are installed. They
+    come with the optional networkmanager extra.
+    """
+    try:
+        return importlib.util.find_spec("sdbus_async.networkmanager") is not None
+    except ImportError:
+        return False
+
+
+class NetworkManagerProvider:
+    """
+    Reads the network state from NetworkManager. The system bus is only
+    opened on first use, so the D-Bus bindings are not imported unless a
+    condition needs them.
+    """
+
+    def __init__(self) -> None:
+        self._nm = None
+
+    @property
+    def nm(self):
+        if self._nm is None:
+            from sdbus import sd_bus_open_system, set_default_bus
+            from sdbus_async.networkmanager import NetworkManager
+
+            set_default_bus(sd_bus_open_system())
+            self._nm = NetworkManager()
+
+        return self._nm
+
+    async def snapshot(self) -> NetworkState:
+        settings = await get_current_network_connection(self.nm)
+        if not settings:
+            return NetworkState()
+
+        connection = settings.get("connection", {})
+
+        metered = None
+        network_metered = connection.get("metered")
+        if network_metered:
+            metered = network_metered[1] == METERED_YES
+
+        interface = None
+        device_type = None
+        connection_device = connection.get("interface-name")
+        if connection_device:
+            interface = connection_device[1]
+            device_type = (await get_device_types(self.nm)).get(interface)
+
+        ssid = None
+        wireless_settings = settings.get("802-11-wireless")
+        if wireless_settings and wireless_settings.get("ssid"):
+            ssid = wireless_settings["ssid"][1].decode("utf-8")
+
+        return NetworkState(True, metered, interface, device_type, ssid)
+
+    async def watch(self, on_change: Callable[[], None]) -> None:
+        async def forward(signal) -> None:
+            async for _ in signal:
+                on_change()
+
+        await asyncio.gather(
+            forward(self.nm.properties_changed),
+            forward(self.nm.state_changed),
+        )
+
+
+def evaluate_conditions(
+    state: NetworkState, wifi_only: bool, ssid: str | None, not_metered: bool
 ) -> bool:
-    settings = await get_current_network_connection()
-    if not settings:
+    if not state.connected:
         logger.warning("Not on a network connection")
         return False
 
-    device_types = await get_device_types()
-    connection = settings.get("connection")
-
     if not_metered:
-        network_metered = connection.get("metered")
-        if not network_metered:
+        if state.metered is None:
             logger.warning("Failed to get network metering settings")
             return False
 
-        if network_metered[1] == DeviceMetered.YES:
+        if state.metered:
             logger.warning("Network is metered")
             return False
 
     if wifi_only:
-        connection_device = connection.get("interface-name")
-        if not connection_device:
+        if not state.interface:
             logger.warning("Failed to get network device")
             return False
 
-        connection_device_type = device_types.get(connection_device[1])
-        if not connection_device_type:
-            logger.warning(f"Failed to get {connection_device[1]} device type")
+        if not state.device_type:
+            logger.warning(f"Failed to get {state.interface} device type")
             return False
 
-        if connection_device_type != DeviceType.WIFI:
-            logger.warning(
-                f"{connection_device[1]} is type {connection_device_type} not WIFI"
-            )
+        if state.device_type != DEVICE_TYPE_WIFI:
+            logger.warning(f"{state.interface} is type {state.device_type} not WIFI")
             return False
 
         if ssid:
-            wireless_settings = settings.get("802-11-wireless")
-            if not wireless_settings:
-                logger.warning("Failed to get wireless settings")
-
-            wireless_settings_ssid = wireless_settings.get("ssid")
-            if not ssid:
+            if not state.ssid:
                 logger.warning("Failed to get SSID from wireless settings")
+                return False
 
-            wireless_settings_ssid_name = wireless_settings_ssid[1].decode("utf-8")
-            if wireless_settings_ssid_name != ssid:
-                logger.warning(
-                    f"SSID {wireless_settings_ssid_name} does not match {ssid}"
-                )
+            if state.ssid != ssid:
+                logger.warning(f"SSID {state.ssid} does not match {ssid}")
                 return False
 
     return True
+
+
+class NetworkMonitor:
+    """
+    Keeps a cached verdict of the upload conditions, refreshed when the
+    provider signals a change and as a fallback every poll_interval seconds.
+    The favorable and unfavorable events let uploads wait for, or be paused
+    by, a change in conditions without querying the network themselves.
+    """
+
+    def __init__(
+        self,
+        provider: NetworkProvider,
+        wifi_only: bool,
+        ssid: str | None,
+        not_metered: bool,
+        poll_interval: float = 60 * 10,
+        settle_delay: float = 1.0,
+    ) -> None:
+        self.provider = provider
+        self.wifi_only = wifi_only
+        self.ssid = ssid
+        self.not_metered = not_metered
+        self.poll_interval = poll_interval
+        self.settle_delay = settle_delay
+
+        self.state: NetworkState = NetworkState()
+        self.verdict: bool = False
+        self.favorable = asyncio.Event()
+        self.unfavorable = asyncio.Event()
+        self.unfavorable.set()
+
+        self._changed = asyncio.Event()
+
+    async def refresh(self) -> bool:
+        try:
+            state = await self.provider.snapshot()
+        except Exception as e:
+            logger.error(f"Failed to get network state: {e}")
+            state = NetworkState()
+
+        verdict = evaluate_conditions(
+            state, self.wifi_only, self.ssid, self.not_metered
+        )
+        if verdict != self.verdict:
+            logger.info(
+                f"Network conditions are now {'favorable' if verdict else 'unfavorable'}"
+            )
+
+        self.state = state
+        self.verdict = verdict
+        if verdict:
+            self.unfavorable.clear()
+            self.favorable.set()
+        else:
+            self.favorable.clear()
+            self.unfavorable.set()
+
+        return verdict
+
+    async def run(self) -> None:
+        watch_task = asyncio.create_task(self._watch())
+        try:
+            while True:
+                await self.refresh()
+
+                try:
+                    await asyncio.wait_for(self._changed.wait(), self.poll_interval)
+                except TimeoutError:
+                    pass
+
+                # Signals arrive in bursts while a connection is coming up
+                await asyncio.sleep(self.settle_delay)
+                self._changed.clear()
+
+        finally:
+            watch_task.cancel()
+
+    async def _watch(self) -> None:
+        try:
+            await self.provider.watch(self._changed.set)
+        except Exception as e:
+            logger.warning(
+                f"Network change signals unavailable, rechecking every "
+                f"{self.poll_interval} seconds: {e}"
+            )
@@ -0,0 +1,381 @@
+import asyncio
+import errno
+import hashlib
+import os
+import select
+import threading
+import time
+
+from typing import AsyncIterator
+
+from aiohttp.abc import AbstractStreamWriter
+from aiohttp.payload import Payload
+
+from .throttle import Bandwidth
+
+# Largest read when the connection keeps up
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Aim for reads that take about this long to send, in seconds
+TARGET_CHUNK_TIME = 0.1
+
+# How often sendfile checks whether the socket can take more data, and how
+# long it waits for that before giving up on the connection
+SENDFILE_POLL_INTERVAL = 0.01
+SENDFILE_TIMEOUT = 60
+
+# Smallest read of a file sent to several targets, and how many chunks the
+# fastest upload may get ahead of the slowest
+SHARED_CHUNK_SIZE = 1024 * 1024
+SHARED_WINDOW = 4
+
+
+class Transfer:
+    """Progress of a single upload, shown by the control socket."""
+
+    def __init__(self, file_path: str, size: int) -> None:
+        self.file_path = file_path
+        self.size = size
+        self.sent: int = 0
+        self.started: float = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        """Average bytes per second sent so far."""
+        elapsed = time.monotonic() - self.started
+        return self.sent / elapsed if elapsed > 0 else 0
+
+
+class BodyChecksum:
+    """
+    SHA-1 checksum Immich identifies assets by, computed from an upload body
+    as it is read so the file does not have to be read again for it. size
+    tells whether the whole file went through it.
+    """
+
+    def __init__(self) -> None:
+        self.sha1 = hashlib.sha1()
+        self.size: int = 0
+
+    def update(self, chunk: bytes) -> None:
+        self.sha1.update(chunk)
+        self.size += len(chunk)
+
+    def digest(self) -> bytes:
+        return self.sha1.digest()
+
+
+def _read_chunk(f, size: int, checksum: BodyChecksum | None) -> bytes:
+    # Runs in the thread pool, hashlib releases the GIL for large chunks
+    chunk = f.read(size)
+    if checksum is not None:
+        checksum.update(chunk)
+
+    return chunk
+
+
+def _hash_range(fd: int, offset: int, count: int, checksum: BodyChecksum) -> None:
+    checksum.update(os.pread(fd, count, offset))
+
+
+def _sendfile_range(
+    sock_fd: int, file_fd: int, offset: int, count: int, cancelled: threading.Event
+) -> None:
+    """
+    Send a range of a file on a non-blocking socket, waiting while its buffer
+    is full. Runs in the thread pool so the event loop is not blocked. Takes
+    ownership of sock_fd, a duplicate that stays valid even if the transport
+    closes the socket meanwhile.
+    """
+    try:
+        waited = 0
+        while count and not cancelled.is_set():
+            try:
+                sent = os.sendfile(sock_fd, file_fd, offset, count)
+            except BlockingIOError:
+                _, writable, _ = select.select([], [sock_fd], [], 1)
+                waited = 0 if writable else waited + 1
+                if waited >= SENDFILE_TIMEOUT:
+                    raise TimeoutError("Timed out sending the file")
+                continue
+
+            if not sent:
+                raise EOFError("File was truncated while uploading")
+            offset += sent
+            count -= sent
+
+    finally:
+        os.close(sock_fd)
+
+
+class FilePayload(Payload):
+    """
+    Upload body streamed straight from the file. On plain HTTP connections the
+    kernel sends the file with sendfile without it passing through Python,
+    otherwise the file is read in chunks sized to the measured throughput so a
+    fast link needs few thread pool round trips and a slow one stays responsive.
+    Either way the file goes out in pieces so the shared bandwidth limit can be
+    applied and the progress recorded in transfer.
+
+    A checksum is computed from the chunks read, or from the page cache for
+    ranges sent with sendfile, so the file is still only read from disk once.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        size: int,
+        min_chunk_size: int,
+        max_chunk_size: int = MAX_CHUNK_SIZE,
+        transfer: Transfer | None = None,
+        bandwidth: Bandwidth | None = None,
+        checksum: BodyChecksum | None = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(file_path, **kwargs)
+        # Known up front so the request is sent with a Content-Length instead
+        # of chunked encoding, which sendfile can not be combined with
+        self._size = size
+        self.file_path = file_path
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max(min_chunk_size, max_chunk_size)
+        self.transfer = transfer or Transfer(file_path, size)
+        self.bandwidth = bandwidth or Bandwidth()
+        self.checksum = checksum
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        raise TypeError("File payloads can not be decoded")
+
+    async def write(self, writer: AbstractStreamWriter) -> None:
+        # Opening can block on slow or network storage
+        f = await asyncio.to_thread(open, self.file_path, "rb", buffering=0)
+        with f:
+            if not await self._sendfile(writer, f):
+                await self._write_chunks(writer, f)
+
+    async def _sendfile(self, writer: AbstractStreamWriter, f) -> bool:
+        """Send the file with sendfile, returns False when it is not possible."""
+        loop = asyncio.get_running_loop()
+        transport = getattr(writer, "transport", None)
+        sock = transport.get_extra_info("socket") if transport is not None else None
+
+        # TLS, chunked or compressed bodies have to go through Python
+        if (
+            sock is None
+            or transport.get_extra_info("sslcontext") is not None
+            or getattr(writer, "chunked", False)
+            or getattr(writer, "_compress", None) is not None
+            or not hasattr(os, "sendfile")
+        ):
+            return False
+
+        # Written around the transport, which has to have sent everything
+        # queued before, like the multipart headers. loop.sendfile would do
+        # this, but uvloop does not implement it.
+        while transport.get_write_buffer_size():
+            if transport.is_closing():
+                raise ConnectionResetError("Connection closed while uploading")
+            await asyncio.sleep(SENDFILE_POLL_INTERVAL)
+
+        cancelled = threading.Event()
+        try:
+            offset = 0
+            hashed = 0
+            while offset < self.size:
+                count = min(self._slice_size(), self.size - offset)
+                await self.bandwidth.acquire(count)
+
+                # The previous range is hashed while the kernel sends this one
+                hashing = asyncio.ensure_future(
+                    self._hash_range(f, hashed, offset - hashed)
+                )
+                try:
+                    await loop.run_in_executor(
+                        None,
+                        _sendfile_range,
+                        os.dup(sock.fileno()),
+                        f.fileno(),
+                        offset,
+                        count,
+                        cancelled,
+                    )
+                except OSError as e:
+                    # Files on file systems without sendfile support fail
+                    # before anything is sent
+                    if offset or e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    return False
+                finally:
+                    await hashing
+
+                hashed = offset
+                offset += count
+                self.transfer.sent = offset
+
+            await self._hash_range(f, hashed, offset - hashed)
+            return True
+
+        finally:
+            # Stops a range still being sent when the upload is cancelled
+            cancelled.set()
+
+    async def _hash_range(self, f, offset: int, count: int) -> None:
+        """Add a range already sent with sendfile to the checksum."""
+        if self.checksum is None or not count:
+            return
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, _hash_range, f.fileno(), offset, count, self.checksum
+        )
+
+    def _slice_size(self) -> int:
+        """Bytes handed to sendfile at a time, about TARGET_CHUNK_TIME worth."""
+        if not self.bandwidth.rate:
+            return self.max_chunk_size
+
+        size = int(self.bandwidth.rate * TARGET_CHUNK_TIME)
+        return min(max(size, self.min_chunk_size), self.max_chunk_size)
+
+    async def _write_chunks(self, writer: AbstractStreamWriter, f) -> None:
+        loop = asyncio.get_running_loop()
+        chunk_size = self.min_chunk_size
+
+        while True:
+            start = time.perf_counter()
+            chunk = await loop.run_in_executor(
+                None, _read_chunk, f, chunk_size, self.checksum
+            )
+            if not chunk:
+                break
+
+            await self.bandwidth.acquire(len(chunk))
+            await writer.write(chunk)
+            self.transfer.sent += len(chunk)
+
+            # Grow reads while they are sent quickly, shrink them when slow
+            elapsed = time.perf_counter() - start
+            if elapsed < TARGET_CHUNK_TIME / 2:
+                chunk_size = min(chunk_size * 2, self.max_chunk_size)
+            elif elapsed > TARGET_CHUNK_TIME * 2:
+                chunk_size = max(chunk_size // 2, self.min_chunk_size)
+
+
+class SharedFile:
+    """
+    Reads a file once for uploads of it to several targets. Every upload gets
+    the chunks through its own reader, the file is read as far ahead as the
+    slowest upload allows within SHARED_WINDOW chunks. Readers are created up
+    front and closed when their upload ends, also when it never started.
+    Chunks are hashed into checksum once as they are read.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        chunk_size: int = SHARED_CHUNK_SIZE,
+        window: int = SHARED_WINDOW,
+        checksum: BodyChecksum | None = None,
+    ) -> None:
+        self.file_path = file_path
+        self.chunk_size = max(chunk_size, SHARED_CHUNK_SIZE)
+        self.window = window
+        self.checksum = checksum
+
+        self.queues: dict[int, asyncio.Queue[bytes | None]] = {}
+        self.task: asyncio.Task | None = None
+        self.error: BaseException | None = None
+
+    def reader(self) -> "SharedReader":
+        if self.task is not None:
+            raise RuntimeError("Readers must be created before reading starts")
+
+        consumer = len(self.queues)
+        self.queues[consumer] = asyncio.Queue(self.window)
+        return SharedReader(self, consumer)
+
+    async def chunks(self, consumer: int) -> AsyncIterator[bytes]:
+        if self.task is None:
+            self.task = asyncio.create_task(self._read())
+
+        queue = self.queues[consumer]
+        while chunk := await queue.get():
+            yield chunk
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self, consumer: int) -> None:
+        queue = self.queues.pop(consumer, None)
+        if queue is None:
+            return
+
+        # Let the reader move on if it is waiting for this upload
+        while not queue.empty():
+            queue.get_nowait()
+
+        if not self.queues and self.task is not None:
+            self.task.cancel()
+
+    async def _read(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            f = await asyncio.to_thread(open, self.file_path, "rb", buffering=0)
+            with f:
+                while True:
+                    chunk = await loop.run_in_executor(
+                        None, _read_chunk, f, self.chunk_size, self.checksum
+                    )
+                    for queue in list(self.queues.values()):
+                        await queue.put(chunk)
+                    if not chunk:
+                        return
+
+        except Exception as e:
+            # Wakes every upload, which raise the error
+            self.error = e
+            for queue in self.queues.values():
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+
+class SharedReader:
+    """One upload's view of a SharedFile."""
+
+    def __init__(self, shared: SharedFile, consumer: int) -> None:
+        self.shared = shared
+        self.consumer = consumer
+
+    def chunks(self) -> AsyncIterator[bytes]:
+        return self.shared.chunks(self.consumer)
+
+    def close(self) -> None:
+        self.shared.close(self.consumer)
+
+
+class SharedFilePayload(Payload):
+    """Upload body taking its chunks from a file shared with other uploads."""
+
+    def __init__(
+        self,
+        reader: SharedReader,
+        size: int,
+        transfer: Transfer | None = None,
+        bandwidth: Bandwidth | None = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(reader, **kwargs)
+        self._size = size
+        self.reader = reader
+        self.transfer = transfer or Transfer(reader.shared.file_path, size)
+        self.bandwidth = bandwidth or Bandwidth()
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        raise TypeError("File payloads can not be decoded")
+
+    async def write(self, writer: AbstractStreamWriter) -> None:
+        async for chunk in self.reader.chunks():
+            await self.bandwidth.acquire(len(chunk))
+            await writer.write(chunk)
+            self.transfer.sent += len(chunk)
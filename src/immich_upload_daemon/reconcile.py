@@ -0,0 +1,247 @@
+import asyncio
+import os
+import stat
+import time
+
+from loguru import logger
+
+from . import metrics
+from .database import Database
+from .files import list_directory
+from .hasher import Hasher
+
+
+class ReconcilePass:
+    """Files checked and drift found by one pass of the reconciler."""
+
+    def __init__(self, reason: str) -> None:
+        self.reason = reason
+        self.started_at: float = time.time()
+        self.seconds: float = 0
+        self.files: int = 0
+        self.directories: int = 0
+
+        # Changes the watcher did not report
+        self.added: int = 0
+        self.changed: int = 0
+        self.removed: int = 0
+
+    @property
+    def drift(self) -> int:
+        return self.added + self.changed + self.removed
+
+    def as_dict(self) -> dict:
+        return {
+            "reason": self.reason,
+            "started_at": self.started_at,
+            "seconds": self.seconds,
+            "files": self.files,
+            "directories": self.directories,
+            "added": self.added,
+            "changed": self.changed,
+            "removed": self.removed,
+        }
+
+
+class Reconciler:
+    """
+    Walks the media paths in the background to catch what the watcher
+    misses: events dropped when the inotify queue overflows, directories it
+    can not watch once max_user_watches is reached and deleted files, which
+    it does not follow at all. Watchdog drops overflows without reporting
+    them, so a pass is triggered once the watcher caught up with a burst
+    large enough to spill its queue, the kind of burst that overflows it.
+
+    Each directory is compared with its rows in the database by stat only.
+    New and changed files go to the hasher, rows of files that are gone are
+    removed once the hasher caught up, so a moved file is recognized as a
+    copy of uploaded content first, and so are directories left empty. Directories are listed one at a time
+    at up to rate entries per second so a pass does not compete with
+    uploads for the disk.
+
+    A pass runs every interval seconds, 0 for only on request, and when
+    trigger() is called.
+    """
+
+    def __init__(
+        self,
+        paths: list[str],
+        db: Database,
+        hasher: Hasher,
+        interval: float,
+        rate: int = 0,
+        settle: float = 2.0,
+    ) -> None:
+        # Paths as the database stores them, without trailing separators
+        self.paths = [os.path.normpath(path) for path in paths]
+        self.db = db
+        self.hasher = hasher
+        self.interval = interval
+        self.rate = max(0, rate)
+
+        # Files modified this recently may still be written, the watcher or
+        # the next pass picks them up
+        self.settle = settle
+
+        self.wake = asyncio.Event()
+        self.reason = "scheduled"
+        self.current: ReconcilePass | None = None
+        self.last: ReconcilePass | None = None
+
+    def trigger(self, reason: str) -> None:
+        """Start a pass as soon as possible."""
+        if not self.wake.is_set():
+            logger.info(f"Reconciling media paths: {reason}")
+            self.reason = reason
+            self.wake.set()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                async with asyncio.timeout(self.interval or None):
+                    await self.wake.wait()
+            except TimeoutError:
+                pass
+
+            reason, self.reason = self.reason, "scheduled"
+            self.wake.clear()
+            try:
+                await self.reconcile(reason)
+            except Exception as e:
+                logger.error(f"Failed to reconcile media paths: {e}")
+
+    async def reconcile(self, reason: str = "requested") -> ReconcilePass:
+        """Walk every media path once and apply the drift found."""
+        result = self.current = ReconcilePass(reason)
+        start = time.perf_counter()
+        try:
+            for root in self.paths:
+                await self._reconcile_root(root, result)
+        finally:
+            self.current = None
+
+        result.seconds = time.perf_counter() - start
+        self.last = result
+        metrics.reconcile_seconds.set(result.seconds)
+        metrics.reconcile_added.inc(result.added)
+        metrics.reconcile_changed.inc(result.changed)
+        metrics.reconcile_removed.inc(result.removed)
+        logger.info(
+            f"Reconciled {result.files} files in {result.directories} "
+            f"directories in {result.seconds:.1f}s: {result.added} added, "
+            f"{result.changed} changed, {result.removed} removed"
+        )
+        return result
+
+    async def _submit(self, file_name: str, stats: os.stat_result) -> bool:
+        """Hand a file the watcher missed to the hasher, unless it is not done."""
+        # Already on its way into the database or possibly still being written
+        if (
+            file_name in self.hasher.pending
+            or stats.st_mtime > time.time() - self.settle
+        ):
+            return False
+
+        logger.debug(f"Reconciling {file_name}")
+        await self.hasher.submit(file_name, stats)
+        return True
+
+    def _keep(
+        self, directory: str, gone: list[str], reason: str, unmounted: list[str]
+    ) -> None:
+        """Keep the rows at and below a directory that may not be mounted."""
+        logger.warning(
+            f"Not removing {len(gone)} files in {directory} or below, it "
+            f"{reason} and may not be mounted"
+        )
+        unmounted.append(directory)
+
+    async def _reconcile_root(self, root: str, result: ReconcilePass) -> None:
+        try:
+            root_stat = await asyncio.to_thread(os.stat, root)
+        except OSError:
+            root_stat = None
+        if root_stat is None or not stat.S_ISDIR(root_stat.st_mode):
+            logger.warning(f"Not reconciling {root}, it is not a directory")
+            return
+
+        visited: set[str] = set()
+        failed: list[str] = []
+        unmounted: list[str] = []
+        removed: list[str] = []
+        entries = 0
+
+        # Directories to list with the device they are on
+        directories = [(root, root_stat.st_dev)]
+        while directories:
+            directory, device = directories.pop()
+            try:
+                files, subdirs = await asyncio.to_thread(list_directory, directory)
+            except OSError as e:
+                # Rows below it are kept, it may only be unreadable for now
+                logger.warning(f"Failed to reconcile {directory}: {e}")
+                failed.append(directory)
+                continue
+
+            visited.add(directory)
+            directories.extend(subdirs)
+            result.directories += 1
+            result.files += len(files)
+            if directory == root:
+                entries = len(files) + len(subdirs)
+
+            added, changed, gone = await self.db.diff_directory(directory, files)
+            for file_name, stats in added:
+                result.added += await self._submit(file_name, stats)
+            for file_name, stats in changed:
+                result.changed += await self._submit(file_name, stats)
+
+            # A mount point that is empty or back on the device it is mounted
+            # on looks like every file below it was deleted
+            if gone and not (files or subdirs):
+                self._keep(directory, gone, "is empty", unmounted)
+            elif (
+                gone
+                and (devices := await self.db.devices_of(directory))
+                and device not in devices
+            ):
+                self._keep(directory, gone, "is on another device", unmounted)
+            else:
+                removed.extend(gone)
+
+            if self.rate:
+                await asyncio.sleep((len(files) + len(subdirs) + 1) / self.rate)
+
+        # Directories that are no longer there at all
+        for directory in await self.db.directories_under(root):
+            if directory in visited or any(
+                os.path.commonpath((directory, path)) == path
+                for path in failed + unmounted
+            ):
+                continue
+
+            _, _, gone = await self.db.diff_directory(directory, [])
+            removed.extend(gone)
+
+        if removed:
+            # An empty mount point looks like every file was deleted
+            if not entries:
+                logger.warning(
+                    f"Not removing {len(removed)} files below {root}, it is "
+                    "empty and may not be mounted"
+                )
+                return
+
+            # Renamed files are hashed and deduplicated against their old row
+            # before it is removed, and files that came back are kept
+            await self.hasher.join()
+            gone = await asyncio.to_thread(
+                lambda: [path for path in removed if not os.path.lexists(path)]
+            )
+            for file_name in gone:
+                await self.db.remove_media(file_name)
+            result.removed += len(gone)
+
+        # Rows of directories all media was removed from
+        if count := await self.db.remove_empty_directories(root):
+            logger.debug(f"Removed {count} empty directories below {root}")
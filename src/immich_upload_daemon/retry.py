@@ -0,0 +1,58 @@
+import asyncio
+import random
+import time
+
+from loguru import logger
+
+
+def backoff_delay(attempts: int, base_delay: float, max_delay: float) -> float:
+    """Exponential backoff with jitter, between half and all of the full delay."""
+    delay = min(max_delay, base_delay * 2 ** max(0, attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class CircuitBreaker:
+    """
+    Stops every upload for a while once the server keeps failing, instead of
+    letting each pending file find that out on its own. The pause grows with
+    each further failure and is lifted by the first successful upload.
+    """
+
+    def __init__(
+        self, threshold: int = 3, base_delay: float = 30, max_delay: float = 60 * 30
+    ) -> None:
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.failures: int = 0
+        self.retry_at: float = 0
+
+    @property
+    def is_open(self) -> bool:
+        return time.time() < self.retry_at
+
+    def record_success(self) -> None:
+        if self.failures >= self.threshold:
+            logger.info("Server is reachable again, resuming uploads")
+
+        self.failures = 0
+        self.retry_at = 0
+
+    def record_failure(self) -> float:
+        """Count a server-wide failure, returns when the file may be retried."""
+        self.failures += 1
+        if self.failures < self.threshold:
+            return time.time() + self.base_delay
+
+        delay = backoff_delay(
+            self.failures - self.threshold + 1, self.base_delay, self.max_delay
+        )
+        self.retry_at = time.time() + delay
+        logger.warning(f"Server is failing, pausing uploads for {delay:.0f}s")
+        return self.retry_at
+
+    async def wait(self) -> None:
+        delay = self.retry_at - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
@@ -0,0 +1,84 @@
+# Media classes, stored in media.kind
+PHOTO = 0
+VIDEO = 1
+
+# Video formats supported by Immich, part of the media extensions in files
+VIDEO_EXTENSIONS = (
+    ".3gp",
+    ".3gpp",
+    ".avi",
+    ".flv",
+    ".m4v",
+    ".mkv",
+    ".mts",
+    ".m2ts",
+    ".m2t",
+    ".mp4",
+    ".insv",
+    ".mpg",
+    ".mpe",
+    ".mpeg",
+    ".mov",
+    ".webm",
+    ".wmv",
+)
+
+# Sort keys of the upload orders, every key stays below 2**62 so photos can
+# be put before videos by adding KIND_WEIGHT to the key of videos
+KIND_WEIGHT = 2**62
+ORDER_KEYS = {
+    "discovered": "rowid",
+    "newest": "-IFNULL(mtime_ns, 0)",
+    "oldest": "IFNULL(mtime_ns, 0)",
+    "smallest": "IFNULL(size, 0)",
+}
+
+
+def media_kind(file_name: str) -> int:
+    return VIDEO if file_name.lower().endswith(VIDEO_EXTENSIONS) else PHOTO
+
+
+class UploadOrder:
+    """
+    Order in which pending media is uploaded, parsed from a comma-separated
+    list of policies: one of discovered, newest, oldest or smallest, optionally
+    preceded by type to upload photos before videos. Ties are broken by the
+    order the files were discovered in.
+
+    The order is a single integer expression over the media table with a
+    partial index on the pending rows, so the next page of uploads is found
+    with an index seek however large the backlog is.
+    """
+
+    def __init__(self, policies: str = "newest") -> None:
+        names = [name.strip().lower() for name in policies.split(",") if name.strip()]
+        self.by_type = bool(names) and names[0] == "type"
+        if self.by_type:
+            names = names[1:]
+
+        if len(names) > 1 or (names and names[0] not in ORDER_KEYS):
+            raise ValueError(
+                f"Invalid upload order {policies}, expected one of "
+                f"{', '.join(ORDER_KEYS)}, optionally preceded by type"
+            )
+
+        self.policy = names[0] if names else "discovered"
+        self.name = f"{'type,' if self.by_type else ''}{self.policy}"
+
+        # Ties are broken by rowid anyway, which can not be part of an index
+        key = ORDER_KEYS[self.policy]
+        if self.by_type:
+            kind = f"IFNULL(kind, {PHOTO}) * {KIND_WEIGHT}"
+            key = kind if key == "rowid" else f"{kind} + {key}"
+        self.key = f"({key})" if key != "rowid" else key
+
+    @property
+    def index_name(self) -> str | None:
+        """Name of the index the order needs, None when rowid order is enough."""
+        if self.key == "rowid":
+            return None
+
+        return f"idx_order_{self.name.replace(',', '_')}"
+
+    def __repr__(self) -> str:
+        return f"UploadOrder({self.name})"
@@ -0,0 +1,56 @@
+import subprocess
+import sys
+import time
+
+
+def import_profile(module: str) -> tuple[float, list[tuple[int, int, str]]]:
+    """
+    Import module in a fresh interpreter with -X importtime. Returns the wall
+    time of the whole interpreter run in seconds and the (self, cumulative,
+    name) import times in microseconds.
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall_time = time.perf_counter() - start
+
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        try:
+            entries.append((int(self_us), int(cumulative_us), name.strip()))
+        except ValueError:
+            # Column headers
+            continue
+
+    return wall_time, entries
+
+
+def profile_startup(module: str, top: int = 20, budget_ms: float = 0) -> bool:
+    """
+    Print the slowest imports of a cold start, returns False when the import
+    of module takes longer than budget_ms.
+    """
+    wall_time, entries = import_profile(module)
+    total_us = next((c for _, c, name in entries if name == module), 0)
+
+    print(f"Interpreter start and import: {wall_time * 1000:.1f} ms")
+    print(f"Import of {module}: {total_us / 1000:.1f} ms")
+    print()
+    print(f"{'self ms':>9} {'total ms':>9}  module")
+    slowest = sorted(entries, key=lambda entry: entry[1], reverse=True)
+    for self_us, cumulative_us, name in slowest[:top]:
+        print(f"{self_us / 1000:>9.1f} {cumulative_us / 1000:>9.1f}  {name}")
+
+    if budget_ms and total_us / 1000 > budget_ms:
+        print(f"\nImport time is over the budget of {budget_ms:.0f} ms")
+        return False
+
+    return True
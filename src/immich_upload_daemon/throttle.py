@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+
+class Bandwidth:
+    """
+    Token bucket shared by every upload so their combined rate stays under
+    rate bytes per second, 0 meaning unlimited. The rate can be changed while
+    uploads are running. Up to burst seconds worth of unused rate is saved up.
+    """
+
+    def __init__(self, rate: int = 0, burst: float = 1.0) -> None:
+        self.rate: int = max(0, rate)
+        self.burst = burst
+
+        self.tokens: float = 0
+        self.updated: float = time.monotonic()
+        # Uploads take turns so one can not starve the others
+        self.lock = asyncio.Lock()
+
+    def set_rate(self, rate: int) -> None:
+        self.rate = max(0, rate)
+        self.tokens = min(self.tokens, self.rate * self.burst)
+
+    async def acquire(self, amount: int) -> None:
+        """Wait until amount bytes may be sent."""
+        if not self.rate:
+            return
+
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate * self.burst,
+                self.tokens + (now - self.updated) * self.rate,
+            )
+            self.updated = now
+
+            # Go into debt and sleep it off, so chunks larger than the bucket
+            # are still sent
+            self.tokens -= amount
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
@@ -0,0 +1,563 @@
+import asyncio
+import contextlib
+import os
+import time
+
+from loguru import logger
+
+from . import metrics
+from .database import Database
+from .hasher import checksum_file
+from .immich import Immich, UploadError
+from .network import NetworkMonitor
+from .payload import BodyChecksum, SharedFile
+from .retry import CircuitBreaker, backoff_delay
+from .schedule import PHOTO, VIDEO, media_kind
+
+
+class Target:
+    """
+    Immich server or account that media is uploaded to, with its own upload
+    conditions and circuit breaker. Videos can have stricter conditions than
+    photos, watched by video_monitor.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        immich: Immich,
+        monitor: NetworkMonitor,
+        video_monitor: NetworkMonitor | None = None,
+    ) -> None:
+        self.name = name
+        self.immich = immich
+        self.monitor = monitor
+        self.video_monitor = video_monitor
+        self.breaker = CircuitBreaker()
+
+    @property
+    def monitors(self) -> list[NetworkMonitor]:
+        return [self.monitor] + ([self.video_monitor] if self.video_monitor else [])
+
+    def monitor_for(self, kind: int) -> NetworkMonitor:
+        """Monitor of the upload conditions of a class of media."""
+        if kind == VIDEO and self.video_monitor is not None:
+            return self.video_monitor
+
+        return self.monitor
+
+    def ready(self, kind: int = PHOTO) -> bool:
+        """Whether uploads of a class of media to the target are allowed now."""
+        return self.monitor_for(kind).verdict and not self.breaker.is_open
+
+    async def wait_ready(self, kind: int = PHOTO) -> None:
+        while not self.ready(kind):
+            await self.monitor_for(kind).favorable.wait()
+            await self.breaker.wait()
+
+
+async def check_existing_assets(
+    db: Database, targets: list[Target], batch_size: int
+) -> int:
+    """
+    Checksum pending media in batches and ask the servers which of them they
+    already have. Those are marked uploaded without transferring any data.
+    Returns the number of uploads skipped.
+
+    Only as many files as were pending when called are checked, so files
+    still being added by a running scan do not hold back the uploads.
+    """
+    skipped = 0
+    remaining = await db.count_unuploaded()
+    while remaining > 0:
+        checking = [
+            target
+            for target in targets
+            if target.immich.bulk_check_supported and target.monitor.verdict
+        ]
+        if not checking:
+            break
+
+        file_names = await db.get_unchecked(min(batch_size, remaining))
+        if not file_names:
+            break
+
+        remaining -= len(file_names)
+
+        checksums = {}
+        stats = {}
+        for file_name in file_names:
+            try:
+                stats[file_name] = await asyncio.to_thread(os.stat, file_name)
+                checksums[file_name] = await asyncio.to_thread(checksum_file, file_name)
+            except FileNotFoundError:
+                await db.remove_media(file_name)
+            except OSError as e:
+                # Left to the upload, which retries it with a backoff, instead
+                # of reading it again on every pass
+                logger.error(f"Failed to checksum {file_name}: {e}")
+                db.skip_precheck(file_name)
+
+        if not checksums:
+            continue
+
+        results = await asyncio.gather(
+            *(target.immich.bulk_upload_check(checksums) for target in checking)
+        )
+        if all(duplicates is None for duplicates in results):
+            break
+
+        for file_name, checksum in checksums.items():
+            await db.set_checksum(file_name, checksum, stats[file_name])
+
+        marks = []
+        for target, duplicates in zip(checking, results):
+            for file_name, asset_id in (duplicates or {}).items():
+                logger.info(
+                    f"{os.path.basename(file_name)} already on {target.name} "
+                    f"as {asset_id}"
+                )
+                marks.append(db.mark_uploaded(file_name, target.name))
+
+        # Marked together so they are committed in the same batch
+        await asyncio.gather(*marks)
+        skipped += len(marks)
+
+    return skipped
+
+
+class UploadWorker:
+    """State of a single upload worker, kept for logging and introspection."""
+
+    def __init__(self, worker_id: int) -> None:
+        self.worker_id: int = worker_id
+        self.current_file: str | None = None
+        self.uploaded: int = 0
+        self.failed: int = 0
+
+        # Set when the pool shrinks, the worker stops after its current file
+        self.retired: bool = False
+        self.task: asyncio.Task | None = None
+
+
+class UploadPool:
+    """
+    Bounded pool of upload workers pulling from a shared work queue, lowest
+    priority first. A file is only ever handed to one worker at a time, files
+    that are already queued or uploading are ignored by submit().
+    Files submitted with submit_now() go ahead of all others.
+
+    Uploads can be paused and the number of workers changed at runtime, up to
+    max_concurrency.
+
+    A file due on several targets is read once and sent to all of those that
+    are ready at the same time, the others get it on a later pass.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        targets: list[Target],
+        concurrency: int,
+        shutdown_event: asyncio.Event,
+        retry_base_delay: float = 60,
+        retry_max_delay: float = 60 * 60 * 6,
+        max_concurrency: int = 0,
+    ) -> None:
+        self.db = db
+        self.targets = targets
+        self.concurrency = max(1, concurrency)
+        self.max_concurrency = max(self.concurrency, max_concurrency)
+        self.shutdown_event = shutdown_event
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+
+        # Queued as (bounded, priority, file name). Files submitted by
+        # producers take room, so they only stay a little ahead of the
+        # workers, files submitted now do not and sort before them.
+        self.queue: asyncio.PriorityQueue[tuple[bool, tuple, str]] = (
+            asyncio.PriorityQueue()
+        )
+        self.room = asyncio.Semaphore(self.concurrency * 2)
+        self.in_flight: set[str] = set()
+        self.workers: list[UploadWorker] = []
+        self.next_worker_id: int = 0
+        self.mark_tasks: set[asyncio.Task] = set()
+
+        # Cleared while paused, pausing also interrupts running uploads
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.pause_requested = asyncio.Event()
+
+        # Uploads waiting for network conditions, the time any of them waits
+        # is counted once however many there are
+        self.blocked_waiters: int = 0
+        self.blocked_since: float = 0.0
+
+    @property
+    def paused(self) -> bool:
+        return not self.resumed.is_set()
+
+    @contextlib.contextmanager
+    def blocked(self):
+        """Count the time spent in the block as blocked by network conditions."""
+        if self.blocked_waiters == 0:
+            self.blocked_since = time.monotonic()
+        self.blocked_waiters += 1
+        try:
+            yield
+        finally:
+            self.blocked_waiters -= 1
+            if self.blocked_waiters == 0:
+                metrics.network_blocked_seconds.inc(
+                    time.monotonic() - self.blocked_since
+                )
+
+    def start(self) -> None:
+        for _ in range(self.concurrency):
+            self._start_worker()
+
+        logger.info(f"Started {self.concurrency} upload workers")
+
+    async def stop(self) -> None:
+        tasks = [worker.task for worker in self.workers if worker.task]
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Let finished uploads be recorded before the database is closed
+        await asyncio.gather(*self.mark_tasks, return_exceptions=True)
+
+    async def submit(self, file_name: str, priority: tuple = ()) -> bool:
+        """
+        Queue a file for upload unless it is already queued or uploading,
+        waiting while the queue is full. Files with a lower priority are
+        handed out first, the empty default goes before all others.
+        """
+        if file_name in self.in_flight:
+            return False
+
+        self.in_flight.add(file_name)
+        await self.room.acquire()
+        self.queue.put_nowait((True, priority, file_name))
+        return True
+
+    def submit_now(self, file_name: str) -> bool:
+        """
+        Queue a file ahead of every other, even while the queue is full,
+        unless it is already queued or uploading.
+        """
+        if file_name in self.in_flight:
+            return False
+
+        self.in_flight.add(file_name)
+        self.queue.put_nowait((False, (), file_name))
+        return True
+
+    async def join(self) -> None:
+        """Wait until every submitted file has been handled by a worker."""
+        await self.queue.join()
+
+    def pause(self) -> None:
+        """Stop uploading, running uploads are interrupted and retried later."""
+        if self.paused:
+            return
+
+        logger.info("Pausing uploads")
+        self.resumed.clear()
+        self.pause_requested.set()
+
+    def resume(self) -> None:
+        if not self.paused:
+            return
+
+        logger.info("Resuming uploads")
+        self.pause_requested.clear()
+        self.resumed.set()
+
+    def set_concurrency(self, concurrency: int) -> int:
+        """
+        Change the number of upload workers, returns the new number. Workers
+        that are no longer needed finish their current file first.
+        """
+        concurrency = min(max(1, concurrency), self.max_concurrency)
+        active = [worker for worker in self.workers if not worker.retired]
+
+        for worker in active[concurrency:]:
+            worker.retired = True
+            # Idle workers are only waiting for the queue and can stop now
+            if worker.current_file is None and worker.task:
+                worker.task.cancel()
+
+        for _ in range(concurrency - len(active)):
+            self._start_worker()
+
+        if concurrency != self.concurrency:
+            logger.info(
+                f"Changed upload workers from {self.concurrency} to {concurrency}"
+            )
+        self.concurrency = concurrency
+        return concurrency
+
+    def _start_worker(self) -> None:
+        worker = UploadWorker(self.next_worker_id)
+        self.next_worker_id += 1
+
+        worker.task = asyncio.create_task(self._run_worker(worker))
+        worker.task.add_done_callback(lambda _: self.workers.remove(worker))
+        self.workers.append(worker)
+
+    async def _run_worker(self, worker: UploadWorker) -> None:
+        while not self.shutdown_event.is_set() and not worker.retired:
+            bounded, _, file_name = await self.queue.get()
+            if bounded:
+                self.room.release()
+            worker.current_file = file_name
+            attempted: list[Target] = []
+            uploaded: list[Target] = []
+            failed: list[Target] = []
+
+            try:
+                pending = await self.db.pending_targets(file_name)
+                targets = [target for target in self.targets if target.name in pending]
+
+                # Hold on to the file until uploading to a target is allowed
+                if targets:
+                    kind = media_kind(file_name)
+                    attempted = await self._wait_ready(targets, kind)
+                    results = await self._upload(file_name, attempted, kind)
+                else:
+                    results = {}
+
+                # Other errors are raised once every result is recorded
+                error: BaseException | None = None
+                for target, result in results.items():
+                    if result is True:
+                        uploaded.append(target)
+                        worker.uploaded += 1
+                        target.breaker.record_success()
+
+                    elif isinstance(result, UploadError):
+                        logger.error(
+                            f"Failed to upload {file_name} to {target.name}: {result}"
+                        )
+                        worker.failed += 1
+                        failed.append(target)
+                        await self._record_failure(file_name, target, result)
+
+                    elif isinstance(result, BaseException):
+                        error = error or result
+
+                if error is not None:
+                    raise error
+
+            except FileNotFoundError:
+                await self.db.remove_media(file_name)
+
+            except Exception as e:
+                logger.error(
+                    f"Upload worker {worker.worker_id} failed on {file_name}: {e}"
+                )
+                worker.failed += 1
+
+                # Retried with a backoff like a failed upload, instead of again
+                # on the next pass over pending media
+                try:
+                    for target in attempted:
+                        if target not in uploaded and target not in failed:
+                            await self._record_failure(
+                                file_name, target, UploadError(str(e))
+                            )
+                except Exception as e:
+                    logger.error(f"Failed to record the failure of {file_name}: {e}")
+
+            finally:
+                worker.current_file = None
+                if uploaded:
+                    # Move on to the next file while the database batches the
+                    # uploaded flag, the file stays in flight until it is durable.
+                    task = asyncio.create_task(self._mark_uploaded(file_name, uploaded))
+                    self.mark_tasks.add(task)
+                    task.add_done_callback(self.mark_tasks.discard)
+                else:
+                    self.in_flight.discard(file_name)
+                self.queue.task_done()
+
+    async def _wait_ready(self, targets: list[Target], kind: int) -> list[Target]:
+        """
+        Wait until uploads of a class of media to one of targets are allowed,
+        returns those ready.
+        """
+        while True:
+            await self.resumed.wait()
+
+            ready = [target for target in targets if target.ready(kind)]
+            if ready:
+                break
+
+            # Only blocked by network conditions while no target has them,
+            # a target that has them waits for its circuit breaker instead
+            monitors = [target.monitor_for(kind) for target in targets]
+            if not any(monitor.verdict for monitor in monitors):
+                waits = [
+                    asyncio.create_task(monitor.favorable.wait())
+                    for monitor in monitors
+                ]
+                blocked = self.blocked()
+            else:
+                waits = [
+                    asyncio.create_task(target.wait_ready(kind)) for target in targets
+                ] + [
+                    asyncio.create_task(monitor.unfavorable.wait())
+                    for monitor in monitors
+                    if monitor.verdict
+                ]
+                blocked = contextlib.nullcontext()
+
+            try:
+                with blocked:
+                    await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for wait in waits:
+                    wait.cancel()
+
+        return ready
+
+    async def _upload(
+        self, file_name: str, targets: list[Target], kind: int
+    ) -> dict[Target, bool | BaseException]:
+        """
+        Upload a file to targets at the same time, reading it only once when
+        there are several. Returns the outcome for each target.
+
+        The SHA-1 checksum Immich identifies assets by is computed from that
+        same read unless it is already known, e.g. from an upload to another
+        target, and stored for later uploads and checks.
+        """
+        stats = await asyncio.to_thread(os.stat, file_name)
+        checksum = await self.db.get_checksum(file_name)
+        body_checksum = BodyChecksum() if checksum is None else None
+
+        if len(targets) == 1:
+            readers = [None]
+        else:
+            shared = SharedFile(
+                file_name, targets[0].immich.chunk_size, checksum=body_checksum
+            )
+            readers = [shared.reader() for _ in targets]
+
+        results = await asyncio.gather(
+            *(
+                self._upload_to(
+                    target,
+                    file_name,
+                    reader,
+                    kind,
+                    checksum,
+                    body_checksum if reader is None else None,
+                )
+                for target, reader in zip(targets, readers)
+            ),
+            return_exceptions=True,
+        )
+
+        if body_checksum is not None and any(result is True for result in results):
+            await self._store_checksum(file_name, stats, body_checksum)
+
+        return dict(zip(targets, results))
+
+    async def _store_checksum(
+        self, file_name: str, stats: os.stat_result, body_checksum: BodyChecksum
+    ) -> None:
+        """Keep a checksum computed while uploading if it covers the whole file."""
+        try:
+            after = await asyncio.to_thread(os.stat, file_name)
+        except OSError:
+            return
+
+        # Changed while it was read, the checksum may be of neither version
+        if (
+            body_checksum.size != stats.st_size
+            or after.st_size != stats.st_size
+            or after.st_mtime_ns != stats.st_mtime_ns
+        ):
+            return
+
+        await self.db.set_checksum(file_name, body_checksum.digest(), stats)
+
+    async def _upload_to(
+        self,
+        target: Target,
+        file_name: str,
+        reader,
+        kind: int,
+        checksum: bytes | None = None,
+        body_checksum: BodyChecksum | None = None,
+    ) -> bool:
+        """
+        Upload a file to a target, giving up early if its network conditions
+        for the class of media stop being favorable or uploads are paused.
+        """
+        upload = asyncio.create_task(
+            target.immich.upload(file_name, reader, checksum, body_checksum)
+        )
+        unfavorable = asyncio.create_task(target.monitor_for(kind).unfavorable.wait())
+        paused = asyncio.create_task(self.pause_requested.wait())
+
+        try:
+            await asyncio.wait(
+                {upload, unfavorable, paused}, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            unfavorable.cancel()
+            paused.cancel()
+            if not upload.done():
+                upload.cancel()
+                await asyncio.gather(upload, return_exceptions=True)
+            # Lets the other targets go on without this one
+            if reader is not None:
+                reader.close()
+
+        if upload.cancelled():
+            if self.paused:
+                logger.warning(f"Uploads paused, stopping upload of {file_name}")
+            else:
+                logger.warning(
+                    f"Network conditions for {target.name} changed, pausing "
+                    f"upload of {file_name}"
+                )
+            return False
+
+        return upload.result()
+
+    async def _record_failure(
+        self, file_name: str, target: Target, error: UploadError
+    ) -> None:
+        """Schedule the next attempt of a failed upload."""
+        attempts = await self.db.get_attempts(file_name, target.name)
+
+        if error.server_error:
+            # Not the file's fault, retry it once the server recovers
+            next_attempt_at = target.breaker.record_failure()
+        else:
+            attempts += 1
+            delay = backoff_delay(attempts, self.retry_base_delay, self.retry_max_delay)
+            next_attempt_at = time.time() + delay
+            logger.warning(
+                f"Retrying {file_name} on {target.name} in {delay:.0f}s after "
+                f"{attempts} attempts"
+            )
+
+        metrics.retries.inc()
+        await self.db.mark_failed(
+            file_name, target.name, str(error), attempts, next_attempt_at
+        )
+
+    async def _mark_uploaded(self, file_name: str, targets: list[Target]) -> None:
+        try:
+            await asyncio.gather(
+                *(self.db.mark_uploaded(file_name, target.name) for target in targets)
+            )
+        finally:
+            self.in_flight.discard(file_name)
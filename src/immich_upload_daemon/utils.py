@@ -5,3 +5,11 @@ def str_to_bool(value: str) -> bool:
         return False
 
     return str(value).lower() in ("y", "yes", "t", "true", "on", "1")
+
+
+def str_to_int(value: str | None, default: int) -> int:
+    # Fallback for if the key exists but is not set
+    if not value:
+        return default
+
+    return int(value)
@@ -0,0 +1,210 @@
+import asyncio
+import os
+import sqlite3
+import time
+
+import pytest
+
+from immich_upload_daemon.database import PENDING, UPLOADED, Database
+
+# Migrations in the order Database._migrate runs them
+MIGRATIONS = [
+    "_migrate_legacy",
+    "_migrate_normalized",
+    "_migrate_spilled_files",
+    "_migrate_precheck",
+]
+
+
+def user_version(db_file: str) -> int:
+    with sqlite3.connect(db_file) as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def create_baseline(db_file: str) -> None:
+    """Database as written by the version before the schema was versioned."""
+    with sqlite3.connect(db_file) as conn:
+        conn.execute(
+            "CREATE TABLE media (file_name TEXT PRIMARY KEY, file_hash TEXT, uploaded INTEGER)"
+        )
+        conn.execute("CREATE INDEX idx_uploaded ON media (uploaded)")
+        conn.executemany(
+            "INSERT INTO media (file_name, file_hash, uploaded) VALUES (?, ?, ?)",
+            [
+                ("/media/2024/a.jpg", "00" * 16, 1),
+                ("/media/2024/b.jpg", "11" * 16, 0),
+                ("/media/videos/c.mp4", "not a digest", None),
+            ],
+        )
+
+
+def test_migrates_baseline_database(tmp_path):
+    db_file = str(tmp_path / "media.db")
+    create_baseline(db_file)
+
+    async def check():
+        db = Database(db_file)
+        await db.init_db()
+        try:
+            assert not db.precheck
+            assert await db.is_uploaded("/media/2024/a.jpg")
+            assert not await db.is_uploaded("/media/2024/b.jpg")
+            assert not await db.is_uploaded("/media/videos/c.mp4")
+            assert await db.find_uploaded(bytes(16)) == ("/media/2024/a.jpg", None)
+
+            async with db.connection.execute(
+                "SELECT path FROM directories ORDER BY path"
+            ) as cursor:
+                directories = [row[0] for row in await cursor.fetchall()]
+            assert directories == ["/media/2024", "/media/videos"]
+
+            async with db.connection.execute(
+                "SELECT name, file_hash, status, precheck FROM media ORDER BY id"
+            ) as cursor:
+                rows = await cursor.fetchall()
+            assert rows == [
+                ("a.jpg", bytes(16), UPLOADED, 0),
+                ("b.jpg", bytes.fromhex("11" * 16), PENDING, 1),
+                ("c.mp4", None, PENDING, 1),
+            ]
+
+            async with db.connection.execute(
+                "SELECT status FROM uploads ORDER BY media_id"
+            ) as cursor:
+                statuses = [row[0] for row in await cursor.fetchall()]
+            assert statuses == [UPLOADED, PENDING, PENDING]
+        finally:
+            await db.close()
+
+    asyncio.run(check())
+    assert user_version(db_file) == len(MIGRATIONS)
+
+
+def test_baseline_upload_state_is_kept_for_the_first_target(tmp_path):
+    db_file = str(tmp_path / "media.db")
+    create_baseline(db_file)
+
+    async def check():
+        db = Database(db_file, targets=["home", "backup"])
+        await db.init_db()
+        try:
+            assert await db.pending_targets("/media/2024/a.jpg") == ["backup"]
+            assert await db.pending_targets("/media/2024/b.jpg") == ["home", "backup"]
+            assert not await db.is_uploaded("/media/2024/a.jpg")
+        finally:
+            await db.close()
+
+    asyncio.run(check())
+
+
+@pytest.mark.parametrize("version", range(len(MIGRATIONS)))
+def test_migration_steps_commit_on_their_own(tmp_path, monkeypatch, version):
+    db_file = str(tmp_path / "media.db")
+    create_baseline(db_file)
+
+    async def fail(self):
+        raise RuntimeError("migration failed")
+
+    async def init(db: Database) -> None:
+        try:
+            await db.init_db()
+        finally:
+            await db.close()
+
+    # Versions before the failing migration stay applied
+    with monkeypatch.context() as patch:
+        patch.setattr(Database, MIGRATIONS[version], fail)
+        with pytest.raises(RuntimeError):
+            asyncio.run(init(Database(db_file)))
+    assert user_version(db_file) == version
+
+    # And the next start carries on from there
+    asyncio.run(init(Database(db_file)))
+    assert user_version(db_file) == len(MIGRATIONS)
+
+
+def test_new_database_is_created_at_latest_version(tmp_path):
+    db_file = str(tmp_path / "media.db")
+    media = tmp_path / "a.jpg"
+    media.write_bytes(b"photo")
+
+    async def check():
+        db = Database(db_file)
+        await db.init_db()
+        try:
+            assert db.precheck
+            assert await db.add_media(str(media), b"h" * 16, os.stat(media))
+            assert await db.get_unchecked(10) == [str(media)]
+        finally:
+            await db.close()
+
+    asyncio.run(check())
+    assert user_version(db_file) == len(MIGRATIONS)
+
+
+def test_refuses_newer_database(tmp_path):
+    db_file = str(tmp_path / "media.db")
+    with sqlite3.connect(db_file) as conn:
+        conn.execute(f"PRAGMA user_version = {len(MIGRATIONS) + 1}")
+
+    async def init():
+        db = Database(db_file)
+        try:
+            await db.init_db()
+        finally:
+            await db.close()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(init())
+
+
+def test_pending_targets_only_flushes_writes_to_its_media(tmp_path):
+    files = [tmp_path / "a.jpg", tmp_path / "b.jpg"]
+
+    async def check():
+        db = Database(str(tmp_path / "media.db"))
+        await db.init_db()
+        try:
+            for i, media in enumerate(files):
+                media.write_bytes(b"photo")
+                await db.add_media(str(media), i.to_bytes(16), os.stat(media))
+            await db.flush()
+
+            await db.mark_failed(
+                str(files[0]), "default", "failed", 1, time.time() + 60
+            )
+            assert await db.pending_targets(str(files[1])) == ["default"]
+            assert db.pending_writes
+
+            assert await db.pending_targets(str(files[0])) == []
+            assert not db.pending_writes
+        finally:
+            await db.close()
+
+    asyncio.run(check())
+
+
+def test_cancelled_flush_commits_the_writes_it_took(tmp_path):
+    media = tmp_path / "a.jpg"
+    media.write_bytes(b"photo")
+
+    async def check():
+        db = Database(str(tmp_path / "media.db"))
+        await db.init_db()
+        try:
+            await db.add_media(str(media), bytes(16), os.stat(media))
+            await db.flush()
+
+            marked = asyncio.create_task(db.mark_uploaded(str(media), "default"))
+            await asyncio.sleep(0)
+            flush = asyncio.create_task(db.flush())
+            while db.pending_writes:
+                await asyncio.sleep(0)
+            flush.cancel()
+
+            assert await asyncio.wait_for(marked, 1)
+            assert await db.is_uploaded(str(media))
+        finally:
+            await db.close()
+
+    asyncio.run(check())
@@ -0,0 +1,54 @@
+import asyncio
+
+from immich_upload_daemon.database import Database
+from immich_upload_daemon.files import EventCoalescer
+
+
+def test_overflow_is_spilled_and_drained_in_order(tmp_path):
+    paths = []
+    for i in range(6):
+        path = tmp_path / f"{i}.jpg"
+        path.write_bytes(b"photo")
+        paths.append(str(path))
+
+    async def check():
+        db = Database(str(tmp_path / "media.db"))
+        await db.init_db()
+        queue = asyncio.Queue(2)
+        caught_up = asyncio.Event()
+        coalescer = EventCoalescer(queue, 0, db, caught_up.set)
+        try:
+            for path in paths[:5]:
+                coalescer.notify(path, complete=True)
+            coalescer.notify(paths[5], complete=True, moved_from="/old/5.jpg")
+
+            # Files beyond the queue and the paths waiting to settle are spilled
+            assert coalescer.spilling
+            assert [queue.get_nowait() for _ in range(2)] == [
+                (paths[0], None),
+                (paths[1], None),
+            ]
+            assert queue.empty()
+            spilled = [path for _, path, _ in await db.get_spilled(10)]
+            assert spilled == paths[2:]
+
+            # Fed back in the order they were spilled, renames included
+            drain = asyncio.create_task(coalescer.drain())
+            drained = [await asyncio.wait_for(queue.get(), 5) for _ in range(4)]
+            assert drained == [
+                (paths[2], None),
+                (paths[3], None),
+                (paths[4], None),
+                (paths[5], "/old/5.jpg"),
+            ]
+
+            await asyncio.wait_for(caught_up.wait(), 5)
+            assert not coalescer.spilling
+            assert await db.get_spilled(10) == []
+
+            drain.cancel()
+            await asyncio.gather(drain, return_exceptions=True)
+        finally:
+            await db.close()
+
+    asyncio.run(check())
@@ -0,0 +1,103 @@
+import asyncio
+import os
+
+from immich_upload_daemon.database import Database
+from immich_upload_daemon.index import (
+    MIN_FILTER_BYTES,
+    FileIndex,
+    path_fingerprint,
+)
+
+STAT = (100, 1_000, 1, 1)
+
+
+def loaded(count: int, compact_threshold: int = 4096) -> FileIndex:
+    """Index loaded with count files the way Database.load_index fills it."""
+    rows = sorted(
+        (path_fingerprint(f"/media/{i}.jpg"), i.to_bytes(16), False, *STAT)
+        for i in range(count)
+    )
+    index = FileIndex(compact_threshold)
+    index.load(rows[: count // 2])
+    index.load(rows[count // 2 :])
+    return index
+
+
+def test_overlay_lookups_match_compacted():
+    index = loaded(100, compact_threshold=1000)
+    index.add("/media/new.jpg", b"n" * 16, STAT)
+    index.set_stat("/media/1.jpg", (200, 2_000, 1, 1))
+    index.remove("/media/2.jpg")
+    index.set_uploaded("/media/3.jpg")
+    index.rename("/media/4.jpg", "/media/moved.jpg", STAT)
+
+    def check():
+        assert len(index) == 100
+        assert index.has_hash("/media/new.jpg", b"n" * 16)
+        assert index.is_unchanged("/media/new.jpg", STAT)
+        assert not index.is_unchanged("/media/1.jpg", STAT)
+        assert index.is_unchanged("/media/1.jpg", (200, 2_000, 1, 1))
+        assert not index.has_hash("/media/2.jpg", (2).to_bytes(16))
+        assert index.has_hash("/media/3.jpg", (3).to_bytes(16))
+        assert not index.is_unchanged("/media/4.jpg", STAT)
+        assert index.has_hash("/media/moved.jpg", (4).to_bytes(16))
+
+    assert index.added
+    check()
+    index.compact()
+    assert not index.added
+    check()
+
+    # A removed file coming back revives its tombstone
+    index.add("/media/2.jpg", b"b" * 16, STAT)
+    assert len(index) == 101
+    assert index.has_hash("/media/2.jpg", b"b" * 16)
+
+
+def test_overlay_is_compacted_past_threshold():
+    index = loaded(10, compact_threshold=8)
+    for i in range(7):
+        index.add(f"/media/new/{i}.jpg", b"n" * 16, STAT)
+    assert len(index.added) == 7
+
+    index.add("/media/new/7.jpg", b"n" * 16, STAT)
+    assert not index.added
+    assert list(index.keys) == sorted(index.keys)
+    assert all(index.is_unchanged(f"/media/new/{i}.jpg", STAT) for i in range(8))
+
+
+def test_filter_has_no_false_negatives_as_it_grows():
+    # Enough files to outgrow the smallest filter and rebuild it
+    count = MIN_FILTER_BYTES * 8 // 16 + 1000
+    index = loaded(count // 2)
+    assert all(index.may_contain(i.to_bytes(16)) for i in range(count // 2))
+
+    for i in range(count // 2, count):
+        index.add(f"/media/{i}.jpg", i.to_bytes(16), STAT)
+    assert len(index.content_filter) > MIN_FILTER_BYTES
+    assert all(index.may_contain(i.to_bytes(16)) for i in range(count))
+
+    # Mostly certain about content that is not known
+    unknown = sum(index.may_contain((count + i).to_bytes(16)) for i in range(1000))
+    assert unknown < 50
+
+
+def test_filter_false_positive_falls_back_to_query(tmp_path):
+    media = tmp_path / "a.jpg"
+    media.write_bytes(b"photo")
+
+    async def check():
+        db = Database(str(tmp_path / "media.db"))
+        await db.init_db()
+        try:
+            await db.add_media(str(media), b"a" * 16, os.stat(media))
+            await db.mark_uploaded(str(media), "default")
+            assert await db.find_uploaded(b"a" * 16) == (str(media), None)
+
+            # Content the filter wrongly reports as possibly known
+            db.index.may_contain = lambda file_hash: True
+            assert await db.find_uploaded(b"b" * 16) is None
+        finally:
+            await db.close()
+
+    asyncio.run(check())
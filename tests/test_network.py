@@ -0,0 +1,155 @@
+import asyncio
+import sys
+import time
+
+from immich_upload_daemon import metrics
+from immich_upload_daemon.network import (
+    NetworkMonitor,
+    NetworkState,
+    has_networkmanager,
+)
+from immich_upload_daemon.schedule import PHOTO
+from immich_upload_daemon.uploader import Target, UploadPool
+
+
+class FakeProvider:
+    """Network state set by the test, changes are signalled by notify()."""
+
+    def __init__(self, metered: bool) -> None:
+        self.state = NetworkState(connected=True, metered=metered)
+        self.snapshots: int = 0
+        self.on_change = None
+
+    async def snapshot(self) -> NetworkState:
+        self.snapshots += 1
+        return self.state
+
+    async def watch(self, on_change) -> None:
+        self.on_change = on_change
+        await asyncio.Event().wait()
+
+    def notify(self, metered: bool) -> None:
+        self.state = NetworkState(connected=True, metered=metered)
+        self.on_change()
+
+
+class StalledClient:
+    """Immich client whose uploads never finish, records their cancellation."""
+
+    def __init__(self) -> None:
+        self.started = asyncio.Event()
+        self.cancelled = False
+
+    async def upload(self, file, source=None, checksum=None, body_checksum=None):
+        self.started.set()
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+def test_refresh_flips_events():
+    async def check():
+        provider = FakeProvider(metered=False)
+        monitor = NetworkMonitor(provider, False, None, True)
+        assert monitor.unfavorable.is_set()
+
+        assert await monitor.refresh()
+        assert monitor.favorable.is_set()
+        assert not monitor.unfavorable.is_set()
+
+        provider.state = NetworkState(connected=True, metered=True)
+        assert not await monitor.refresh()
+        assert not monitor.favorable.is_set()
+        assert monitor.unfavorable.is_set()
+
+        # Unknown metering does not count as unmetered
+        provider.state = NetworkState(connected=True)
+        assert not await monitor.refresh()
+
+    asyncio.run(check())
+
+
+def test_changes_settle_before_refreshing():
+    async def check():
+        provider = FakeProvider(metered=False)
+        monitor = NetworkMonitor(provider, False, None, True, poll_interval=3600)
+        assert monitor.settle_delay == 1.0
+
+        run = asyncio.create_task(monitor.run())
+        await monitor.favorable.wait()
+        assert provider.snapshots == 1
+
+        # A burst of signals only refreshes once, after the settle delay
+        for _ in range(3):
+            provider.notify(metered=True)
+            await asyncio.sleep(0.1)
+        await asyncio.sleep(0.5)
+        assert monitor.verdict
+        assert provider.snapshots == 1
+
+        await asyncio.wait_for(monitor.unfavorable.wait(), 1)
+        assert provider.snapshots == 2
+
+        run.cancel()
+        await asyncio.gather(run, return_exceptions=True)
+
+    asyncio.run(check())
+
+
+def test_upload_is_cancelled_when_conditions_turn_unfavorable():
+    async def check():
+        provider = FakeProvider(metered=False)
+        monitor = NetworkMonitor(provider, False, None, True)
+        await monitor.refresh()
+
+        client = StalledClient()
+        target = Target("default", client, monitor)
+        pool = UploadPool(None, [target], 1, asyncio.Event())
+
+        upload = asyncio.create_task(
+            pool._upload_to(target, "/media/a.jpg", None, PHOTO)
+        )
+        await client.started.wait()
+        assert not upload.done()
+
+        provider.state = NetworkState(connected=True, metered=True)
+        await monitor.refresh()
+        assert await asyncio.wait_for(upload, 1) is False
+        assert client.cancelled
+
+    asyncio.run(check())
+
+
+def test_only_waits_on_network_conditions_count_as_blocked():
+    async def check():
+        provider = FakeProvider(metered=True)
+        monitor = NetworkMonitor(provider, False, None, True)
+        await monitor.refresh()
+
+        target = Target("default", StalledClient(), monitor)
+        pool = UploadPool(None, [target], 1, asyncio.Event())
+
+        # Waiting on the network
+        blocked = metrics.network_blocked_seconds.value
+        wait = asyncio.create_task(pool._wait_ready([target], PHOTO))
+        await asyncio.sleep(0.2)
+        assert metrics.network_blocked_seconds.value == blocked
+
+        # Backing off from a failing server once the network is back
+        target.breaker.retry_at = time.time() + 0.3
+        provider.state = NetworkState(connected=True, metered=False)
+        await monitor.refresh()
+        assert await asyncio.wait_for(wait, 1) == [target]
+        waited = metrics.network_blocked_seconds.value - blocked
+        assert 0.2 <= waited < 0.3
+
+    asyncio.run(check())
+
+
+def test_missing_networkmanager_extra_is_detected(monkeypatch):
+    # A None entry makes the import fail as if the package was not installed
+    monkeypatch.setitem(sys.modules, "sdbus_async", None)
+    monkeypatch.delitem(sys.modules, "sdbus_async.networkmanager", raising=False)
+    assert not has_networkmanager()
@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import os
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from immich_upload_daemon import payload
+from immich_upload_daemon.payload import (
+    SHARED_CHUNK_SIZE,
+    BodyChecksum,
+    FilePayload,
+    SharedFile,
+)
+from immich_upload_daemon.throttle import Bandwidth
+
+
+async def digest_upload(request: web.Request) -> web.Response:
+    body = (await request.post())["assetData"].file.read()
+    return web.json_response(
+        {"size": len(body), "sha1": hashlib.sha1(body).hexdigest()}
+    )
+
+
+@pytest.mark.parametrize("sendfile", [True, False])
+def test_body_and_checksum_match_the_file(tmp_path, monkeypatch, sendfile):
+    content = os.urandom(1024 * 1024 + 123)
+    media = tmp_path / "a.jpg"
+    media.write_bytes(content)
+
+    ranges = []
+    if sendfile:
+        send_range = payload._sendfile_range
+
+        def record(sock_fd, file_fd, offset, count, cancelled):
+            ranges.append((offset, count))
+            send_range(sock_fd, file_fd, offset, count, cancelled)
+
+        monkeypatch.setattr(payload, "_sendfile_range", record)
+    else:
+        monkeypatch.delattr(os, "sendfile")
+
+    async def check():
+        app = web.Application(client_max_size=2 * len(content))
+        app.router.add_post("/", digest_upload)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            checksum = BodyChecksum()
+            body = FilePayload(
+                str(media),
+                len(content),
+                min_chunk_size=16 * 1024,
+                max_chunk_size=256 * 1024,
+                checksum=checksum,
+            )
+            # Sent as multipart form data like Immich.upload does
+            form = aiohttp.FormData()
+            form.add_field("assetData", body, filename="a.jpg")
+            async with aiohttp.ClientSession() as session:
+                async with session.post(server.make_url("/"), data=form) as response:
+                    result = await response.json()
+        finally:
+            await server.close()
+
+        assert result == {
+            "size": len(content),
+            "sha1": hashlib.sha1(content).hexdigest(),
+        }
+        assert checksum.size == len(content)
+        assert checksum.digest() == hashlib.sha1(content).digest()
+        assert body.transfer.sent == len(content)
+
+    asyncio.run(check())
+
+    if sendfile:
+        # Sent in ranges, each hashed while the next one is sent
+        assert ranges[0] == (0, 256 * 1024)
+        assert sum(count for _, count in ranges) == len(content)
+
+
+def test_sendfile_ranges_follow_the_bandwidth_limit(tmp_path):
+    def slice_size(rate: int) -> int:
+        body = FilePayload(
+            str(tmp_path / "a.jpg"),
+            0,
+            min_chunk_size=16 * 1024,
+            max_chunk_size=1024 * 1024,
+            bandwidth=Bandwidth(rate),
+        )
+        return body._slice_size()
+
+    assert slice_size(0) == 1024 * 1024
+    assert slice_size(1024 * 1024) == int(1024 * 1024 * payload.TARGET_CHUNK_TIME)
+    assert slice_size(1024) == 16 * 1024
+    assert slice_size(1024 * 1024 * 1024) == 1024 * 1024
+
+
+def test_chunks_grow_while_sent_quickly_and_shrink_when_slow(tmp_path):
+    sizes = [1024, 2048, 4096, 8192, 16384, 8192, 4096]
+    media = tmp_path / "a.jpg"
+    media.write_bytes(os.urandom(sum(sizes)))
+
+    class Writer:
+        def __init__(self) -> None:
+            self.sizes: list[int] = []
+
+        async def write(self, chunk: bytes) -> None:
+            self.sizes.append(len(chunk))
+            # The connection slows down once reads reach the largest size
+            if len(self.sizes) > 4:
+                await asyncio.sleep(payload.TARGET_CHUNK_TIME * 2.5)
+
+    async def check():
+        writer = Writer()
+        body = FilePayload(
+            str(media), media.stat().st_size, min_chunk_size=1024, max_chunk_size=16384
+        )
+        with open(media, "rb", buffering=0) as f:
+            await body._write_chunks(writer, f)
+        assert writer.sizes == sizes
+
+    asyncio.run(check())
+
+
+def test_reader_closing_early_does_not_stall_the_others(tmp_path):
+    content = os.urandom(SHARED_CHUNK_SIZE * 5 + 123)
+    media = tmp_path / "a.jpg"
+    media.write_bytes(content)
+
+    async def check():
+        checksum = BodyChecksum()
+        shared = SharedFile(str(media), window=2, checksum=checksum)
+        early, unstarted, complete = (shared.reader() for _ in range(3))
+
+        async def read_one() -> None:
+            async for _ in early.chunks():
+                break
+            early.close()
+
+        async def read_all() -> bytes:
+            return b"".join([chunk async for chunk in complete.chunks()])
+
+        unstarted.close()
+        _, body = await asyncio.wait_for(asyncio.gather(read_one(), read_all()), 5)
+        complete.close()
+
+        assert body == content
+        assert checksum.digest() == hashlib.sha1(content).digest()
+        assert shared.task.done() and not shared.task.cancelled()
+
+    asyncio.run(check())
+
+
+def test_shared_read_stops_once_every_reader_closed(tmp_path):
+    media = tmp_path / "a.jpg"
+    media.write_bytes(os.urandom(SHARED_CHUNK_SIZE * 8))
+
+    async def check():
+        shared = SharedFile(str(media), window=1)
+        first, second = shared.reader(), shared.reader()
+        for reader in (first, second):
+            async for _ in reader.chunks():
+                break
+
+        first.close()
+        assert not shared.task.done()
+        second.close()
+        await asyncio.sleep(0)
+        assert shared.task.cancelled()
+
+    asyncio.run(check())
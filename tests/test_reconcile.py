@@ -0,0 +1,51 @@
+import asyncio
+import os
+
+from immich_upload_daemon.database import Database
+from immich_upload_daemon.hasher import Hasher
+from immich_upload_daemon.reconcile import Reconciler
+
+
+def test_removes_deleted_files_and_their_directories(tmp_path):
+    root = tmp_path / "media"
+    for directory in ("2024", "2025"):
+        (root / directory).mkdir(parents=True)
+        (root / directory / "a.jpg").write_bytes(os.urandom(100))
+
+    async def check():
+        db = Database(str(tmp_path / "media.db"))
+        await db.init_db()
+        hasher = Hasher(db, 1, False, lambda: None)
+        reconciler = Reconciler([str(root)], db, hasher, 0, settle=0)
+        try:
+            result = await reconciler.reconcile()
+            await hasher.join()
+            assert result.added == 2
+            assert sorted(await db.directories_under(str(root))) == [
+                str(root / "2024"),
+                str(root / "2025"),
+            ]
+
+            # Deleted along with its directory
+            (root / "2024" / "a.jpg").unlink()
+            (root / "2024").rmdir()
+            result = await reconciler.reconcile()
+            assert result.removed == 1
+            assert not await db.is_uploaded(str(root / "2024" / "a.jpg"))
+            assert await db.directories_under(str(root)) == [str(root / "2025")]
+
+            # Media coming back to the directory adds it again
+            (root / "2024").mkdir()
+            (root / "2024" / "b.jpg").write_bytes(os.urandom(100))
+            await reconciler.reconcile()
+            await hasher.join()
+            await db.flush()
+            assert sorted(await db.directories_under(str(root))) == [
+                str(root / "2024"),
+                str(root / "2025"),
+            ]
+        finally:
+            await hasher.close()
+            await db.close()
+
+    asyncio.run(check())
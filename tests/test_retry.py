@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+from immich_upload_daemon.retry import CircuitBreaker, backoff_delay
+
+
+def test_backoff_doubles_up_to_the_limit():
+    for attempts, delay in [(0, 10), (1, 10), (2, 20), (3, 40), (10, 100)]:
+        for _ in range(20):
+            assert delay / 2 <= backoff_delay(attempts, 10, 100) <= delay
+
+
+def test_breaker_opens_after_threshold_failures():
+    breaker = CircuitBreaker(threshold=3, base_delay=10, max_delay=100)
+
+    # Failures below the threshold only delay the file
+    for _ in range(2):
+        assert breaker.record_failure() <= time.time() + 10
+        assert not breaker.is_open
+
+    retry_at = breaker.record_failure()
+    assert breaker.is_open
+    assert breaker.retry_at == retry_at
+    assert time.time() + 5 <= retry_at <= time.time() + 10
+
+    # The pause grows with each further failure
+    assert breaker.record_failure() >= time.time() + 10
+    assert breaker.failures == 4
+
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.failures == 0
+
+
+def test_breaker_wait_lasts_until_retry():
+    breaker = CircuitBreaker()
+
+    async def check():
+        start = time.monotonic()
+        await breaker.wait()
+        assert time.monotonic() - start < 0.1
+
+        breaker.retry_at = time.time() + 0.2
+        await breaker.wait()
+        assert time.monotonic() - start >= 0.2
+        assert not breaker.is_open
+
+    asyncio.run(check())
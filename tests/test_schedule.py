@@ -0,0 +1,103 @@
+import asyncio
+import os
+
+import pytest
+
+from immich_upload_daemon import database
+from immich_upload_daemon.database import Database
+from immich_upload_daemon.schedule import UploadOrder
+
+# Media in the order it is discovered, with its mtime and size
+MEDIA = [
+    ("a.jpg", 300, 30),
+    ("b.mp4", 500, 10),
+    ("c.jpg", 100, 50),
+    ("d.mov", 200, 20),
+    ("e.jpg", 400, 40),
+]
+
+
+def create_media(directory, name: str, mtime: int, size: int) -> str:
+    path = directory / name
+    path.write_bytes(os.urandom(size))
+    os.utime(path, ns=(mtime * 10**9, mtime * 10**9))
+    return str(path)
+
+
+async def open_db(tmp_path, order: str) -> Database:
+    db = Database(str(tmp_path / "media.db"), order=UploadOrder(order))
+    await db.init_db()
+    for i, (name, mtime, size) in enumerate(MEDIA):
+        path = create_media(tmp_path, name, mtime, size)
+        await db.add_media(path, i.to_bytes(16), os.stat(path))
+    return db
+
+
+async def pending(db: Database, **kwargs) -> list[str]:
+    return [
+        os.path.basename(file_name)
+        async for file_name, _ in db.iter_unuploaded(page_size=2, **kwargs)
+    ]
+
+
+@pytest.mark.parametrize(
+    "order, expected",
+    [
+        ("discovered", ["a.jpg", "b.mp4", "c.jpg", "d.mov", "e.jpg"]),
+        ("newest", ["b.mp4", "e.jpg", "a.jpg", "d.mov", "c.jpg"]),
+        ("oldest", ["c.jpg", "d.mov", "a.jpg", "e.jpg", "b.mp4"]),
+        ("smallest", ["b.mp4", "d.mov", "a.jpg", "e.jpg", "c.jpg"]),
+        ("type", ["a.jpg", "c.jpg", "e.jpg", "b.mp4", "d.mov"]),
+        ("type,newest", ["e.jpg", "a.jpg", "c.jpg", "b.mp4", "d.mov"]),
+        ("type,oldest", ["c.jpg", "a.jpg", "e.jpg", "d.mov", "b.mp4"]),
+        ("type,smallest", ["a.jpg", "e.jpg", "c.jpg", "b.mp4", "d.mov"]),
+    ],
+)
+def test_pending_media_follows_the_upload_order(tmp_path, order, expected):
+    async def check():
+        db = await open_db(tmp_path, order)
+        try:
+            assert await pending(db) == expected
+
+            # Videos are left out while none of the targets takes them
+            photos = [name for name in expected if name.endswith(".jpg")]
+            assert await pending(db, video_targets=[]) == photos
+        finally:
+            await db.close()
+
+    asyncio.run(check())
+
+
+def test_invalid_order_is_rejected():
+    for order in ("largest", "newest,oldest", "type,type"):
+        with pytest.raises(ValueError):
+            UploadOrder(order)
+
+
+def test_pass_restarts_from_the_top_for_new_media(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "RESTART_INTERVAL", 0)
+
+    async def check():
+        db = await open_db(tmp_path, "newest")
+        try:
+            passing = db.iter_unuploaded(page_size=2)
+            seen = [os.path.basename((await anext(passing))[0])]
+
+            # Newer than everything pending, so it comes next
+            path = create_media(tmp_path, "f.jpg", 1000, 10)
+            await db.add_media(path, b"f" * 16, os.stat(path))
+
+            seen += [os.path.basename(file_name) async for file_name, _ in passing]
+            assert seen == [
+                "b.mp4",
+                "f.jpg",
+                "b.mp4",
+                "e.jpg",
+                "a.jpg",
+                "d.mov",
+                "c.jpg",
+            ]
+        finally:
+            await db.close()
+
+    asyncio.run(check())
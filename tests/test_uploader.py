@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import os
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from fake_immich import FakeImmich
+from immich_upload_daemon import payload
+from immich_upload_daemon.database import FAILED, PENDING, UPLOADED, Database
+from immich_upload_daemon.immich import Immich
+from immich_upload_daemon.network import NetworkMonitor, NullNetworkProvider
+from immich_upload_daemon.uploader import Target, UploadPool, check_existing_assets
+
+
+async def open_db(
+    tmp_path, files: dict[str, bytes], targets: list[str] | None = None
+) -> Database:
+    """Database of a first scan that found files, by name with their content."""
+    db = Database(str(tmp_path / "media.db"), targets=targets)
+    await db.init_db()
+    for i, (name, content) in enumerate(files.items()):
+        path = tmp_path / name
+        path.write_bytes(content)
+        await db.add_media(str(path), i.to_bytes(16), os.stat(path))
+    return db
+
+
+async def connect_target(
+    url: str, name: str = "default", not_metered: bool = False
+) -> Target:
+    """Connected target, the network is online with unknown metering."""
+    immich = Immich(url, "key", 65536)
+    await immich.connect()
+    monitor = NetworkMonitor(NullNetworkProvider(), False, None, not_metered)
+    await monitor.refresh()
+    return Target(name, immich, monitor)
+
+
+async def upload_states(db: Database) -> dict[str, int]:
+    async with db.connection.execute(
+        "SELECT targets.name, uploads.status FROM uploads JOIN targets ON targets.id = uploads.target_id"
+    ) as cursor:
+        return dict(await cursor.fetchall())
+
+
+async def upload_once(db: Database, targets: list[Target], file_name: str) -> None:
+    pool = UploadPool(db, targets, 1, asyncio.Event())
+    pool.start()
+    try:
+        await pool.submit(file_name)
+        await pool.join()
+        await asyncio.gather(*pool.mark_tasks)
+    finally:
+        await pool.stop()
+
+
+def test_bulk_check_marks_duplicates_without_sending_them(tmp_path):
+    async def check():
+        db = await open_db(tmp_path, {"known.jpg": b"known", "new.jpg": b"new"})
+        server = FakeImmich()
+        server.checksums.add(hashlib.sha1(b"known").hexdigest())
+        target = await connect_target(await server.start())
+        try:
+            assert await check_existing_assets(db, [target], 10) == 1
+            assert await db.is_uploaded(str(tmp_path / "known.jpg"))
+            assert not await db.is_uploaded(str(tmp_path / "new.jpg"))
+            assert server.uploads == 0
+            assert server.bytes_received == 0
+
+            # Both were checked, the new one is left to its upload
+            assert await db.get_unchecked(10) == []
+            assert await db.get_checksum(str(tmp_path / "new.jpg")) == (
+                hashlib.sha1(b"new").digest()
+            )
+        finally:
+            await target.immich.close()
+            await server.stop()
+            await db.close()
+
+    asyncio.run(check())
+
+
+def test_bulk_check_is_disabled_by_not_found(tmp_path):
+    async def check():
+        db = await open_db(tmp_path, {"a.jpg": b"a"})
+        server = TestServer(web.Application())
+        await server.start_server()
+        target = await connect_target(str(server.make_url("/api")))
+        try:
+            assert await check_existing_assets(db, [target], 10) == 0
+            assert not target.immich.bulk_check_supported
+            assert not await db.is_uploaded(str(tmp_path / "a.jpg"))
+
+            # Not asked again
+            assert await check_existing_assets(db, [target], 10) == 0
+        finally:
+            await target.immich.close()
+            await server.close()
+            await db.close()
+
+    asyncio.run(check())
+
+
+def test_bulk_check_skips_unreadable_files(tmp_path):
+    async def check():
+        db = await open_db(tmp_path, {"broken.jpg": b"broken", "known.jpg": b"known"})
+        server = FakeImmich()
+        server.checksums.add(hashlib.sha1(b"known").hexdigest())
+        target = await connect_target(await server.start())
+
+        # Reading a directory fails with an error other than a missing file
+        broken = tmp_path / "broken.jpg"
+        broken.unlink()
+        broken.mkdir()
+        try:
+            assert await check_existing_assets(db, [target], 1) == 1
+            assert await db.is_uploaded(str(tmp_path / "known.jpg"))
+            assert await db.is_uploaded(str(broken)) is False
+
+            # Left to the upload instead of being read on every pass
+            assert await db.get_unchecked(10) == []
+        finally:
+            await target.immich.close()
+            await server.stop()
+            await db.close()
+
+    asyncio.run(check())
+
+
+def test_errors_outside_the_upload_are_retried_with_backoff(tmp_path, monkeypatch):
+    async def fail(self, file_name, targets, kind):
+        raise PermissionError(f"Permission denied: {file_name}")
+
+    monkeypatch.setattr(UploadPool, "_upload", fail)
+
+    async def check():
+        db = await open_db(tmp_path, {"a.jpg": b"a"})
+        monitor = NetworkMonitor(NullNetworkProvider(), False, None, False)
+        await monitor.refresh()
+        target = Target("default", None, monitor)
+        pool = UploadPool(db, [target], 1, asyncio.Event(), retry_base_delay=60)
+        pool.start()
+        try:
+            file_name = str(tmp_path / "a.jpg")
+            await pool.submit(file_name)
+            await pool.join()
+
+            # Not due again until the backoff passed
+            assert await db.pending_targets(file_name) == []
+            assert await db.get_attempts(file_name, "default") == 1
+            async with db.connection.execute(
+                "SELECT last_error, next_attempt_at FROM uploads"
+            ) as cursor:
+                error, next_attempt_at = await cursor.fetchone()
+            assert "Permission denied" in error
+            assert next_attempt_at >= time.time() + 25
+        finally:
+            await pool.stop()
+            await db.close()
+
+    asyncio.run(check())
+
+
+def test_files_submitted_now_skip_the_full_queue():
+    async def check():
+        pool = UploadPool(None, [], 1, asyncio.Event())
+        assert await pool.submit("/media/a.jpg", (1,))
+        assert await pool.submit("/media/b.jpg", ())
+
+        # Producers wait for room
+        blocked = asyncio.create_task(pool.submit("/media/c.jpg", ()))
+        await asyncio.sleep(0.1)
+        assert not blocked.done()
+
+        assert pool.submit_now("/media/d.jpg")
+        assert not pool.submit_now("/media/a.jpg")
+        assert [pool.queue.get_nowait()[2] for _ in range(3)] == [
+            "/media/d.jpg",
+            "/media/b.jpg",
+            "/media/a.jpg",
+        ]
+
+        blocked.cancel()
+
+    asyncio.run(check())
+
+
+def test_failing_target_does_not_hold_back_the_others(tmp_path, monkeypatch):
+    content = os.urandom(3 * 1024 * 1024)
+    read = []
+    read_chunk = payload._read_chunk
+
+    def record(f, size, checksum):
+        chunk = read_chunk(f, size, checksum)
+        read.append(len(chunk))
+        return chunk
+
+    monkeypatch.setattr(payload, "_read_chunk", record)
+
+    async def fail(request: web.Request) -> web.Response:
+        await request.read()
+        return web.Response(status=500, text="Internal server error")
+
+    async def check():
+        db = await open_db(tmp_path, {"a.jpg": content}, ["home", "backup"])
+        home = FakeImmich()
+        app = web.Application(client_max_size=0)
+        app.router.add_post("/api/assets", fail)
+        failing = TestServer(app)
+        await failing.start_server()
+        targets = [
+            await connect_target(await home.start(), "home"),
+            await connect_target(str(failing.make_url("/api")), "backup"),
+        ]
+        file_name = str(tmp_path / "a.jpg")
+        try:
+            await upload_once(db, targets, file_name)
+
+            assert await upload_states(db) == {"home": UPLOADED, "backup": FAILED}
+            assert not await db.is_uploaded(file_name)
+            assert home.uploads == 1
+            assert targets[1].breaker.failures == 1
+
+            # Read once for both, and the checksum is taken from that read
+            assert sum(read) == len(content)
+            assert await db.get_checksum(file_name) == hashlib.sha1(content).digest()
+        finally:
+            for target in targets:
+                await target.immich.close()
+            await home.stop()
+            await failing.close()
+            await db.close()
+
+    asyncio.run(check())
+
+
+def test_unfavorable_target_is_left_pending(tmp_path):
+    async def check():
+        db = await open_db(tmp_path, {"a.jpg": b"photo"}, ["home", "backup"])
+        home, backup = FakeImmich(), FakeImmich()
+        targets = [
+            await connect_target(await home.start(), "home"),
+            await connect_target(await backup.start(), "backup", not_metered=True),
+        ]
+        try:
+            await upload_once(db, targets, str(tmp_path / "a.jpg"))
+
+            assert await upload_states(db) == {"home": UPLOADED, "backup": PENDING}
+            assert (home.uploads, backup.uploads) == (1, 0)
+            assert await db.pending_targets(str(tmp_path / "a.jpg")) == ["backup"]
+        finally:
+            for target in targets:
+                await target.immich.close()
+            await home.stop()
+            await backup.stop()
+            await db.close()
+
+    asyncio.run(check())